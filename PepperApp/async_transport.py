@@ -0,0 +1,295 @@
+"""
+asyncio transport core for the operator (PEPPER_ASYNC_TRANSPORT=1).
+
+One event loop, on its own thread, serves the control connection as a
+stream and the video/audio socket as a DatagramProtocol. Timers armed at
+the next NACK, frame expiry or finalisation deadline replace the receive
+timeouts and idle sleeps of the threaded handlers, so a datagram is
+handled as soon as it arrives and an idle session costs nothing. Every
+SocketManager (one per robot) runs on the same shared loop.
+
+SocketManager and the UI's worker threads keep calling the blocking
+methods of TCPSocketHandler / UDPSocketHandler, which wait on the loop,
+and report to the Tk main loop with widget.after as before.
+"""
+import asyncio
+import concurrent.futures
+import copy
+import functools
+import socket
+import threading
+import time
+from pepper_app_socket import UDPCapture
+from video_maker_old import make_video_from_frames
+
+
+class TransportLoop:
+    """An asyncio event loop running on a daemon thread."""
+    def __init__(self, name: str = "pepper-transport"):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def start(self):
+        if not self._thread.is_alive():
+            self._thread.start()
+
+    def in_loop(self) -> bool:
+        return threading.get_ident() == self._thread.ident
+
+    def submit(self, coro) -> concurrent.futures.Future:
+        """Run a coroutine on the loop; the future can be waited on from any other thread."""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def call_soon(self, callback, *args):
+        self.loop.call_soon_threadsafe(callback, *args)
+
+    def stop(self):
+        if self._thread.is_alive():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join(timeout=2.0)
+
+
+_shared_loop = None
+_shared_lock = threading.Lock()
+
+
+def shared_loop() -> TransportLoop:
+    """The process-wide transport loop, started on first use."""
+    global _shared_loop
+    with _shared_lock:
+        if _shared_loop is None:
+            _shared_loop = TransportLoop()
+            _shared_loop.start()
+    return _shared_loop
+
+
+class AsyncControlHandler:
+    """
+    The control connection as an asyncio stream, with TCPSocketHandler's
+    blocking methods. Each read waits on the loop with its own timeout
+    instead of a socket timeout, and times out the way
+    TCPSocketHandler's does: accept raises socket.timeout, reads return
+    None. Writes are queued to the loop and never block the caller.
+    The StreamReader does its own buffering, so there are no read_stats.
+    """
+    read_stats = None
+
+    def __init__(self, transport: TransportLoop, host, port):
+        self.transport = transport
+        self.host = host
+        self.port = port
+        # Bound here, like TCPSocketHandler, so a port in use fails at construction
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((self.host, self.port))
+        self.conn: asyncio.StreamWriter | None = None
+        self._reader: asyncio.StreamReader | None = None
+        self._server = None
+        self._accepted: asyncio.Queue | None = None
+        self._timeout: float | None = None
+        self._failed = False
+
+    def start(self):
+        self.transport.start()
+        if self._server is None:
+            self._server = self.transport.submit(self._start_server()).result()
+
+    async def _start_server(self):
+        self._accepted = asyncio.Queue()
+        return await asyncio.start_server(self._on_connect, sock=self.socket, backlog=1)
+
+    def _on_connect(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._accepted.put_nowait((reader, writer))
+
+    def accept_connection(self, timeout: float = 10.0):
+        try:
+            reader, writer = self.transport.submit(asyncio.wait_for(self._accepted.get(), timeout)).result()
+        except (asyncio.TimeoutError, concurrent.futures.TimeoutError):
+            raise socket.timeout("timed out waiting for the robot to connect")
+        if self.conn is not None:
+            self.transport.call_soon(self.conn.close)
+        self._reader, self.conn = reader, writer
+        self._failed = False
+        addr = writer.get_extra_info('peername')
+        print(f"Connection accepted from {addr}")
+        return addr
+
+    def exit(self):
+        if self.conn is not None:
+            self.transport.call_soon(self.conn.close)
+        if self._server is not None:
+            self.transport.call_soon(self._server.close)
+        else:
+            self.socket.close()
+
+    def for_connection(self) -> 'AsyncControlHandler':
+        """This handler fixed to the current connection: its reads stay on that
+        connection after a later accept_connection moves this one on."""
+        return copy.copy(self)
+
+    def shutdown(self):
+        """Close the current connection, ending any read waiting on it."""
+        if self.conn is not None:
+            self.transport.call_soon(self.conn.close)
+
+    @property
+    def closed(self) -> bool:
+        """The robot closed the connection (or it failed)."""
+        return self._failed or (self._reader is not None and self._reader.at_eof())
+
+    def send(self, data: bytes):
+        if self.conn is not None:
+            self.transport.call_soon(self.conn.write, data)
+
+    def _wait(self, coro, timeout: float | None):
+        timeout = timeout if timeout is not None else self._timeout
+        return self.transport.submit(asyncio.wait_for(coro, timeout)).result()
+
+    def receive(self, lenght: int) -> bytes | None:
+        """Up to ``lenght`` bytes (b'' at the end of the stream), or None if none came within set_timeout."""
+        if self._reader is None:
+            return None
+        try:
+            return self._wait(self._reader.read(lenght), None)
+        except (asyncio.TimeoutError, concurrent.futures.TimeoutError):
+            return None
+        except Exception:
+            self._failed = True
+            return None
+
+    def set_timeout(self, timeout_sec: float | None):
+        self._timeout = timeout_sec
+
+    def receive_line(self, max_len: int = 4096, timeout: float | None = None) -> bytes | None:
+        if self._reader is None:
+            return None
+        try:
+            line = self._wait(self._reader.readline(), timeout)
+        except (asyncio.TimeoutError, concurrent.futures.TimeoutError):
+            return None
+        except Exception:
+            self._failed = True
+            return None
+        return line if line else None
+
+    def receive_exact(self, nbytes: int, timeout: float | None = None) -> bytes | None:
+        if self._reader is None:
+            return None
+        try:
+            return self._wait(self._reader.readexactly(nbytes), timeout)
+        except (asyncio.TimeoutError, concurrent.futures.TimeoutError):
+            return None
+        except Exception:
+            self._failed = True
+            return None
+
+
+class _CaptureProtocol(asyncio.DatagramProtocol):
+    def __init__(self, capture: 'AsyncUDPHandler'):
+        self.capture = capture
+
+    def datagram_received(self, data, addr):
+        self.capture._datagram_received(data, addr)
+
+    def error_received(self, exc):
+        pass    # ICMP errors for NACKs sent to a robot that went away
+
+
+class AsyncUDPHandler(UDPCapture):
+    """
+    UDPCapture on the transport loop, in place of UDPSocketHandler's
+    thread. Datagrams are handled as they arrive; a single timer is kept
+    armed at the next deadline UDPCapture._next_tick reports.
+    make_video_from_frames runs in the loop's executor, so a session's
+    finalisation never stalls the other connections on the loop.
+    """
+    def __init__(self, transport: TransportLoop, host, port):
+        UDPCapture.__init__(self, host, port)
+        self.transport = transport
+        self._endpoint = None
+        self._timer: asyncio.TimerHandle | None = None
+
+    def start(self):
+        self.transport.start()
+        self.socket.setblocking(False)
+        self._endpoint = self.transport.submit(self._open()).result()
+        self.running = True
+
+    async def _open(self):
+        endpoint, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+            lambda: _CaptureProtocol(self), sock=self.socket)
+        return endpoint
+
+    def is_alive(self) -> bool:
+        return self.running
+
+    def join(self, timeout: float | None = None):
+        pass
+
+    def exit(self):
+        self.listening = False
+        self.running = False
+        self.transport.call_soon(self._close)
+
+    def _close(self):
+        self._arm(None)
+        if self._endpoint is not None:
+            self._endpoint.close()
+        else:
+            self.socket.close()
+
+    def _state_changed(self):
+        # Set from SocketManager's thread: re-check on the loop (countdown, audio, finalisation)
+        if self.running and not self.transport.in_loop():
+            self.transport.call_soon(self._service)
+
+    def _datagram_received(self, data, addr):
+        self._apply_reset()
+        if not self.listening:
+            return
+        now = time.time()
+        self._on_datagram(data, addr, now)
+        self._service(now)
+
+    def _service(self, now: float | None = None):
+        now = time.time() if now is None else now
+        self._apply_reset()
+        if not (self.running and self.listening):
+            self._arm(None)
+            return
+        self._tick(now)
+        if self._needs_data():
+            self._arm(self._next_tick(now))
+            return
+        self._arm(None)
+        frames, patient_id, audio_bytes, rate_changes = self._finalize(now)
+        made = self.transport.loop.run_in_executor(None, make_video_from_frames, frames, patient_id, audio_bytes,
+                                                   self.mux_audio, rate_changes)
+        made.add_done_callback(functools.partial(self._video_made, frames))
+
+    def _video_made(self, frames, future):
+        # On the loop, like every acquire from the frame pool
+        self._release_frames(frames)
+        if future.exception() is not None:
+            print(f"Making the video failed: {future.exception()}")
+
+    def _arm(self, delay: float | None):
+        if delay is None:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            return
+        when = self.transport.loop.time() + delay
+        if self._timer is not None:
+            if self._timer.when() <= when:
+                return
+            self._timer.cancel()
+        self._timer = self.transport.loop.call_at(when, self._on_timer)
+
+    def _on_timer(self):
+        self._timer = None
+        self._service()
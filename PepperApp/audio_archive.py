@@ -0,0 +1,55 @@
+import argparse
+import struct
+import wave
+import numpy as np
+
+# Must match PepperCameraService/audio_archive.py
+ARCHIVE_HEADER = struct.Struct('!4sIH2x')   # magic, sample rate, channels
+ARCHIVE_MAGIC = b'PMC0'
+# One conversion chunk: 10 s of 48 kHz audio, so memory stays flat whatever the session length
+CHUNK_FRAMES = 48000 * 10
+
+
+def open_archive(path: str) -> tuple[int, int, np.memmap]:
+    """(sample rate, channels, read-only frames x channels int16 memmap) of a .pmc archive."""
+    with open(path, 'rb') as f:
+        magic, sample_rate, channels = ARCHIVE_HEADER.unpack(f.read(ARCHIVE_HEADER.size))
+    if magic != ARCHIVE_MAGIC:
+        raise ValueError(f"Not a multichannel audio archive: {path}")
+    data = np.memmap(path, dtype='<i2', mode='r', offset=ARCHIVE_HEADER.size)
+    # A session cut off mid-buffer may end on a partial frame
+    frames = len(data) // channels
+    return sample_rate, channels, data[:frames * channels].reshape(frames, channels)
+
+
+def iter_chunks(samples: np.ndarray, mono: bool = False, chunk_frames: int = CHUNK_FRAMES):
+    """Yield int16 chunks of the archive, interleaved or mixed down to mono like the robot does."""
+    for start in range(0, len(samples), chunk_frames):
+        chunk = samples[start:start + chunk_frames]
+        if mono:
+            # Same integer mean as SoundReceiverModule, so the mixdown matches the muxed audio
+            yield (chunk.sum(axis=1, dtype=np.int32) // chunk.shape[1]).astype('<i2')
+        else:
+            yield np.ascontiguousarray(chunk)
+
+
+def archive_to_wav(path: str, wav_path: str, mono: bool = False, chunk_frames: int = CHUNK_FRAMES) -> int:
+    """Write the archive as a multichannel (or mono) WAV in chunks. Returns frames written."""
+    sample_rate, channels, samples = open_archive(path)
+    with wave.open(wav_path, 'wb') as wav:
+        wav.setnchannels(1 if mono else channels)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        for chunk in iter_chunks(samples, mono, chunk_frames):
+            wav.writeframes(chunk.tobytes())
+    return len(samples)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert a multichannel audio archive (.pmc) to WAV')
+    parser.add_argument('archive', help='audio_<session>.pmc received from the robot')
+    parser.add_argument('wav', help='Output WAV path')
+    parser.add_argument('--mono', action='store_true', help='Mix down to mono instead of keeping every channel')
+    args = parser.parse_args()
+    frames = archive_to_wav(args.archive, args.wav, args.mono)
+    print(f"Wrote {frames} frames to {args.wav}")
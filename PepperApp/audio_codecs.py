@@ -0,0 +1,118 @@
+import io
+import struct
+import subprocess
+import wave
+import numpy as np
+
+# Must match PepperCameraService/audio_codecs.py
+ADPCM_MAGIC = b'IMA0'
+_ADPCM_HEADER = struct.Struct('!4sIBI')     # magic, sample rate, channels, samples per channel
+_ADPCM_BLOCK_HEADER = struct.Struct('!hB')  # first sample (exact), step index
+ADPCM_BLOCK_SAMPLES = 4096
+
+# Audio codecs the operator can decode
+DECODABLE_AUDIO_CODECS = ('wav', 'flac', 'adpcm')
+
+_IMA_INDEX_TABLE = [-1, -1, -1, -1, 2, 4, 6, 8] * 2
+_IMA_STEP_TABLE = [
+    7, 8, 9, 10, 11, 12, 13, 14, 16, 17, 19, 21, 23, 25, 28, 31, 34, 37, 41, 45,
+    50, 55, 60, 66, 73, 80, 88, 97, 107, 118, 130, 143, 157, 173, 190, 209, 230,
+    253, 279, 307, 337, 371, 408, 449, 494, 544, 598, 658, 724, 796, 876, 963,
+    1060, 1166, 1282, 1411, 1552, 1707, 1878, 2066, 2272, 2499, 2749, 3024, 3327,
+    3660, 4026, 4428, 4871, 5358, 5894, 6484, 7132, 7845, 8630, 9493, 10442,
+    11487, 12635, 13899, 15289, 16818, 18500, 20350, 22385, 24623, 27086, 29794,
+    32767,
+]
+
+
+def choose_audio_codec(offered: list[str], preferred: str) -> str:
+    """Pick the audio codec for a session; anything not offered or not decodable means WAV."""
+    if preferred in offered and preferred in DECODABLE_AUDIO_CODECS:
+        return preferred
+    return 'wav'
+
+
+def _to_wav(samples: np.ndarray, sample_rate: int, channels: int) -> bytes:
+    buf = io.BytesIO()
+    with wave.open(buf, 'wb') as wav:
+        wav.setnchannels(channels)
+        wav.setsampwidth(2)
+        wav.setframerate(sample_rate)
+        wav.writeframes(samples.astype('<i2').tobytes())
+    return buf.getvalue()
+
+
+def _ima_decode_block(first: int, index: int, nibbles, count: int, out: np.ndarray):
+    predictor = first
+    out[0] = predictor
+    for i in range(1, count):
+        nibble = nibbles[i - 1]
+        step = _IMA_STEP_TABLE[index]
+        delta = step >> 3
+        if nibble & 4:
+            delta += step
+        if nibble & 2:
+            delta += step >> 1
+        if nibble & 1:
+            delta += step >> 2
+        if nibble & 8:
+            predictor = max(-32768, predictor - delta)
+        else:
+            predictor = min(32767, predictor + delta)
+        index = min(88, max(0, index + _IMA_INDEX_TABLE[nibble]))
+        out[i] = predictor
+
+
+def _decode_adpcm(data: bytes) -> bytes:
+    _, sample_rate, channels, count = _ADPCM_HEADER.unpack_from(data)
+    samples = np.zeros((channels, count), dtype=np.int16)
+    offset = _ADPCM_HEADER.size
+    for start in range(0, count, ADPCM_BLOCK_SAMPLES):
+        block_len = min(ADPCM_BLOCK_SAMPLES, count - start)
+        packed_len = block_len // 2
+        for channel in range(channels):
+            first, index = _ADPCM_BLOCK_HEADER.unpack_from(data, offset)
+            offset += _ADPCM_BLOCK_HEADER.size
+            packed = np.frombuffer(data, dtype=np.uint8, count=packed_len, offset=offset)
+            offset += packed_len
+            nibbles = np.empty(packed_len * 2, dtype=np.uint8)
+            nibbles[0::2] = packed & 0x0F
+            nibbles[1::2] = packed >> 4
+            _ima_decode_block(first, index, nibbles.tolist(), block_len,
+                              samples[channel, start:start + block_len])
+    return _to_wav(samples.T.reshape(-1), sample_rate, channels)
+
+
+def _decode_flac(data: bytes) -> bytes:
+    try:
+        import soundfile
+        samples, sample_rate = soundfile.read(io.BytesIO(data), dtype='int16', always_2d=True)
+        return _to_wav(samples.reshape(-1), sample_rate, samples.shape[1])
+    except (ImportError, OSError):
+        pass
+    # STREAMINFO is always the first metadata block: 20 bits rate, 3 bits channels - 1
+    info = int.from_bytes(data[18:21], 'big')
+    sample_rate, channels = info >> 4, ((info >> 1) & 0x7) + 1
+    # Raw PCM out: a piped WAV from ffmpeg has no valid length fields
+    result = subprocess.run(['ffmpeg', '-loglevel', 'error', '-i', 'pipe:0', '-f', 's16le', '-ac', str(channels), 'pipe:1'],
+                            input=data, capture_output=True, check=True)
+    return _to_wav(np.frombuffer(result.stdout, dtype='<i2'), sample_rate, channels)
+
+
+def decode_audio(audio_bytes: bytes | None) -> bytes | None:
+    """
+    Turn whatever audio the robot sent into WAV bytes. The codec is recognised
+    from the payload, so WAV from older robots passes through untouched.
+    """
+    if not audio_bytes:
+        return audio_bytes
+    magic = bytes(audio_bytes[:4])
+    try:
+        if magic == ADPCM_MAGIC:
+            return _decode_adpcm(audio_bytes)
+        if magic == b'fLaC':
+            return _decode_flac(audio_bytes)
+    except Exception as e:
+        print(f"Audio decode error ({magic!r}): {e}")
+        return None
+    return audio_bytes
@@ -0,0 +1,220 @@
+import socket
+import struct
+import threading
+import time
+import numpy as np
+
+# Must match PepperCameraService/audio_monitor.py
+MONITOR_HEADER = struct.Struct('!4sIQQH')   # magic, seq, capture_us, send_us (robot clock), samples
+MONITOR_MAGIC = b'PMON'
+PING_HEADER = struct.Struct('!4sQ')
+PING_MAGIC = b'PPNG'
+PONG_MAGIC = b'PPON'
+MONITOR_RATE = 16000
+
+
+class JitterBuffer:
+    """
+    Playout buffer for the live monitor. Packets are queued by sequence
+    number; playback starts once ``target_ms`` of audio is buffered. The
+    target follows the RFC 3550 interarrival jitter estimate, and excess
+    audio beyond it is dropped so latency does not creep up. Lost or late
+    packets play as silence. ``push`` also keeps at most twice ``max_ms``
+    queued, so the buffer stays bounded when nothing pulls (no output).
+    """
+    def __init__(self, min_ms: float = 40.0, max_ms: float = 400.0, jitter_multiple: float = 4.0):
+        self.min_ms = min_ms
+        self.max_ms = max_ms
+        self.jitter_multiple = jitter_multiple
+        self.jitter_ms = 0.0
+        self.target_ms = min_ms
+        self._lock = threading.Lock()
+        self._packets: dict[int, tuple[int, np.ndarray]] = {}
+        self._next_seq: int | None = None
+        self._offset = 0            # samples already played from the packet at _next_seq
+        self._buffering = True
+        self._last_transit: float | None = None
+        self.late = 0
+        self.lost = 0
+        self.underruns = 0
+        self.overflowed = 0         # packets dropped unplayed by the bound in push
+
+    def _buffered_samples(self) -> int:
+        return sum(len(samples) for seq, (_, samples) in self._packets.items()
+                   if self._next_seq is None or seq >= self._next_seq) - self._offset
+
+    def push(self, seq: int, capture_us: int, samples: np.ndarray, arrival_s: float):
+        with self._lock:
+            # Interarrival jitter from the transit time (arrival - capture); the clock offset cancels out
+            transit = arrival_s * 1000.0 - capture_us / 1000.0
+            if self._last_transit is not None:
+                self.jitter_ms += (abs(transit - self._last_transit) - self.jitter_ms) / 16.0
+            self._last_transit = transit
+            self.target_ms = min(self.max_ms, max(self.min_ms, self.jitter_multiple * self.jitter_ms + 20.0))
+            if self._next_seq is not None and seq < self._next_seq:
+                self.late += 1
+                return
+            self._packets[seq] = (capture_us, samples)
+            if self._next_seq is None:
+                self._next_seq = seq
+            max_packets = int(2 * self.max_ms * MONITOR_RATE / 1000.0 / max(1, len(samples))) + 1
+            if seq - self._next_seq >= max_packets:
+                oldest = seq - max_packets + 1
+                for old in [old for old in self._packets if old < oldest]:
+                    del self._packets[old]
+                    self.overflowed += 1
+                self._next_seq = oldest
+                self._offset = 0
+
+    def pull(self, count: int) -> tuple[np.ndarray, int | None]:
+        """``count`` samples to play, and the robot capture time (us) of the first real one, if any."""
+        out = np.zeros(count, dtype=np.int16)
+        with self._lock:
+            buffered_ms = self._buffered_samples() * 1000.0 / MONITOR_RATE
+            if self._buffering:
+                if self._next_seq is None or buffered_ms < self.target_ms:
+                    return out, None
+                self._buffering = False
+            elif buffered_ms > self.target_ms + 100.0:
+                # Far behind: skip ahead to the target instead of playing ever later
+                self._skip(int((buffered_ms - self.target_ms) * MONITOR_RATE / 1000.0))
+            first_capture = None
+            filled = 0
+            while filled < count:
+                packet = self._packets.get(self._next_seq)
+                if packet is None:
+                    if not any(seq > self._next_seq for seq in self._packets):
+                        # Nothing newer has arrived: an underrun, not a loss
+                        self.underruns += 1
+                        self._buffering = True
+                        break
+                    self.lost += 1
+                    self._next_seq += 1
+                    self._offset = 0
+                    continue
+                capture_us, samples = packet
+                take = min(count - filled, len(samples) - self._offset)
+                if first_capture is None:
+                    first_capture = capture_us + self._offset * 1000000 // MONITOR_RATE
+                out[filled:filled + take] = samples[self._offset:self._offset + take]
+                filled += take
+                self._offset += take
+                if self._offset >= len(samples):
+                    del self._packets[self._next_seq]
+                    self._next_seq += 1
+                    self._offset = 0
+            return out, first_capture
+
+    def _skip(self, count: int):
+        while count > 0 and self._next_seq in self._packets:
+            _, samples = self._packets[self._next_seq]
+            take = min(count, len(samples) - self._offset)
+            count -= take
+            self._offset += take
+            if self._offset >= len(samples):
+                del self._packets[self._next_seq]
+                self._next_seq += 1
+                self._offset = 0
+
+
+class AudioMonitorReceiver(threading.Thread):
+    """
+    Receives the robot's live monitor audio (--monitor_audio) and plays it
+    through a JitterBuffer with sounddevice, when installed. Clock probes to
+    the robot give the robot-to-local clock offset (NTP style, best of the
+    lowest round trips), so ``latency_ms`` is true mouth-to-ear latency:
+    robot capture to the sample leaving the sound card.
+    """
+    def __init__(self, host, port, block_ms: int = 10):
+        threading.Thread.__init__(self, daemon=True)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((host, port))
+        self.socket.settimeout(0.5)
+        self.buffer = JitterBuffer()
+        self.block_samples = MONITOR_RATE * block_ms // 1000
+        self.running = False
+        self.robot_addr = None
+        self.clock_offset_us: float | None = None   # robot clock minus local clock
+        self.rtt_ms: float | None = None
+        self.latency_ms: float | None = None
+        self.packets = 0
+        self._stream = None
+
+    def run(self):
+        self.running = True
+        last_ping = 0.0
+        while self.running:
+            try:
+                data, addr = self.socket.recvfrom(2048)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            now = time.time()
+            magic = data[:4]
+            if magic == MONITOR_MAGIC and len(data) >= MONITOR_HEADER.size:
+                _, seq, capture_us, _, count = MONITOR_HEADER.unpack_from(data)
+                samples = np.frombuffer(data, dtype='<i2', count=count, offset=MONITOR_HEADER.size)
+                self.buffer.push(seq, capture_us, samples, now)
+                self.packets += 1
+                if self.robot_addr is None:
+                    self.robot_addr = addr
+                    self._open_output()
+            elif magic == PONG_MAGIC and len(data) == PING_HEADER.size + 8:
+                self._on_pong(data, now)
+            if self.robot_addr is not None and now - last_ping > 1.0:
+                self.socket.sendto(PING_HEADER.pack(PING_MAGIC, int(now * 1e6)), self.robot_addr)
+                last_ping = now
+
+    def _on_pong(self, data: bytes, now: float):
+        _, sent_us = PING_HEADER.unpack_from(data, 0)
+        robot_us = struct.unpack_from('!Q', data, PING_HEADER.size)[0]
+        rtt_us = now * 1e6 - sent_us
+        if self.rtt_ms is None or rtt_us / 1000.0 <= self.rtt_ms * 1.5:
+            # Only trust low round trips: queueing delay makes the midpoint estimate one-sided
+            self.clock_offset_us = robot_us - (sent_us + now * 1e6) / 2.0
+        self.rtt_ms = rtt_us / 1000.0 if self.rtt_ms is None else min(self.rtt_ms * 1.05, rtt_us / 1000.0)
+
+    def _open_output(self):
+        try:
+            import sounddevice
+        except ImportError:
+            print("Audio monitor: install sounddevice to listen; receiving without playback.")
+            return
+        try:
+            self._stream = sounddevice.OutputStream(samplerate=MONITOR_RATE, channels=1, dtype='int16',
+                                                    blocksize=self.block_samples, latency='low',
+                                                    callback=self._play)
+            self._stream.start()
+            print(f"Audio monitor: playing from {self.robot_addr[0]}")
+        except Exception as e:
+            print(f"Audio monitor: cannot open audio output: {e}")
+            self._stream = None
+
+    def _play(self, outdata, frames, time_info, status):
+        samples, capture_us = self.buffer.pull(frames)
+        outdata[:, 0] = samples
+        if capture_us is None or self.clock_offset_us is None:
+            return
+        # The first sample of this block leaves the sound card after the device's output latency
+        ear_us = time.time() * 1e6 + self._stream.latency * 1e6
+        latency_ms = (ear_us - (capture_us - self.clock_offset_us)) / 1000.0
+        self.latency_ms = latency_ms if self.latency_ms is None else 0.9 * self.latency_ms + 0.1 * latency_ms
+
+    def status_text(self) -> str:
+        if not self.packets:
+            return "Audio monitor: off"
+        latency = f"{self.latency_ms:.0f} ms" if self.latency_ms is not None else "measuring"
+        return (f"Audio monitor: {latency} mouth-to-ear, buffer {self.buffer.target_ms:.0f} ms, "
+                f"jitter {self.buffer.jitter_ms:.1f} ms, lost {self.buffer.lost}")
+
+    def exit(self):
+        self.running = False
+        if self._stream is not None:
+            try:
+                self._stream.stop()
+                self._stream.close()
+            except Exception:
+                pass
+        self.socket.close()
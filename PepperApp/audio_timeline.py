@@ -0,0 +1,72 @@
+import struct
+import numpy as np
+
+# Must match PepperCameraService/audio_timeline.py
+TRAILER_ENTRY = struct.Struct('!QQ')      # two unsigned values per entry, see the magics
+TRAILER_FOOTER = struct.Struct('!4sI')    # magic, entry count
+TIMELINE_MAGIC = b'PTIM'   # (mono sample offset, NAOqi capture timestamp us)
+SEGMENTS_MAGIC = b'PVAD'   # (start sample, end sample) of each voice activity segment
+
+
+def pack_trailer(magic: bytes, entries: list[tuple[int, int]]) -> bytes:
+    parts = [TRAILER_ENTRY.pack(first, second) for first, second in entries]
+    parts.append(TRAILER_FOOTER.pack(magic, len(entries)))
+    return b''.join(parts)
+
+
+def pack_timeline(entries: list[tuple[int, int]]) -> bytes:
+    return pack_trailer(TIMELINE_MAGIC, entries)
+
+
+def split_trailer(audio_bytes: bytes | None, magic: bytes) -> tuple[bytes | None, list[tuple[int, int]] | None]:
+    """Strip a ``magic`` trailer from the end of the payload: (the rest, its entries or None)."""
+    if not audio_bytes or len(audio_bytes) < TRAILER_FOOTER.size:
+        return audio_bytes, None
+    found, count = TRAILER_FOOTER.unpack(bytes(audio_bytes[-TRAILER_FOOTER.size:]))
+    length = count * TRAILER_ENTRY.size + TRAILER_FOOTER.size
+    if found != magic or length > len(audio_bytes):
+        return audio_bytes, None
+    start = len(audio_bytes) - length
+    entries = [TRAILER_ENTRY.unpack_from(audio_bytes, start + i * TRAILER_ENTRY.size) for i in range(count)]
+    return audio_bytes[:start], entries
+
+
+def split_timeline(audio_bytes: bytes | None) -> tuple[bytes | None, list[tuple[int, int]] | None]:
+    """Strip the robot's audio timeline trailer: (audio payload, [(sample offset, ts_us), ...] or None)."""
+    return split_trailer(audio_bytes, TIMELINE_MAGIC)
+
+
+def split_segments(audio_bytes: bytes | None) -> tuple[bytes | None, list[tuple[int, int]] | None]:
+    """Strip the robot's voice activity trailer: (audio payload, [(start, end sample), ...] or None).
+    It sits under the timeline, so split that first."""
+    return split_trailer(audio_bytes, SEGMENTS_MAGIC)
+
+
+class AudioClock:
+    """
+    Maps robot capture timestamps onto the recording's audio sample clock,
+    from a least-squares fit of the timeline (sample offset -> robot time).
+    The slope against the nominal sample period is the clock drift.
+    """
+    def __init__(self, entries: list[tuple[int, int]], sample_rate: int):
+        self.sample_rate = sample_rate
+        nominal = 1e6 / sample_rate
+        offsets = np.array([entry[0] for entry in entries], dtype=np.float64)
+        stamps = np.array([entry[1] for entry in entries], dtype=np.float64)
+        self._base_us = stamps[0]
+        if len(entries) >= 2 and offsets[-1] > offsets[0]:
+            slope, intercept = np.polyfit(offsets, stamps - self._base_us, 1)
+            residuals = stamps - self._base_us - (intercept + slope * offsets)
+            self.jitter_ms = float(np.abs(residuals).max()) / 1000.0
+        else:
+            slope, intercept = nominal, -offsets[0] * nominal
+            self.jitter_ms = 0.0
+        self.us_per_sample = float(slope)
+        self.start_us = self._base_us + float(intercept)
+        # Positive: fewer samples per robot minute than nominal, so audio played at the
+        # nominal rate runs ahead of the video by this much per minute
+        self.drift_ms_per_minute = (self.us_per_sample / nominal - 1.0) * 60000.0
+
+    def audio_seconds(self, ts_us: int) -> float:
+        """Position of a robot timestamp in the audio, in seconds of audio (may be negative)."""
+        return (ts_us - self.start_us) / self.us_per_sample / self.sample_rate
@@ -0,0 +1,161 @@
+import json
+import queue
+import threading
+import time
+
+# Must match PepperCameraService/control_protocol.py
+CONTROL_OPTION = 'control=json'     # appended to the 'codec' reply to opt in
+CONTROL_ACCEPT = b'CONTROL:json'    # the robot's answer; JSON-lines requests from then on
+READ_TIMEOUT = 60.0                 # reader wake-up while the robot is quiet
+
+
+def pack_message(message: dict) -> bytes:
+    return (json.dumps(message, separators=(',', ':')) + '\n').encode('utf-8')
+
+
+class ControlStats:
+    """Latency of the framed control requests: round trip to the robot's 'received'
+    acknowledgement and the robot-side execution time from its 'done'. The robot
+    acks a request as soon as it reads it and runs requests one at a time, so
+    a pipelined request's send-to-done time includes the ones queued before it."""
+    def __init__(self):
+        self.sent = 0
+        self.completed = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.rtt_ms: float | None = None            # last round trip
+        self.rtt_avg_ms: float | None = None        # exponentially weighted
+        self.exec_ms: float | None = None           # last execution time on the robot
+        self.total_ms: float | None = None          # last send-to-done time
+        self.clock_offset_ms: float | None = None   # robot wall clock minus ours, at mid round trip
+
+    def record_rtt(self, rtt_ms: float):
+        self.rtt_ms = rtt_ms
+        self.rtt_avg_ms = rtt_ms if self.rtt_avg_ms is None else self.rtt_avg_ms + (rtt_ms - self.rtt_avg_ms) * 0.2
+
+    def status_text(self) -> str:
+        if self.rtt_ms is None:
+            return "Control: no replies yet"
+        text = f"Control: RTT {self.rtt_ms:.0f} ms (avg {self.rtt_avg_ms:.0f})"
+        if self.exec_ms is not None:
+            text += f", exec {self.exec_ms:.0f} ms"
+        if self.in_flight:
+            text += f", {self.in_flight} in flight"
+        if self.errors:
+            text += f", {self.errors} failed"
+        return text
+
+
+class ControlClient(threading.Thread):
+    """
+    Pipelined control requests over a connection negotiated to JSON lines.
+    Requests go out without waiting; replies are matched by request id.
+
+    Owns the reads on the TCP connection: its thread reads every line,
+    hands replies ('{' lines) to their requests, and queues the rest
+    (frame count, AUDIO_*, RATE_CHANGES:, SPOOL: lines; an AUDIO_LEN or
+    RATE_CHANGES payload is read right after its header) for SocketManager.stop, which reads them
+    through receive_line / receive_exact as it would from the handler.
+
+    ``tcp_socket`` is fixed to one connection (the handler's
+    for_connection()), so after a reconnect this thread cannot read the
+    new robot's lines; exit() shuts that connection down and joins.
+    """
+    def __init__(self, tcp_socket):
+        threading.Thread.__init__(self, daemon=True)
+        self.tcp_socket = tcp_socket
+        self.stats = ControlStats()
+        self.running = False
+        self._next_id = 1
+        # request id -> [command, sent at (monotonic, for round trips), sent at (wall clock, for the offset)]
+        self._pending: dict[int, list] = {}
+        self._lock = threading.Lock()
+        self._lines: queue.Queue = queue.Queue()
+        self._payload: bytes | None = None
+
+    def send(self, command: str, text: str | None = None) -> int:
+        """Send a request; returns its id."""
+        with self._lock:
+            request_id = self._next_id
+            self._next_id += 1
+            self._pending[request_id] = [command, time.monotonic(), time.time()]
+            self.stats.sent += 1
+            self.stats.in_flight = len(self._pending)
+        message = {'id': request_id, 'cmd': command}
+        if text is not None:
+            message['text'] = text
+        self.tcp_socket.send(pack_message(message))
+        return request_id
+
+    def run(self):
+        self.running = True
+        while self.running:
+            line = self.tcp_socket.receive_line(max_len=64 * 1024, timeout=READ_TIMEOUT)
+            if line is None:
+                if self.running and self.tcp_socket.closed:
+                    print("Control connection closed")
+                    break
+                continue
+            if line.startswith(b"{"):
+                self._handle_reply(line)
+                continue
+            payload = None
+            if line.startswith((b"AUDIO_LEN:", b"RATE_CHANGES:")):
+                try:
+                    n = int(line.split(b":", 1)[1])
+                except ValueError:
+                    n = -1
+                if 0 <= n <= 64 * 1024 * 1024:
+                    payload = self.tcp_socket.receive_exact(n, timeout=max(10.0, n / (64 * 1024.0)))
+            self._lines.put((line, payload))
+        self.running = False
+
+    def _handle_reply(self, line: bytes):
+        now = time.monotonic()
+        try:
+            reply = json.loads(line)
+            request_id = reply['id']
+            ack = reply['ack']
+        except (ValueError, KeyError, TypeError):
+            print(f"Malformed control reply: {line[:80]!r}")
+            return
+        with self._lock:
+            pending = self._pending.get(request_id)
+            if pending is None:
+                return
+            command, sent, sent_wall = pending
+            if ack == 'received':
+                rtt = now - sent
+                self.stats.record_rtt(rtt * 1000.0)
+                if 'ts' in reply:
+                    # The robot's ts is wall clock, so the midpoint has to be too
+                    self.stats.clock_offset_ms = (reply['ts'] - (sent_wall + rtt / 2)) * 1000.0
+                return
+            del self._pending[request_id]
+            self.stats.in_flight = len(self._pending)
+            self.stats.exec_ms = reply.get('exec_ms')
+            self.stats.total_ms = (now - sent) * 1000.0
+            if ack == 'error':
+                self.stats.errors += 1
+                print(f"Command {command} failed on the robot: {reply.get('error')}")
+            else:
+                self.stats.completed += 1
+
+    def receive_line(self, max_len: int = 4096, timeout: float | None = None) -> bytes | None:
+        try:
+            line, self._payload = self._lines.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        return line
+
+    def receive_exact(self, nbytes: int, timeout: float | None = None) -> bytes | None:
+        # AUDIO_LEN payloads are read with their header line
+        payload, self._payload = self._payload, None
+        return payload if payload is not None and len(payload) == nbytes else None
+
+    def exit(self):
+        self.running = False
+        # Wakes the read this thread is blocked in; the connection is being left anyway
+        self.tcp_socket.shutdown()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join(timeout=2.0)
@@ -0,0 +1,174 @@
+import struct
+import zlib
+import cv2
+import numpy as np
+
+# Must match the encoders in PepperCameraService/frame_compresser.py
+RAW_MAGIC = b'RAW0'
+DELTA_MAGIC = b'DLT1'
+LEGACY_DELTA_MAGIC = b'DLT0'  # robots before reference numbers
+# Static-scene keep-alive: "repeat the previous frame at this timestamp"
+REPEAT_PAYLOAD = b'REP0'
+# Inter-frame H.264: payload is an access unit number, the number of its first picture and
+# whole pictures' Annex B NAL units; remuxed, never decoded per frame
+H264_MAGIC = b'AVC2'
+AVC1_MAGIC = b'AVC1'         # robots before picture numbers: access unit number only
+LEGACY_H264_MAGIC = b'H264'  # robots before access unit numbers: NAL units only
+_H264_HEADER = struct.Struct('!4sII')      # magic, access unit seq, first picture
+_AVC1_HEADER = struct.Struct('!4sI')       # magic, access unit seq
+_RAW_HEADER = struct.Struct('!4sHHB')      # magic, width, height, channels
+_DELTA_HEADER = struct.Struct('!4sHHBBII') # magic, width, height, channels, keyframe, frame seq, reference seq
+_LEGACY_DELTA_HEADER = struct.Struct('!4sHHBB')
+
+# Backends the operator can decode, in order of preference
+DECODABLE_ENCODERS = ('jpeg', 'turbojpeg', 'delta', 'png', 'raw', 'h264')
+DEPTH_DISPLAY_MAX_MM = 8000
+
+
+def h264_access_unit(frame_data) -> tuple[int | None, int | None, bytes] | None:
+    """(access unit seq, first picture number, NAL units) of an H.264 payload, the numbers
+    None where older robots did not send them, or None for a payload of any other backend."""
+    magic = bytes(frame_data[:4])
+    if magic == H264_MAGIC and len(frame_data) >= _H264_HEADER.size:
+        _, seq, first_picture = _H264_HEADER.unpack_from(frame_data)
+        return seq, first_picture, bytes(frame_data[_H264_HEADER.size:])
+    if magic == AVC1_MAGIC and len(frame_data) >= _AVC1_HEADER.size:
+        _, seq = _AVC1_HEADER.unpack_from(frame_data)
+        return seq, None, bytes(frame_data[_AVC1_HEADER.size:])
+    if magic == LEGACY_H264_MAGIC:
+        return None, None, bytes(frame_data[len(LEGACY_H264_MAGIC):])
+    return None
+
+
+def h264_picture_starts(nal_units: bytes) -> list[int]:
+    """
+    Offsets in Annex B ``nal_units`` where a picture begins: at the SEI, SPS,
+    PPS or access unit delimiter ahead of its first slice, or at that slice
+    (first_mb_in_slice 0, a leading 1 bit). Must match the robot's frame_compresser.py.
+    """
+    starts = []
+    prefix = None       # first non-slice NAL unit since the last slice
+    pos = nal_units.find(b'\x00\x00\x01')
+    while 0 <= pos < len(nal_units) - 3:
+        begin = pos - 1 if pos > 0 and nal_units[pos - 1] == 0 else pos
+        nal_type = nal_units[pos + 3] & 0x1F
+        if nal_type in (6, 7, 8, 9):
+            if prefix is None:
+                prefix = begin
+        elif nal_type in (1, 5):
+            if pos + 4 < len(nal_units) and nal_units[pos + 4] & 0x80:
+                starts.append(prefix if prefix is not None else begin)
+            prefix = None
+        pos = nal_units.find(b'\x00\x00\x01', pos + 3)
+    return starts
+
+
+def h264_has_idr(nal_units: bytes) -> bool:
+    """Whether Annex B ``nal_units`` hold an IDR slice (NAL type 5), where decoding can resume."""
+    start = nal_units.find(b'\x00\x00\x01')
+    while 0 <= start < len(nal_units) - 3:
+        if nal_units[start + 3] & 0x1F == 5:
+            return True
+        start = nal_units.find(b'\x00\x00\x01', start + 3)
+    return False
+
+
+def choose_encoder(offered: list[str], preferred: str) -> str:
+    """Pick the frame encoder for a session from what the robot offers."""
+    if preferred in offered and preferred in DECODABLE_ENCODERS:
+        return preferred
+    for name in DECODABLE_ENCODERS:
+        if name in offered:
+            return name
+    return 'jpeg'
+
+
+class FrameDecoder:
+    """
+    Decodes frame payloads of any backend into BGR uint8 images. The format
+    is recognised from the payload; keep one instance per stream because the
+    delta codec depends on the previous frame.
+    """
+    def __init__(self):
+        self._previous = None
+        self._previous_seq = None
+        self._last_image = None
+
+    def decode(self, frame_data, idx):
+        if frame_data == REPEAT_PAYLOAD:
+            # Expanded into a real frame: the last image decoded on this stream
+            return self._last_image
+        image = self._decode(frame_data, idx)
+        if image is not None:
+            self._last_image = image
+        return image
+
+    def _decode(self, frame_data, idx):
+        # Skip empty or obviously invalid buffers to avoid OpenCV assertion
+        if not frame_data or len(frame_data) < 16:
+            print(f"Skipping frame {idx}: empty or too small buffer ({0 if not frame_data else len(frame_data)} bytes)")
+            return None
+        magic = bytes(frame_data[:4])
+        try:
+            if magic == RAW_MAGIC:
+                return self._decode_raw(frame_data)
+            if magic in (DELTA_MAGIC, LEGACY_DELTA_MAGIC):
+                return self._decode_delta(frame_data, idx)
+            if magic in (H264_MAGIC, AVC1_MAGIC, LEGACY_H264_MAGIC):
+                print(f"Skipping frame {idx}: H.264 payloads are remuxed, not decoded per frame")
+                return None
+            image = self._decode_image(frame_data, idx)
+        except Exception as e:
+            print(f"Skipping frame {idx}: decode error: {e}")
+            return None
+        return image
+
+    def _decode_raw(self, frame_data):
+        _, width, height, channels = _RAW_HEADER.unpack_from(frame_data)
+        body = np.frombuffer(frame_data, dtype=np.uint8, offset=_RAW_HEADER.size)
+        return body.reshape((height, width, channels))
+
+    def _decode_delta(self, frame_data, idx):
+        if bytes(frame_data[:4]) == DELTA_MAGIC:
+            header = _DELTA_HEADER
+            _, width, height, channels, keyframe, seq, reference = header.unpack_from(frame_data)
+        else:
+            header = _LEGACY_DELTA_HEADER
+            _, width, height, channels, keyframe = header.unpack_from(frame_data)
+            seq = reference = None
+        if not keyframe and reference != self._previous_seq:
+            # Lost over UDP: the frame this delta was encoded against, or one before it.
+            # Adding it to anything else corrupts every frame up to the next keyframe.
+            print(f"Skipping frame {idx}: delta against frame {reference}, last decoded {self._previous_seq}")
+            return None
+        body = np.frombuffer(zlib.decompress(bytes(frame_data[header.size:])), dtype=np.uint8)
+        body = body.reshape((height, width, channels))
+        if keyframe:
+            image = body.copy()
+        elif self._previous is None or self._previous.shape != body.shape:
+            print(f"Skipping frame {idx}: delta frame without a keyframe")
+            return None
+        else:
+            # uint8 addition wraps modulo 256, undoing the encoder's subtraction
+            image = self._previous + body
+        self._previous = image
+        self._previous_seq = seq
+        return image
+
+    def _decode_image(self, frame_data, idx):
+        np_data = np.frombuffer(frame_data, dtype=np.uint8)
+        image = cv2.imdecode(np_data, cv2.IMREAD_UNCHANGED)
+        if image is None:
+            print(f"Skipping frame {idx}: decode returned None")
+            return None
+        if image.dtype == np.uint16:
+            # Depth stream (millimetres): scale into 8 bits for display
+            image = cv2.convertScaleAbs(image, alpha=255.0 / DEPTH_DISPLAY_MAX_MM)
+        # Ensure 3 channels BGR
+        if len(image.shape) == 2:
+            image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+        elif image.shape[2] == 1:
+            image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+        elif image.shape[2] == 4:
+            image = cv2.cvtColor(image, cv2.COLOR_BGRA2BGR)
+        return image
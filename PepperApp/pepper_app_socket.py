@@ -1,13 +1,20 @@
+import copy
 import socket
 import threading
 from video_maker_old import make_video_from_frames
 import time
 import os
 import struct
+import wave
+from audio_timeline import pack_timeline
+from video_datagrams import FramePool, FrameReassembler, parse_chunk, pack_nacks, MAX_DATAGRAM
+from socket_reader import ReadStats, SocketReader
 
 class TCPSocketHandler:
     """
-    Responsible for sending commands to Pepper camera service
+    Responsible for sending commands to Pepper camera service.
+    Reads go through a SocketReader, so lines and the payloads behind
+    them come out of block-sized recv calls (see ``read_stats``).
     """
     def __init__(self, host, port):
         self.host = host
@@ -15,6 +22,8 @@ class TCPSocketHandler:
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.socket.bind((self.host, self.port))
+        self.conn: socket.socket | None = None
+        self.reader: SocketReader | None = None
 
     def start(self) -> None | tuple[str, int]:
         self.socket.listen(1)
@@ -22,77 +31,83 @@ class TCPSocketHandler:
 
     def accept_connection(self):
         self.conn, addr = self.socket.accept()
+        self.reader = SocketReader(self.conn)
         print(f"Connection accepted from {addr}")
         return addr
 
     def exit(self):
         self.socket.close()
-        if hasattr(self, "conn"):
+        if self.conn is not None:
             self.conn.close()
 
+    def for_connection(self) -> 'TCPSocketHandler':
+        """This handler fixed to the current connection: its reads stay on that
+        connection after a later accept_connection moves this one on."""
+        return copy.copy(self)
+
+    def shutdown(self):
+        """Shut the current connection down, waking any read blocked on it."""
+        if self.conn is not None:
+            try:
+                self.conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    @property
+    def closed(self) -> bool:
+        """The robot closed the connection (or it failed)."""
+        return self.reader is not None and self.reader.closed
+
+    @property
+    def read_stats(self) -> ReadStats | None:
+        return self.reader.stats if self.reader is not None else None
+
     def send(self, data: bytes):
-        if hasattr(self, "conn"):
+        if self.conn is not None:
             self.conn.sendall(data)
     
     def receive(self, lenght: int):
-        if hasattr(self, "conn"):
-            return self.conn.recv(lenght)
+        if self.reader is not None:
+            return self.reader.read_some(lenght)
 
     def set_timeout(self, timeout_sec: float | None):
-        if hasattr(self, "conn"):
+        if self.conn is not None:
             try:
                 self.conn.settimeout(timeout_sec if timeout_sec is not None else 0.0)
             except Exception:
                 pass
 
     def receive_line(self, max_len: int = 4096, timeout: float | None = None) -> bytes | None:
-        if not hasattr(self, "conn"):
+        if self.reader is None:
             return None
         try:
-            if timeout is not None:
-                self.conn.settimeout(timeout)
-            buf = bytearray()
-            while len(buf) < max_len:
-                ch = self.conn.recv(1)
-                if not ch:
-                    break
-                buf += ch
-                if ch == b"\n":
-                    break
-            return bytes(buf) if buf else None
-        except socket.timeout:
-            return None
+            return self.reader.read_line(max_len, timeout)
         except Exception:
             return None
 
     def receive_exact(self, nbytes: int, timeout: float | None = None) -> bytes | None:
-        if not hasattr(self, "conn"):
+        if self.reader is None:
             return None
         try:
-            if timeout is not None:
-                self.conn.settimeout(timeout)
-            chunks = []
-            total = 0
-            while total < nbytes:
-                chunk = self.conn.recv(min(65536, nbytes - total))
-                if not chunk:
-                    break
-                chunks.append(chunk)
-                total += len(chunk)
-            return b"".join(chunks) if total == nbytes else None
-        except socket.timeout:
-            return None
+            return self.reader.read_exact(nbytes, timeout)
         except Exception:
             return None
 
-    
 
-class UDPSocketHandler(threading.Thread):
+class UDPCapture:
     """
-    Responsible for receiving frames form Pepper camera service
+    Session state of the video (and legacy UDP audio) stream: chunk
+    reassembly, frame countdown, audio markers and the finalisation
+    timeouts. Transport-agnostic: UDPSocketHandler drives it from a
+    receiving thread, async_transport.AsyncUDPHandler from an asyncio
+    DatagramProtocol and timers.
     """
+    # Finalisation timeouts (seconds)
+    AUDIO_START_TIMEOUT = 10.0  # frames done, no audio started
+    AUDIO_STALL_TIMEOUT = 8.0   # audio started, then no packets
+    FRAMES_IDLE_TIMEOUT = 2.0   # frame count unknown, no packets
+
     def __init__(self, host, port):
-        threading.Thread.__init__(self)
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         # Increase kernel receive buffer to reduce UDP drops on bursts (e.g., during audio send)
         try:
@@ -101,19 +116,16 @@ class UDPSocketHandler(threading.Thread):
         except Exception:
             pass
         self.socket.bind((host, port))
-        # Allow periodic checks instead of blocking forever on recv
-        try:
-            self.socket.settimeout(0.2)
-        except Exception:
-            pass
         # State
         self.running = False
         self.listening = False
         self.frames = []
-        self.frames_countdown = -1
+        self._frames_countdown = -1
         self.patient_id = 0
         self.audio_bytes = None
-        self.audio_done = False
+        self._audio_done = False
+        # The robot's quality / frame rate change log, written beside the video
+        self.rate_changes = None
         # Timers/markers
         self._frames_zero_at = None  # timestamp when frames_countdown reached 0
         self._last_packet_ts = None  # last time any UDP packet was received
@@ -122,6 +134,10 @@ class UDPSocketHandler(threading.Thread):
         self._pre_audio_bytes = 0
         self._audio_chunks = 0
         self._audio_bytes_accum = 0
+        # Legacy frame bytes waiting for END, and UDP audio
+        self._bytes_received = bytearray()
+        self._receiving_audio = False
+        self._audio_buf = bytearray()
         # Config flags
         env_flag = os.getenv('PEPPER_MUX_AUDIO', '1').strip().lower()
         self.mux_audio = env_flag not in ('0', 'false', 'no', 'off')
@@ -129,13 +145,50 @@ class UDPSocketHandler(threading.Thread):
         tcp_audio_flag = os.getenv('PEPPER_TCP_AUDIO', '1').strip().lower()
         self.use_udp_audio = tcp_audio_flag in ('0', 'false', 'no', 'off')
         self._frame_header = struct.Struct('!QI')
-        self._last_frame_ts = None
+        # Secondary camera streams: magic b'PF', stream id, timestamp, length
+        self._stream_frame_header = struct.Struct('!2sBQI')
+        self._last_frame_ts = {}
         self._reset_requested = False
+        # Chunked frames (video_datagrams.py); robots without it still send raw chunks + END
+        try:
+            self._frame_timeout = int(os.getenv('PEPPER_FRAME_TIMEOUT_MS', '500')) / 1000.0
+        except Exception:
+            self._frame_timeout = 0.5
+        # Missing chunks are NACKed back to the robot, which resends them (PEPPER_VIDEO_NACK=0 disables)
+        nack_flag = os.getenv('PEPPER_VIDEO_NACK', '1').strip().lower()
+        self._nack = nack_flag not in ('0', 'false', 'no', 'off')
+        self._robot_addr = None
+        # Frames are reassembled in pooled slab regions and stored as views of them; a
+        # session's regions go back to the pool once its video is made (_release_frames)
+        self.frame_pool = FramePool()
+        self.reassembler = FrameReassembler(self._frame_timeout, nack=self._nack, pool=self.frame_pool)
         try:
             self._timestamp_reset_threshold = int(os.getenv('PEPPER_TS_RESET_DELTA_US', '1000000000'))
         except Exception:
             self._timestamp_reset_threshold = 1000000000
 
+    # Set by SocketManager from other threads; the driver may need to react at once
+    @property
+    def frames_countdown(self) -> int:
+        return self._frames_countdown
+
+    @frames_countdown.setter
+    def frames_countdown(self, value: int):
+        self._frames_countdown = value
+        self._state_changed()
+
+    @property
+    def audio_done(self) -> bool:
+        return self._audio_done
+
+    @audio_done.setter
+    def audio_done(self, value: bool):
+        self._audio_done = value
+        self._state_changed()
+
+    def _state_changed(self):
+        pass
+
     def set_patient_id(self, patient_id: int):
         self.patient_id = patient_id
 
@@ -143,238 +196,573 @@ class UDPSocketHandler(threading.Thread):
         if patient_id is not None:
             self.patient_id = patient_id
         self.frames = []
-        self.frames_countdown = -1
+        self._frames_countdown = -1
         self.audio_bytes = None
-        self.audio_done = False
+        self.rate_changes = None
+        self._audio_done = False
         self._frames_zero_at = None
         self._last_packet_ts = None
         self._pre_audio_chunks = []
         self._pre_audio_bytes = 0
         self._audio_chunks = 0
         self._audio_bytes_accum = 0
-        self._last_frame_ts = None
+        self._last_frame_ts = {}
+        self._robot_addr = None
+        self.reassembler = FrameReassembler(self._frame_timeout, nack=self._nack, pool=self.frame_pool)
         self._reset_requested = True
         self.listening = True
+        self._state_changed()
+
+    @property
+    def loss_stats(self):
+        """LossStats of the current (or last) session's video chunks."""
+        return self.reassembler.stats
+
+    def cancel_capture(self):
+        """Stop assembling the current capture without making a video (lossless mode)."""
+        self.listening = False
+        self.frames = []
+        self._frames_countdown = -1
+        self.audio_bytes = None
+        self._reset_requested = True
+        self._state_changed()
+
+    def _apply_reset(self):
+        if self._reset_requested:
+            self._bytes_received.clear()
+            self._audio_buf = bytearray()
+            self._receiving_audio = False
+            self._reset_requested = False
+
+    def _needs_data(self) -> bool:
+        # Keep receiving while there are frames remaining OR a partial frame in progress
+        need_more_video = (self._frames_countdown != 0) or (len(self._bytes_received) > 0) or self.reassembler.pending > 0
+        need_more_audio = (not self._audio_done)
+        return need_more_video or need_more_audio
+
+    def _tick(self, now: float):
+        for _ in range(self.reassembler.expire(now)):
+            self._frame_lost()
+        self._send_nacks(now)
+        # If frames finished but audio hasn’t arrived for a while, finalize without audio (graceful timeout)
+        if (self._frames_countdown == 0) and (not self._audio_done) and self._frames_zero_at is not None:
+            # Longer timeout before audio starts
+            no_audio_yet = not self._receiving_audio and (now - self._frames_zero_at > self.AUDIO_START_TIMEOUT)
+            # If audio started but stalled (no packets), allow stall timeout
+            stalled = (self._receiving_audio and (self._last_packet_ts is not None)
+                       and (now - self._last_packet_ts > self.AUDIO_STALL_TIMEOUT))
+            if no_audio_yet:
+                if self._pre_audio_bytes > 0:
+                    # Assume start marker lost; promote pre-audio to real audio
+                    print("Promoting pre-audio buffer ({} bytes) to audio due to missing AUDIO_START.".format(self._pre_audio_bytes))
+                    self._audio_buf = b"".join(self._pre_audio_chunks)
+                    self._pre_audio_chunks = []
+                    self._pre_audio_bytes = 0
+                    self.audio_bytes = self._audio_buf
+                    self._audio_done = True
+                else:
+                    print("Audio timed out waiting to start; finalizing without audio.")
+                    self._audio_done = True
+            elif stalled:
+                # If we accumulated any audio, finalize with what we have (assume AUDIO_END lost)
+                if self._audio_bytes_accum > 0:
+                    print("Audio stalled after start; finalizing with {} bytes (missing AUDIO_END).".format(self._audio_bytes_accum))
+                    self.audio_bytes = self._audio_buf
+                    self._audio_done = True
+                else:
+                    print("Audio stalled with no data; finalizing without audio.")
+                    self._audio_done = True
+        # If frame count is unknown (<0) but we received at least one frame and saw no packets recently,
+        # assume frames are done and arm audio timeout
+        if (self._frames_countdown < 0) and (len(self.frames) > 0) and (self._last_packet_ts is not None):
+            if now - self._last_packet_ts > self.FRAMES_IDLE_TIMEOUT:
+                self._frames_countdown = 0
+                if self._frames_zero_at is None:
+                    self._frames_zero_at = now
+
+    def _next_tick(self, now: float) -> float | None:
+        """Seconds until _tick next has something to do; None if only a packet or a state change can."""
+        if self.reassembler.pending:
+            return 0.02     # NACK and expiry granularity
+        deadlines = []
+        if (self._frames_countdown == 0) and (not self._audio_done) and self._frames_zero_at is not None:
+            if not self._receiving_audio:
+                deadlines.append(self._frames_zero_at + self.AUDIO_START_TIMEOUT)
+            elif self._last_packet_ts is not None:
+                deadlines.append(self._last_packet_ts + self.AUDIO_STALL_TIMEOUT)
+        if (self._frames_countdown < 0) and (len(self.frames) > 0) and (self._last_packet_ts is not None):
+            deadlines.append(self._last_packet_ts + self.FRAMES_IDLE_TIMEOUT)
+        return max(0.0, min(deadlines) - now) if deadlines else None
+
+    def _on_datagram(self, data, addr, now: float):
+        """Handle one datagram; ``data`` may be a view of a reused receive buffer."""
+        self._last_packet_ts = now
+        chunk = parse_chunk(data)
+        if chunk is not None:
+            if addr is not None:
+                self._robot_addr = addr
+            frame_blob = self.reassembler.add(data, chunk, now)
+            if frame_blob is not None:
+                self._handle_frame_blob(frame_blob)
+            return
+        # Legacy frame bytes, END and audio are kept past the next receive
+        data = bytes(data)
+        # Handle audio control markers
+        if self.use_udp_audio and data == b"AUDIO_START":
+            # Ignore duplicate start markers once in audio mode
+            if self._receiving_audio:
+                print("AUDIO_START duplicate; already receiving audio")
+                return
+            # If audio starts while a video frame is mid-assembly (rare UDP reordering),
+            # finish the partial frame so we don't stall waiting for its END.
+            if self._bytes_received:
+                # Finalize any partial frame before switching to audio mode
+                frame_blob = bytes(self._bytes_received)
+                self._bytes_received.clear()
+                self._handle_frame_blob(frame_blob, suffix=" (forced finalize on AUDIO_START)")
+            self._receiving_audio = True
+            self._audio_chunks = 0
+            self._audio_bytes_accum = 0
+            # If any audio data arrived before the marker, include it
+            if self._pre_audio_chunks:
+                self._audio_buf = bytearray(b"".join(self._pre_audio_chunks))
+                self._pre_audio_chunks = []
+                self._pre_audio_bytes = 0
+            else:
+                self._audio_buf = bytearray() # Reset
+                print("AUDIO_START received; preloaded {} bytes".format(len(self._audio_buf)))
+            return
+        if self.use_udp_audio and data == b"AUDIO_END":
+            self._receiving_audio = False
+            self.audio_bytes = bytes(self._audio_buf)
+            self._audio_done = True
+            print(f"Audio received: {len(self.audio_bytes)} bytes in {self._audio_chunks} chunks")
+            self._audio_chunks = 0
+            self._audio_bytes_accum = 0
+            return
+        if self.use_udp_audio and data == b"AUDIO_NONE":
+            self.audio_bytes = None
+            self._audio_done = True
+            print("No audio will be received")
+            return
+
+        if self.use_udp_audio and self._receiving_audio:
+            self._audio_buf += data
+            self._audio_chunks += 1
+            self._audio_bytes_accum += len(data)
+            if (self._audio_chunks % 50) == 0:
+                print("Audio receiving... {} bytes so far".format(self._audio_bytes_accum))
+            return
+        # If frames are finished and we haven't started receiving_audio yet,
+        # stash unknown packets (not control markers) as potential early audio.
+        if self.use_udp_audio and self._frames_countdown == 0 and data not in (b"END", b"AUDIO_END", b"AUDIO_NONE"):
+            # Buffer as pre-audio chunk
+            self._pre_audio_chunks.append(data)
+            self._pre_audio_bytes += len(data)
+            if (len(self._pre_audio_chunks) % 20) == 0:
+                print("Pre-audio buffering... {} bytes".format(self._pre_audio_bytes))
+            # If we accumulated enough without seeing AUDIO_START, assume marker lost and switch
+            if self._pre_audio_bytes >= 4096 and not self._receiving_audio:
+                self._audio_buf = bytearray(b"".join(self._pre_audio_chunks))
+                self._pre_audio_chunks = []
+                self._pre_audio_bytes = 0
+                self._receiving_audio = True
+                self._audio_chunks = 0
+                self._audio_bytes_accum = len(self._audio_buf)
+                print("Assuming AUDIO_START lost; switching to audio mode with {} preloaded bytes".format(len(self._audio_buf)))
+            return
+        if data == b"END":
+            # odebrano wszystkie dane z klatki
+            if self._bytes_received:
+                frame_blob = bytes(self._bytes_received)
+                self._bytes_received.clear()
+                self._handle_frame_blob(frame_blob, suffix="")
+            else:
+                # Ignore stray END without data (could be due to packet loss or overlap with AUDIO markers)
+                print("Warning: received END without frame data; skipping")
+        else:
+            # odebrano czesc klatki
+            self._bytes_received += data
+            print(f"udp thread received {len(data)} bytes")
+
+    def _finalize(self, now: float):
+        """
+        End the session (audio_done is True here): returns (frames, patient id,
+        audio bytes, rate changes) for make_video_from_frames; pass the frames
+        to _release_frames once it is done with them.
+        """
+        # nie ma juz klatek do odbioru
+        # trzeba przygotować filmik z tego co jest
+        self.reassembler.expire(now, force=True)
+        print("Finalizing: frames={}, audio={} bytes".format(len(self.frames), 0 if self.audio_bytes is None else len(self.audio_bytes)))
+        print("Session " + self.loss_stats.summary())
+        self.listening = False
+        session = (self.frames, self.patient_id, self.audio_bytes, self.rate_changes)
+        self._frames_countdown = -1
+        self.frames = []
+        self.audio_bytes = None
+        self.rate_changes = None
+        self._audio_done = False
+        self._frames_zero_at = None
+        self._last_packet_ts = None
+        self._pre_audio_chunks = []
+        self._pre_audio_bytes = 0
+        self._audio_chunks = 0
+        self._audio_bytes_accum = 0
+        self._last_frame_ts = {}
+        return session
+
+    def _release_frames(self, frames):
+        # The frames are views of the pool's slabs; nothing may read them after this
+        for entry in frames:
+            self.frame_pool.release(entry[1])
+
+    def _decode_frame_blob(self, blob):
+        try:
+            stream_id = 0
+            header = self._frame_header
+            if blob[:2] == b"PF" and len(blob) >= self._stream_frame_header.size:
+                # Legacy timestamps are < 10**15, so their first two bytes are never b"PF"
+                _, stream_id, ts_us, payload_len = self._stream_frame_header.unpack_from(blob)
+                header = self._stream_frame_header
+            elif len(blob) >= self._frame_header.size:
+                ts_us, payload_len = self._frame_header.unpack_from(blob)
+            else:
+                print("Frame blob too small for header ({} bytes); treating as legacy frame".format(len(blob)))
+                return (None, blob)
+            frame_bytes = blob[header.size:]
+            if payload_len != len(frame_bytes):
+                print("Discarding frame: payload size mismatch (expected {} got {})".format(payload_len, len(frame_bytes)))
+                return None
+            if payload_len <= 0 or payload_len > (3 * 1024 * 1024):
+                print("Discarding frame: unreasonable payload length {}".format(payload_len))
+                return None
+            if ts_us < 0 or ts_us > 10**15:
+                print("Discarding frame: timestamp {} outside expected range".format(ts_us))
+                return None
+            entry = (ts_us, frame_bytes, stream_id) if stream_id else (ts_us, frame_bytes)
+            last_ts = self._last_frame_ts.get(stream_id)
+            if last_ts is None or ts_us > last_ts:
+                self._last_frame_ts[stream_id] = ts_us
+                return entry
+            delta_back = last_ts - ts_us
+            if delta_back > self._timestamp_reset_threshold:
+                print("Timestamp jump backwards by {} us; resetting baseline.".format(delta_back))
+                self._last_frame_ts[stream_id] = ts_us
+                return entry
+            print("Dropping out-of-order frame with timestamp {} (last {})".format(ts_us, last_ts))
+            return None
+        except struct.error as exc:
+            print("Failed to unpack frame header: {}".format(exc))
+        # Legacy support: no timestamp header
+        return (None, blob)
+
+    def _send_nacks(self, now):
+        if self._robot_addr is None:
+            return
+        requests = self.reassembler.nacks(now)
+        if not requests:
+            return
+        try:
+            for datagram in pack_nacks(requests):
+                self.socket.sendto(datagram, self._robot_addr)
+        except OSError:
+            pass
+
+    def _frame_lost(self):
+        # A dropped frame will never arrive; count it off so stop does not wait for it
+        if self._frames_countdown > 0:
+            self._frames_countdown -= 1
+            print(f"Frame dropped (incomplete); frames left: {self._frames_countdown}")
+            if self._frames_countdown == 0 and self._frames_zero_at is None:
+                self._frames_zero_at = time.time()
+
+    def _handle_frame_blob(self, blob, suffix=""):
+        frame_entry = self._decode_frame_blob(blob)
+        if frame_entry is None:
+            self.frame_pool.release(blob)
+        else:
+            self.frames.append(frame_entry)
+            if self._frames_countdown > 0:
+                self._frames_countdown -= 1
+                print(f"Frames left: {self._frames_countdown}{suffix}")
+                if self._frames_countdown == 0 and self._frames_zero_at is None:
+                    self._frames_zero_at = time.time()
+            elif self._frames_countdown == 0 and self._frames_zero_at is None:
+                self._frames_zero_at = time.time()
+        return frame_entry is not None
+
+
+class UDPSocketHandler(UDPCapture, threading.Thread):
+    """
+    Responsible for receiving frames form Pepper camera service
+    """
+    def __init__(self, host, port):
+        threading.Thread.__init__(self)
+        UDPCapture.__init__(self, host, port)
+        # Allow periodic checks instead of blocking forever on recv
+        self._recv_timeout = 0.2
+        try:
+            self.socket.settimeout(self._recv_timeout)
+        except Exception:
+            pass
 
     def run(self):
-        RECV_SIZE = 1400
         self.running = True
-        bytes_received = bytearray()
-        receiving_audio = False
-        audio_buf = bytearray() 
+        # Every datagram is received into the same buffer; chunks are copied from it into their frame
+        recv_buf = bytearray(MAX_DATAGRAM)
+        recv_view = memoryview(recv_buf)
 
         while self.running:
-            if self._reset_requested:
-                bytes_received.clear()
-                audio_buf.clear()
-                receiving_audio = False
-                self._reset_requested = False
+            self._apply_reset()
             if not self.listening:
                 time.sleep(0.1)
                 continue
 
-            # Keep receiving while there are frames remaining OR a partial frame in progress
-            need_more_video = (self.frames_countdown != 0) or (len(bytes_received) > 0)
-            need_more_audio = (not self.audio_done)
             now = time.time()
-            # If frames finished but audio hasn’t arrived for a while, finalize without audio (graceful timeout)
-            if (self.frames_countdown == 0) and (not self.audio_done) and self._frames_zero_at is not None:
-                # Longer timeout before audio starts
-                no_audio_yet = not receiving_audio and (now - self._frames_zero_at > 10.0)
-                # If audio started but stalled (no packets), allow stall timeout
-                stalled = receiving_audio and (self._last_packet_ts is not None) and (now - self._last_packet_ts > 8.0)
-                if no_audio_yet:
-                    if self._pre_audio_bytes > 0:
-                        # Assume start marker lost; promote pre-audio to real audio
-                        print("Promoting pre-audio buffer ({} bytes) to audio due to missing AUDIO_START.".format(self._pre_audio_bytes))
-                        audio_buf = b"".join(self._pre_audio_chunks)
-                        self._pre_audio_chunks = []
-                        self._pre_audio_bytes = 0
-                        self.audio_bytes = audio_buf
-                        self.audio_done = True
-                    else:
-                        print("Audio timed out waiting to start; finalizing without audio.")
-                        self.audio_done = True
-                elif stalled:
-                    # If we accumulated any audio, finalize with what we have (assume AUDIO_END lost)
-                    if self._audio_bytes_accum > 0:
-                        print("Audio stalled after start; finalizing with {} bytes (missing AUDIO_END).".format(self._audio_bytes_accum))
-                        self.audio_bytes = audio_buf
-                        self.audio_done = True
-                    else:
-                        print("Audio stalled with no data; finalizing without audio.")
-                        self.audio_done = True
-            # If frame count is unknown (<0) but we received at least one frame and saw no packets recently,
-            # assume frames are done and arm audio timeout
-            if (self.frames_countdown < 0) and (len(self.frames) > 0) and (self._last_packet_ts is not None):
-                if now - self._last_packet_ts > 2.0:
-                    self.frames_countdown = 0
-                    if self._frames_zero_at is None:
-                        self._frames_zero_at = now
-
-            if need_more_video or need_more_audio:
+            self._tick(now)
+            # Wake up often enough to NACK and expire while frames are incomplete
+            recv_timeout = 0.02 if self.reassembler.pending else 0.2
+            if recv_timeout != self._recv_timeout:
+                self.socket.settimeout(recv_timeout)
+                self._recv_timeout = recv_timeout
+
+            if self._needs_data():
                 # sluchanie kiedy sa klatki do odbioru
                 try:
-                    data, _ = self.socket.recvfrom(RECV_SIZE)
+                    if self._robot_addr is None:
+                        size, addr = self.socket.recvfrom_into(recv_buf)
+                    else:
+                        size, addr = self.socket.recv_into(recv_buf), None
                 except socket.timeout:
                     continue
                 except Exception:
                     time.sleep(0.02)
                     continue
-                if not data:
+                if not size:
                     time.sleep(0.02)
                     continue
-                self._last_packet_ts = now
-                # Handle audio control markers
-                if self.use_udp_audio and data == b"AUDIO_START":
-                    # Ignore duplicate start markers once in audio mode
-                    if 'receiving_audio' in locals() and receiving_audio:
-                        print("AUDIO_START duplicate; already receiving audio")
-                        continue
-                    # If audio starts while a video frame is mid-assembly (rare UDP reordering),
-                    # finish the partial frame so we don't stall waiting for its END.
-                    if bytes_received:
-                        # Finalize any partial frame before switching to audio mode
-                        frame_blob = bytes(bytes_received)
-                        bytes_received.clear()
-                        self._handle_frame_blob(frame_blob, suffix=" (forced finalize on AUDIO_START)")
-                    receiving_audio = True
-                    self._audio_chunks = 0
-                    self._audio_bytes_accum = 0
-                    # If any audio data arrived before the marker, include it
-                    if self._pre_audio_chunks:
-                        audio_buf = bytearray(b"".join(self._pre_audio_chunks))
-                        self._pre_audio_chunks = []
-                        self._pre_audio_bytes = 0
-                    else:
-                        audio_buf.clear() # Reset
-                        print("AUDIO_START received; preloaded {} bytes".format(len(audio_buf)))
-                    continue
-                if self.use_udp_audio and data == b"AUDIO_END":
-                    receiving_audio = False
-                    self.audio_bytes = bytes(audio_buf)
-                    self.audio_done = True
-                    print(f"Audio received: {len(self.audio_bytes)} bytes in {self._audio_chunks} chunks")
-                    self._audio_chunks = 0
-                    self._audio_bytes_accum = 0
-                    continue
-                if self.use_udp_audio and data == b"AUDIO_NONE":
-                    self.audio_bytes = None
-                    self.audio_done = True
-                    print("No audio will be received")
-                    continue
-
-                if self.use_udp_audio and receiving_audio:
-                    audio_buf += data
-                    self._audio_chunks += 1
-                    self._audio_bytes_accum += len(data)
-                    if (self._audio_chunks % 50) == 0:
-                        print("Audio receiving... {} bytes so far".format(self._audio_bytes_accum))
-                    continue
-                # If frames are finished and we haven't started receiving_audio yet,
-                # stash unknown packets (not control markers) as potential early audio.
-                if self.use_udp_audio and self.frames_countdown == 0 and data not in (b"END", b"AUDIO_END", b"AUDIO_NONE"):
-                    # Buffer as pre-audio chunk
-                    self._pre_audio_chunks.append(data)
-                    self._pre_audio_bytes += len(data)
-                    if (len(self._pre_audio_chunks) % 20) == 0:
-                        print("Pre-audio buffering... {} bytes".format(self._pre_audio_bytes))
-                    # If we accumulated enough without seeing AUDIO_START, assume marker lost and switch
-                    if self._pre_audio_bytes >= 4096 and not receiving_audio:
-                        audio_buf = b"".join(self._pre_audio_chunks)
-                        self._pre_audio_chunks = []
-                        self._pre_audio_bytes = 0
-                        receiving_audio = True
-                        self._audio_chunks = 0
-                        self._audio_bytes_accum = len(audio_buf)
-                        print("Assuming AUDIO_START lost; switching to audio mode with {} preloaded bytes".format(len(audio_buf)))
-                    continue
-                if data == b"END":
-                    # odebrano wszystkie dane z klatki
-                    if bytes_received:
-                        frame_blob = bytes(bytes_received)
-                        bytes_received.clear()
-                        self._handle_frame_blob(frame_blob, suffix="")
-                    else:
-                        # Ignore stray END without data (could be due to packet loss or overlap with AUDIO markers)
-                        print("Warning: received END without frame data; skipping")
-                    if self.frames_countdown < 0:
-                        # Unknown total; rely on inactivity to detect completion
-                        pass
-                else:
-                    # odebrano czesc klatki
-                    bytes_received += data
-                    print(f"udp thread received {len(data)} bytes")
+                self._on_datagram(recv_view[:size], addr, now)
             else:
-                # nie ma juz klatek do odbioru
-                # trzeba przygotować filmik z tego co jest (audio_done == True here)
-                print("Finalizing: frames={}, audio={} bytes".format(len(self.frames), 0 if self.audio_bytes is None else len(self.audio_bytes)))
-                self.listening = False
-                make_video_from_frames(self.frames, self.patient_id, self.audio_bytes, self.mux_audio)
-                self.frames_countdown = -1
-                self.frames = []
-                self.audio_bytes = None
-                self.audio_done = False
-                self._frames_zero_at = None
-                self._last_packet_ts = None
-                self._pre_audio_chunks = []
-                self._pre_audio_bytes = 0
-                self._audio_chunks = 0
-                self._audio_bytes_accum = 0
-                self._last_frame_ts = None
+                frames, patient_id, audio_bytes, rate_changes = self._finalize(now)
+                try:
+                    make_video_from_frames(frames, patient_id, audio_bytes, self.mux_audio, rate_changes)
+                finally:
+                    self._release_frames(frames)
 
+    def exit(self):
+        self.listening = False
+        self.running = False
+        self.socket.close()
+
+
+class SpoolTransferHandler(threading.Thread):
+    """
+    Receives session spools pushed by the robot in lossless mode, and
+    multichannel audio archives (--archive_audio). Transfers are resumable:
+    each connection is answered with the number of bytes already on disk for
+    that session, and the robot continues from there.
+    """
+    # Header kind -> final file name; the partial upload is the same name + '.part'
+    _file_names = {'SPOOL': "spool_{}.spool", 'ARCHIVE': "audio_{}.pmc"}
+    def __init__(self, host, port, directory: str = "."):
+        threading.Thread.__init__(self, daemon=True)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((host, port))
+        self.socket.settimeout(0.5)
+        self.directory = directory
+        self.running = False
+        self._completed: dict[str, str] = {}
+        self._done = threading.Condition()
 
+    def run(self):
+        self.socket.listen(1)
+        self.running = True
+        while self.running:
+            try:
+                conn, addr = self.socket.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            try:
+                conn.settimeout(30.0)
+                self._receive(conn)
+            except Exception as e:
+                print(f"Spool transfer from {addr} interrupted: {e}")
+            finally:
+                conn.close()
+
+    def _receive(self, conn):
+        reader = SocketReader(conn, block_size=262144)
+        header = reader.read_line(max_len=256)
+        if not header:
+            return
+        parts = header.decode('utf-8', errors='ignore').split()
+        if len(parts) != 3 or parts[0] not in self._file_names or not parts[1].isdigit():
+            print(f"Bad spool header: {bytes(header)!r}")
+            return
+        kind, session_id, total = parts[0], parts[1], int(parts[2])
+        final_path = os.path.join(self.directory, self._file_names[kind].format(session_id))
+        part_path = final_path + ".part"
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if offset > total:
+            offset = 0
+            os.remove(part_path)
+        conn.sendall(f"{offset}\n".encode('utf-8'))
+        started = time.time()
+        received = 0
+        with open(part_path, 'ab') as f:
+            while offset + received < total:
+                chunk = reader.read_some(total - offset - received)
+                if not chunk:
+                    break
+                f.write(chunk)
+                received += len(chunk)
+        elapsed = max(1e-6, time.time() - started)
+        print(f"{kind.title()} {session_id}: received {received} bytes (resumed at {offset}) in {elapsed:.2f}s, {received / elapsed / 1048576:.2f} MB/s")
+        if offset + received < total:
+            return
+        os.replace(part_path, final_path)
+        conn.sendall(b"OK\n")
+        if kind == 'ARCHIVE':
+            # Nobody waits for archives; they are kept for offline analysis (see audio_archive.py)
+            print(f"Multichannel audio archive saved: {final_path}")
+            return
+        with self._done:
+            self._completed[session_id] = final_path
+            self._done.notify_all()
 
+    def wait_for(self, session_id: str, timeout: float) -> str | None:
+        with self._done:
+            self._done.wait_for(lambda: session_id in self._completed, timeout)
+            return self._completed.pop(session_id, None)
 
     def exit(self):
-        self.listening = False
         self.running = False
         self.socket.close()
 
-    def _decode_frame_blob(self, blob):
-        try:
-            if len(blob) >= self._frame_header.size:
-                ts_us, payload_len = self._frame_header.unpack_from(blob)
-                frame_bytes = blob[self._frame_header.size:]
-                if payload_len != len(frame_bytes):
-                    print("Discarding frame: payload size mismatch (expected {} got {})".format(payload_len, len(frame_bytes)))
-                    return None
-                if payload_len <= 0 or payload_len > (3 * 1024 * 1024):
-                    print("Discarding frame: unreasonable payload length {}".format(payload_len))
-                    return None
-                if ts_us < 0 or ts_us > 10**15:
-                    print("Discarding frame: timestamp {} outside expected range".format(ts_us))
-                    return None
-                if self._last_frame_ts is None:
-                    self._last_frame_ts = ts_us
-                    return (ts_us, frame_bytes)
-                if ts_us > self._last_frame_ts:
-                    self._last_frame_ts = ts_us
-                    return (ts_us, frame_bytes)
-                delta_back = self._last_frame_ts - ts_us
-                if delta_back > self._timestamp_reset_threshold:
-                    print("Timestamp jump backwards by {} us; resetting baseline.".format(delta_back))
-                    self._last_frame_ts = ts_us
-                    return (ts_us, frame_bytes)
-                print("Dropping out-of-order frame with timestamp {} (last {})".format(ts_us, self._last_frame_ts))
-                return None
-            else:
-                print("Frame blob too small for header ({} bytes); treating as legacy frame".format(len(blob)))
-        except struct.error as exc:
-            print("Failed to unpack frame header: {}".format(exc))
-        # Legacy support: no timestamp header
-        return (None, blob)
 
-    def _handle_frame_blob(self, blob, suffix=""):
-        frame_entry = self._decode_frame_blob(blob)
-        if frame_entry is not None:
-            self.frames.append(frame_entry)
-            if self.frames_countdown > 0:
-                self.frames_countdown -= 1
-                print(f"Frames left: {self.frames_countdown}{suffix}")
-                if self.frames_countdown == 0 and self._frames_zero_at is None:
-                    self._frames_zero_at = time.time()
-            elif self.frames_countdown == 0 and self._frames_zero_at is None:
-                self._frames_zero_at = time.time()
-        return frame_entry is not None
+class AudioStreamHandler(threading.Thread):
+    """
+    Receives audio the robot streams while recording (--stream_audio), so
+    stop only has to wait for the last few packets instead of the whole
+    recording. Packets carry a sequence number and the NAOqi capture
+    timestamp; PCM is appended to a WAV file as it arrives.
+    """
+    _packet_header = struct.Struct('!4sIQI')  # magic, seq, ts_us, payload length
+
+    def __init__(self, host, port, directory: str = "."):
+        threading.Thread.__init__(self, daemon=True)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((host, port))
+        self.socket.settimeout(0.5)
+        self.directory = directory
+        self.running = False
+        self.streaming = False
+        self._completed: dict[str, str] = {}
+        self._done = threading.Condition()
+
+    def run(self):
+        self.socket.listen(1)
+        self.running = True
+        while self.running:
+            try:
+                conn, addr = self.socket.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            try:
+                conn.settimeout(30.0)
+                self.streaming = True
+                self._receive(conn)
+            except Exception as e:
+                print(f"Audio stream from {addr} interrupted: {e}")
+            finally:
+                self.streaming = False
+                conn.close()
+
+    def _receive(self, conn):
+        reader = SocketReader(conn)
+        header = reader.read_line(max_len=256)
+        if not header:
+            return
+        parts = header.decode('utf-8', errors='ignore').split()
+        if len(parts) != 4 or parts[0] != 'AUDIO_SESSION':
+            print(f"Bad audio stream header: {bytes(header)!r}")
+            return
+        session_id, sample_rate, channels = parts[1], int(parts[2]), int(parts[3])
+        path = os.path.join(self.directory, f"audio_stream_{session_id}.wav")
+        packets = 0
+        lost = 0
+        expected_seq = 0
+        first_ts = None
+        last_ts = None
+        complete = False
+        trailer = b''
+        timeline = []
+        samples_written = 0
+        with wave.open(path, 'wb') as wav:
+            wav.setnchannels(channels)
+            wav.setsampwidth(2)
+            wav.setframerate(sample_rate)
+            while True:
+                try:
+                    message = reader.read_message(self._packet_header)
+                except ValueError as e:
+                    print(f"Audio stream {session_id}: bad packet, {e}")
+                    break
+                if message is None:
+                    break
+                (magic, seq, ts_us, length), pcm = message
+                if magic == b'PEND':
+                    # The end packet carries the robot's trailers (voice activity segments)
+                    trailer = pcm
+                    complete = True
+                    break
+                if magic != b'PAUD':
+                    print(f"Audio stream {session_id}: bad packet magic {magic!r}")
+                    break
+                if seq != expected_seq:
+                    lost += seq - expected_seq
+                expected_seq = seq + 1
+                if first_ts is None:
+                    first_ts = ts_us
+                last_ts = ts_us
+                timeline.append((samples_written, ts_us))
+                samples_written += len(pcm) // (2 * channels)
+                # writeframesraw leaves the header for close() to patch; the data is on disk as it arrives
+                wav.writeframesraw(pcm)
+                packets += 1
+        # Same trailer the robot appends to buffered recordings, for A/V alignment
+        with open(path, 'ab') as f:
+            f.write(trailer)
+            f.write(pack_timeline(timeline))
+        if complete:
+            # The robot keeps its own copy of the recording until this arrives
+            try:
+                conn.sendall(b'AUDIO_OK\n')
+            except OSError as e:
+                print(f"Audio stream {session_id}: could not confirm: {e}")
+        span = (last_ts - first_ts) / 1e6 if first_ts is not None else 0.0
+        print(f"Audio stream {session_id}: {packets} packets, {lost} missing, {span:.1f}s{'' if complete else ' (connection lost)'}")
+        with self._done:
+            self._completed[session_id] = path
+            self._done.notify_all()
 
+    @property
+    def active(self) -> bool:
+        """A stream is open or finished but not yet collected by wait_for."""
+        return self.streaming or bool(self._completed)
+
+    def wait_for(self, session_id: str, timeout: float) -> str | None:
+        with self._done:
+            self._done.wait_for(lambda: session_id in self._completed, timeout)
+            return self._completed.pop(session_id, None)
+
+    def exit(self):
+        self.running = False
+        self.socket.close()
@@ -1,28 +1,104 @@
-from pepper_app_socket import TCPSocketHandler, UDPSocketHandler
+from pepper_app_socket import TCPSocketHandler, UDPSocketHandler, SpoolTransferHandler, AudioStreamHandler
+from session_spool import read_spool
+from frame_codecs import choose_encoder
+from audio_codecs import choose_audio_codec
+from audio_monitor import AudioMonitorReceiver
+from video_maker_old import make_video_from_frames
+from async_transport import TransportLoop, AsyncControlHandler, AsyncUDPHandler, shared_loop
+from control_protocol import ControlClient, CONTROL_OPTION, CONTROL_ACCEPT
+import json
 import os
 
 class SocketManager:
-    def __init__(self, host: str, port_tcp: int, port_udp: int):
+    def __init__(self, host: str, port_tcp: int, port_udp: int, port_bulk: int | None = None, port_audio: int | None = None,
+                 port_monitor: int | None = None, transport: TransportLoop | None = None):
         self._host = host
         self._port_tcp = port_tcp
         self._port_udp = port_udp
-        self.tcp_socket: TCPSocketHandler = TCPSocketHandler(host, port_tcp)
-        self.udp_socket: UDPSocketHandler = UDPSocketHandler(host, port_udp)
+        # PEPPER_ASYNC_TRANSPORT=1: control and video/audio sockets on the asyncio loop shared by all robots
+        async_flag = os.getenv('PEPPER_ASYNC_TRANSPORT', '0').strip().lower()
+        if transport is None and async_flag not in ('0', 'false', 'no', 'off'):
+            transport = shared_loop()
+        self._transport = transport
+        if transport is not None:
+            self.tcp_socket: TCPSocketHandler | AsyncControlHandler = AsyncControlHandler(transport, host, port_tcp)
+        else:
+            self.tcp_socket = TCPSocketHandler(host, port_tcp)
+        self.udp_socket: UDPSocketHandler | AsyncUDPHandler = self._make_udp_handler()
+        self.spool_socket: SpoolTransferHandler = SpoolTransferHandler(host, port_bulk if port_bulk is not None else port_tcp + 2)
+        self.audio_socket: AudioStreamHandler = AudioStreamHandler(host, port_audio if port_audio is not None else port_tcp + 3)
+        self.audio_monitor: AudioMonitorReceiver = AudioMonitorReceiver(host, port_monitor if port_monitor is not None else port_tcp + 4)
         self._udp_started = False
+        # JSON-lines control requests with acknowledgements, when the robot accepts them
+        self.control: ControlClient | None = None
         
     def start(self):
         self.tcp_socket.start()
+        if not self.spool_socket.is_alive():
+            self.spool_socket.start()
+        if not self.audio_socket.is_alive():
+            self.audio_socket.start()
+        if not self.audio_monitor.is_alive():
+            self.audio_monitor.start()
         if self.udp_socket.is_alive():
             return
 
         if self._udp_started and not self.udp_socket.is_alive():
             # Thread objects cannot be restarted, so create a fresh handler if needed.
-            self.udp_socket = UDPSocketHandler(self._host, self._port_udp)
+            self.udp_socket = self._make_udp_handler()
 
         self.udp_socket.start()
         self._udp_started = True
 
+    def _make_udp_handler(self) -> UDPSocketHandler | AsyncUDPHandler:
+        if self._transport is not None:
+            return AsyncUDPHandler(self._transport, self._host, self._port_udp)
+        return UDPSocketHandler(self._host, self._port_udp)
     
+    def negotiate_encoder(self, timeout: float = 2.0) -> str:
+        """
+        Read the robot's 'ENCODERS:<a,b,...>' and 'AUDIO_CODECS:<a,b,...>' offers sent
+        right after it connects and answer with 'codec <frame> [<audio>]'
+        (PEPPER_FRAME_ENCODER, default jpeg; PEPPER_AUDIO_CODEC, default wav).
+        Robots that send no offer keep JPEG and WAV. The reply also offers
+        JSON-lines control requests (PEPPER_CONTROL_JSON=0 disables); robots
+        that do not answer CONTROL:json get bare command strings.
+        """
+        if self.control is not None:
+            # Joined before reading: the old client must not take the new robot's offers
+            self.control.exit()
+            self.control = None
+        preferred = os.getenv('PEPPER_FRAME_ENCODER', 'jpeg').strip().lower()
+        preferred_audio = os.getenv('PEPPER_AUDIO_CODEC', 'wav').strip().lower()
+        line = self.tcp_socket.receive_line(timeout=timeout)
+        if not line or not line.startswith(b"ENCODERS:"):
+            print("Robot offered no frame encoders; using jpeg")
+            return 'jpeg'
+        offered = [name for name in line[len(b"ENCODERS:"):].decode('utf-8', errors='ignore').strip().split(',') if name]
+        chosen = choose_encoder(offered, preferred)
+        reply = f"codec {chosen}"
+        line = self.tcp_socket.receive_line(timeout=0.5)
+        if line and line.startswith(b"AUDIO_CODECS:"):
+            offered_audio = [name for name in line[len(b"AUDIO_CODECS:"):].decode('utf-8', errors='ignore').strip().split(',') if name]
+            audio_codec = choose_audio_codec(offered_audio, preferred_audio)
+            reply += f" {audio_codec}"
+            print(f"Audio codec: {audio_codec} (robot offers {offered_audio})")
+            # Only offered after an audio codec, so no robot can take the option for a codec name
+            control_flag = os.getenv('PEPPER_CONTROL_JSON', '1').strip().lower()
+            if control_flag not in ('0', 'false', 'no', 'off'):
+                reply += f" {CONTROL_OPTION}"
+        self.tcp_socket.send(reply.encode('utf-8'))
+        print(f"Frame encoder: {chosen} (robot offers {offered})")
+        if reply.endswith(CONTROL_OPTION):
+            line = self.tcp_socket.receive_line(timeout=1.0)
+            if line and line.strip() == CONTROL_ACCEPT:
+                self.control = ControlClient(self.tcp_socket.for_connection())
+                self.control.start()
+                print("Control requests: JSON lines with acknowledgements")
+            else:
+                print("Robot does not accept JSON-lines control; sending bare commands")
+        return chosen
+
     def check_connection(self) -> bool:
         if self.tcp_socket.conn is None:
             print("TCP connection is not established.")
@@ -36,16 +112,19 @@ class SocketManager:
         """
         Sends the command to camera service
         """
+        text = None
         if command == "speak":
             if len(args) == 0:
                 print("No text provided for 'speak' command.")
                 return
             text = args[0]
-            command = f"speak {text}"
 
         print("sending command: ", command)
-        command_bytes: bytes = command.encode('utf-8')
-        self.tcp_socket.send(command_bytes)
+        if self.control is not None:
+            self.control.send(command, text)
+        else:
+            command_bytes: bytes = (f"speak {text}" if text is not None else command).encode('utf-8')
+            self.tcp_socket.send(command_bytes)
         
         match command:
             case "start":
@@ -55,7 +134,7 @@ class SocketManager:
                 self.stop()
             case "exit":
                 self.exit()
-            case "sleep" | "wake":
+            case "sleep" | "wake" | "speak":
                 pass
             case _:
                 print(f"Unknown command: {command}")
@@ -66,10 +145,27 @@ class SocketManager:
 
 
     def stop(self):
+        stats = self.tcp_socket.read_stats
+        before = stats.snapshot() if stats is not None else None
+        try:
+            self._receive_stop_data()
+        finally:
+            if before is not None:
+                print(f"Stop reads: {stats.since(before)}")
+
+    def _receive_stop_data(self):
+        # With JSON-lines control, ControlClient owns the reads and queues these lines for us
+        reader = self.control if self.control is not None else self.tcp_socket
         print("waiting for frame countdown (line)")
-        header = self.tcp_socket.receive_line(timeout=30.0)
+        header = reader.receive_line(timeout=30.0)
+        if header and header.startswith(b"RATE_CHANGES:"):
+            self._receive_rate_changes(reader, header)
+            header = reader.receive_line(timeout=30.0)
         if not header:
             raise RuntimeError("Timeout waiting for frame count over TCP")
+        if header.startswith(b"SPOOL:"):
+            self._receive_spool(header)
+            return
         try:
             frames_left = int(header.decode('utf-8', errors='strict').strip())
         except Exception:
@@ -81,14 +177,18 @@ class SocketManager:
         # Optionally receive audio over TCP for reliability
         tcp_audio_flag = os.getenv('PEPPER_TCP_AUDIO', '1').strip().lower()
         use_tcp_audio = tcp_audio_flag not in ('0', 'false', 'no', 'off')
-        if use_tcp_audio:
+        if use_tcp_audio or self.audio_socket.active:
             try:
-                # Protocol: server sends a line 'AUDIO_LEN:<n>\n' or 'AUDIO_NONE\n' after frames count
-                header = self.tcp_socket.receive_line(timeout=5.0)
+                # Protocol: server sends a line 'AUDIO_LEN:<n>\n' or 'AUDIO_NONE\n' after frames count.
+                # The robot encodes the audio after sending the count, so allow it as long as the count.
+                header = reader.receive_line(timeout=30.0)
                 if not header:
                     print("No audio header over TCP; falling back to UDP or none.")
                     return
                 header_s = header.decode('utf-8', errors='ignore').strip()
+                if header_s.startswith('AUDIO_STREAM:'):
+                    self._receive_audio_stream(header_s.split(':', 1)[1])
+                    return
                 if header_s == 'AUDIO_NONE':
                     self.udp_socket.audio_bytes = None
                     self.udp_socket.audio_done = True
@@ -102,7 +202,7 @@ class SocketManager:
                     if n is None or n < 0 or n > (64 * 1024 * 1024):
                         print(f"Invalid audio length over TCP: {header_s}")
                         return
-                    data = self.tcp_socket.receive_exact(n, timeout=max(10.0, n / (64*1024.0)))
+                    data = reader.receive_exact(n, timeout=max(10.0, n / (64*1024.0)))
                     if data is None:
                         print("Failed to receive full audio over TCP; will finalize without or with partial via UDP.")
                         return
@@ -113,8 +213,61 @@ class SocketManager:
                 print(f"TCP audio receive error: {e}")
 
 
+    def _receive_rate_changes(self, reader, header: bytes):
+        # 'RATE_CHANGES:<n>' then n bytes of JSON: the robot's quality / frame rate changes this session
+        try:
+            n = int(header.split(b':', 1)[1])
+        except ValueError:
+            print(f"Malformed rate change header: {header!r}")
+            return
+        data = reader.receive_exact(n, timeout=10.0)
+        try:
+            self.udp_socket.rate_changes = json.loads(data) if data is not None else None
+        except ValueError as e:
+            print(f"Malformed rate change log: {e}")
+            return
+        if self.udp_socket.rate_changes is not None:
+            print(f"Rate changes: {len(self.udp_socket.rate_changes)}")
+
+    def _receive_audio_stream(self, session_id: str):
+        # Audio was streamed during the session; only the tail is still in flight
+        path = self.audio_socket.wait_for(session_id, timeout=10.0)
+        if path is None:
+            print(f"Audio stream {session_id} did not finish; finalizing without audio.")
+            self.udp_socket.audio_bytes = None
+        else:
+            with open(path, 'rb') as f:
+                self.udp_socket.audio_bytes = f.read()
+            os.remove(path)
+            print(f"Audio received as stream: {len(self.udp_socket.audio_bytes)} bytes")
+        self.udp_socket.audio_done = True
+
+    def _receive_spool(self, header: bytes):
+        # Lossless mode: the robot announces 'SPOOL:<session>:<bytes>:<frames>' instead of a frame count
+        # and pushes the session over the bulk port; UDP frames were only a preview.
+        try:
+            _, session_id, total, frame_count = header.decode('utf-8').strip().split(':')
+            total = int(total)
+        except ValueError:
+            raise RuntimeError(f"Malformed spool announcement: {header!r}")
+        patient_id = self.udp_socket.patient_id
+        self.udp_socket.cancel_capture()
+        print(f"Waiting for spool {session_id}: {total} bytes, {frame_count} frames")
+        path = self.spool_socket.wait_for(session_id, timeout=max(60.0, total / (256 * 1024.0)))
+        if path is None:
+            raise RuntimeError(f"Timeout waiting for spool {session_id}")
+        frames, audio_bytes = read_spool(path)
+        make_video_from_frames(frames, patient_id, audio_bytes, self.udp_socket.mux_audio)
+        os.remove(path)
+
     def exit(self):
+        if self.control is not None:
+            self.control.exit()
+            self.control = None
         self.tcp_socket.exit()
         self.udp_socket.exit()
+        self.spool_socket.exit()
+        self.audio_socket.exit()
+        self.audio_monitor.exit()
         if self.udp_socket.is_alive():
             self.udp_socket.join()
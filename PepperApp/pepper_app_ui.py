@@ -28,6 +28,7 @@ class App(customtkinter.CTk):
         self.loading_bar.set(0)
         self.show_start_frame()
         self.after(0, self._equalize_left_panel_width)
+        self.after(500, self._update_audio_monitor_status)
 
     def connect(self):
         ip_value = self.ip_entry.get().strip()
@@ -210,6 +211,7 @@ class App(customtkinter.CTk):
 
             try:
                 self.socket_manager.tcp_socket.accept_connection()
+                self.socket_manager.negotiate_encoder()
             except socket.timeout:
                 self.after(0, lambda: tkinter.messagebox.showerror("Error", "Socket accept timed out. Pepper app not started?"))
                 return
@@ -231,6 +233,17 @@ class App(customtkinter.CTk):
         self.loading_bar.stop()
         self.loading_bar.set(0)
 
+    def _update_audio_monitor_status(self):
+        monitor = getattr(self.socket_manager, "audio_monitor", None)
+        if monitor is not None:
+            text = monitor.status_text()
+            control = getattr(self.socket_manager, "control", None)
+            if control is not None:
+                # Live command round trip and robot-side execution time
+                text += "   " + control.stats.status_text()
+            self.audio_monitor_label.configure(text=text)
+        self.after(500, self._update_audio_monitor_status)
+
     def _re_enable_connect_button(self):
         self.loading_bar.stop()
         self.loading_bar.set(0)
@@ -344,6 +357,9 @@ class App(customtkinter.CTk):
         self.loading_bar = customtkinter.CTkProgressBar(self, progress_color="#a60d02")
         self.loading_bar.grid(row=1, column=2, columnspan=4, padx=20, pady=10, sticky="ew")
 
+        self.audio_monitor_label = customtkinter.CTkLabel(self, text="Audio monitor: off", anchor="w")
+        self.audio_monitor_label.grid(row=1, column=0, columnspan=2, padx=20, pady=10, sticky="w")
+
         self.large_textbox = customtkinter.CTkTextbox(self, width=300, height=100, font=self.say_textbox_font)
         self.large_textbox.grid(row=2, column=0, columnspan=2, padx=20, pady=(20, 10), sticky="nsew")
         self._apply_say_textbox_editable_state()
@@ -0,0 +1,60 @@
+import os
+import struct
+
+# Must match PepperCameraService/session_spool.py
+RECORD_HEADER = struct.Struct('!cBQI')   # kind, stream id, timestamp_us, payload length
+INDEX_ENTRY = struct.Struct('!cBQQI')    # kind, stream id, timestamp_us, record offset, payload length
+FOOTER = struct.Struct('!4sQI')          # magic, index offset, entry count
+FOOTER_MAGIC = b'PIDX'
+KIND_VIDEO = b'V'
+KIND_AUDIO = b'A'
+
+
+def _read_index(f, file_size: int) -> list[tuple[bytes, int, int, int, int]] | None:
+    if file_size < FOOTER.size:
+        return None
+    f.seek(file_size - FOOTER.size)
+    magic, index_offset, count = FOOTER.unpack(f.read(FOOTER.size))
+    if magic != FOOTER_MAGIC or index_offset + count * INDEX_ENTRY.size + FOOTER.size != file_size:
+        return None
+    f.seek(index_offset)
+    raw = f.read(count * INDEX_ENTRY.size)
+    return [INDEX_ENTRY.unpack_from(raw, i * INDEX_ENTRY.size) for i in range(count)]
+
+
+def _scan_records(f, file_size: int) -> list[tuple[bytes, int, int, int, int]]:
+    # No usable index (e.g. truncated spool): walk the records sequentially
+    entries = []
+    offset = 0
+    f.seek(0)
+    while offset + RECORD_HEADER.size <= file_size:
+        kind, stream_id, ts_us, length = RECORD_HEADER.unpack(f.read(RECORD_HEADER.size))
+        if kind not in (KIND_VIDEO, KIND_AUDIO) or offset + RECORD_HEADER.size + length > file_size:
+            break
+        entries.append((kind, stream_id, ts_us, offset, length))
+        offset += RECORD_HEADER.size + length
+        f.seek(offset)
+    return entries
+
+
+def read_spool(path: str) -> tuple[list[tuple[int, bytes, int]], bytes | None]:
+    """
+    Load a session spool written by the robot in lossless mode.
+    Returns ``(frames, audio_bytes)`` in the shape make_video_from_frames expects.
+    """
+    file_size = os.path.getsize(path)
+    frames = []
+    audio_parts = []
+    with open(path, 'rb') as f:
+        entries = _read_index(f, file_size)
+        if entries is None:
+            print(f"Spool {path} has no valid index; scanning records.")
+            entries = _scan_records(f, file_size)
+        for kind, stream_id, ts_us, offset, length in entries:
+            f.seek(offset + RECORD_HEADER.size)
+            payload = f.read(length)
+            if kind == KIND_VIDEO:
+                frames.append((ts_us, payload, stream_id))
+            elif kind == KIND_AUDIO:
+                audio_parts.append(payload)
+    return frames, (b"".join(audio_parts) if audio_parts else None)
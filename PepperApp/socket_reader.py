@@ -0,0 +1,121 @@
+import socket
+import struct
+
+BLOCK_SIZE = 64 * 1024      # bytes asked of each recv
+MAX_RECV = 1024 * 1024      # largest single recv, for the rest of a large payload
+
+
+class ReadStats:
+    """recv calls made by a SocketReader and the bytes they returned."""
+    def __init__(self):
+        self.recv_calls = 0
+        self.bytes_received = 0
+
+    @property
+    def bytes_per_recv(self) -> float:
+        return self.bytes_received / self.recv_calls if self.recv_calls else 0.0
+
+    def snapshot(self) -> tuple[int, int]:
+        return self.recv_calls, self.bytes_received
+
+    def since(self, snapshot: tuple[int, int]) -> str:
+        calls = self.recv_calls - snapshot[0]
+        nbytes = self.bytes_received - snapshot[1]
+        return f"{nbytes} bytes in {calls} recv calls ({nbytes / calls if calls else 0.0:.0f} bytes/call)"
+
+
+class SocketReader:
+    """
+    Buffered reads from a stream socket. Each recv asks for a whole block,
+    and lines, exact-length payloads and length-prefixed messages are all
+    served from the one buffer, so bytes that arrive behind a line stay
+    for the next read instead of being lost between calls.
+
+    Reads time out the way the handlers' always did: ``timeout`` is set on
+    the socket for each recv, and a read that times out returns None and
+    leaves what it had buffered. ``closed`` turns True once the peer has
+    closed the connection (or it failed).
+    """
+    def __init__(self, sock: socket.socket, block_size: int = BLOCK_SIZE):
+        self.sock = sock
+        self.block_size = block_size
+        self.stats = ReadStats()
+        self.closed = False
+        self._buffer = bytearray()
+
+    def _fill(self, timeout: float | None, size: int = 0) -> bool:
+        """One recv of at least a block into the buffer; False on timeout or end of stream."""
+        if self.closed:
+            return False
+        try:
+            if timeout is not None:
+                self.sock.settimeout(timeout)
+            data = self.sock.recv(max(self.block_size, size))
+        except socket.timeout:
+            return False
+        except OSError:
+            self.closed = True
+            return False
+        self.stats.recv_calls += 1
+        if not data:
+            self.closed = True
+            return False
+        self.stats.bytes_received += len(data)
+        self._buffer += data
+        return True
+
+    def _ensure(self, nbytes: int, timeout: float | None) -> bool:
+        """Buffer at least ``nbytes``; a large payload is asked for whole (up to MAX_RECV per call)."""
+        while len(self._buffer) < nbytes:
+            if not self._fill(timeout, min(nbytes - len(self._buffer), MAX_RECV)):
+                return False
+        return True
+
+    def _take(self, n: int) -> bytes:
+        data = bytes(self._buffer[:n])
+        del self._buffer[:n]
+        return data
+
+    def read_line(self, max_len: int = 4096, timeout: float | None = None) -> bytes | None:
+        """The next line with its newline, at most ``max_len`` bytes of it, or None if
+        nothing arrived. A line cut short by the limit or the end of the stream is
+        returned as it is."""
+        searched = 0
+        while True:
+            end = self._buffer.find(b"\n", searched, max_len)
+            if end >= 0:
+                return self._take(end + 1)
+            if len(self._buffer) >= max_len:
+                return self._take(max_len)
+            searched = len(self._buffer)
+            if not self._fill(timeout):
+                if self.closed and self._buffer:
+                    return self._take(len(self._buffer))
+                return None
+
+    def read_exact(self, nbytes: int, timeout: float | None = None) -> bytes | None:
+        """Exactly ``nbytes``, or None (with nothing consumed) if they did not all arrive."""
+        if not self._ensure(nbytes, timeout):
+            return None
+        return self._take(nbytes)
+
+    def read_message(self, header: struct.Struct, max_length: int = 64 * 1024 * 1024,
+                     timeout: float | None = None) -> tuple[tuple, bytes] | None:
+        """A message framed by ``header``, whose last field is the payload length:
+        (header fields, payload), or None (with nothing consumed) if it did not all arrive.
+        Raises ValueError for a length over ``max_length`` rather than buffering it."""
+        if not self._ensure(header.size, timeout):
+            return None
+        fields = header.unpack_from(self._buffer)
+        if fields[-1] > max_length:
+            raise ValueError(f"message length {fields[-1]} exceeds {max_length}")
+        if not self._ensure(header.size + fields[-1], timeout):
+            return None
+        del self._buffer[:header.size]
+        return fields, self._take(fields[-1])
+
+    def read_some(self, max_len: int, timeout: float | None = None) -> bytes:
+        """Up to ``max_len`` bytes: what is buffered, else one recv; b'' at the end of the stream."""
+        if not self._buffer:
+            self._fill(timeout)
+        return self._take(min(max_len, len(self._buffer)))
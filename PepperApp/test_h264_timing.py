@@ -0,0 +1,88 @@
+"""
+H.264 sessions whose frame rate changed are decoded and each picture is
+placed on its frame's capture timestamp. The robot's encoder output can lag
+its input, so a payload may be empty and a later one carry two pictures;
+these check that every picture still gets its own frame's timestamp.
+
+    python -m pytest -q test_h264_timing.py
+"""
+import struct
+import numpy as np
+import pytest
+import video_maker_old
+from frame_codecs import h264_picture_starts
+
+H264_HEADER = struct.Struct('!4sII')   # as the robot's frame_compresser.py packs it
+
+# Six frames at 15 fps, then six at 7.5 fps
+TIMESTAMPS = [1000000 + i * 66667 for i in range(6)] + [1400000 + i * 133333 for i in range(6)]
+# Which pictures each payload carries: payload 1 is empty (the encoder was late) and
+# payload 2 carries pictures 1 and 2; from then on the output lags a frame behind,
+# and the flush at stop carries the last picture.
+CARRIED = [[0], [], [1, 2], [3], [4], [5], [6], [7], [8], [9], [10], [], [11]]
+
+
+def _synthetic_pictures(count):
+    # An IDR slice, then P slices; first_mb_in_slice 0 is the leading 1 bit after the NAL header
+    idr = b'\x00\x00\x00\x01\x67\x42' + b'\x00\x00\x00\x01\x68\xce' + b'\x00\x00\x00\x01\x65\x88\x84'
+    return [idr] + [b'\x00\x00\x00\x01\x41\x9a\x02' for _ in range(count - 1)]
+
+
+def _session(pictures):
+    frames = []
+    first = 0
+    for seq, carried in enumerate(CARRIED):
+        ts = TIMESTAMPS[seq] if seq < len(TIMESTAMPS) else TIMESTAMPS[-1] + 1
+        nal_units = b''.join(pictures[n] for n in carried)
+        frames.append((ts, H264_HEADER.pack(b'AVC2', seq, first) + nal_units))
+        first += len(carried)
+    return frames
+
+
+def test_picture_starts_count_whole_pictures():
+    pictures = _synthetic_pictures(3)
+    assert h264_picture_starts(pictures[0]) == [0]
+    assert len(h264_picture_starts(b''.join(pictures))) == 3
+    assert h264_picture_starts(b'') == []
+
+
+def test_lagging_payloads_keep_their_frames_timestamps():
+    frames = _session(_synthetic_pictures(len(TIMESTAMPS)))
+    units = video_maker_old._h264_access_units(frames)
+    timed = video_maker_old._h264_picture_times(frames, units)
+    assert [ts for ts, _ in timed] == TIMESTAMPS
+    assert [int.from_bytes(position, 'big') for _, position in timed] == list(range(len(TIMESTAMPS)))
+
+
+def test_unnumbered_payloads_are_not_timed():
+    # AVC1 robots did not number pictures: counting them would be off after a late one
+    frames = [(ts, b'AVC1' + struct.pack('!I', seq) + b'\x00\x00\x01\x65\x88')
+              for seq, ts in enumerate(TIMESTAMPS)]
+    assert video_maker_old._h264_picture_times(frames, video_maker_old._h264_access_units(frames)) is None
+
+
+def test_decoded_pictures_match_their_frames(tmp_path):
+    av = pytest.importorskip('av')
+    from fractions import Fraction
+    codec = av.CodecContext.create('libx264', 'w')
+    codec.width, codec.height, codec.pix_fmt = 64, 48, 'yuv420p'
+    codec.time_base = Fraction(1, 15)
+    codec.options = {'preset': 'ultrafast', 'tune': 'zerolatency', 'bf': '0'}
+    levels = [40 + 15 * n for n in range(len(TIMESTAMPS))]
+    pictures = []
+    for level in levels:
+        image = np.full((48, 64, 3), level, dtype=np.uint8)
+        packets = codec.encode(av.VideoFrame.from_ndarray(image, format='bgr24'))
+        pictures.append(b''.join(bytes(packet) for packet in packets))
+    assert all(len(h264_picture_starts(picture)) == 1 for picture in pictures)
+    frames = _session(pictures)
+    units = video_maker_old._h264_access_units(frames)
+    timed = video_maker_old._h264_picture_times(frames, units)
+    path = tmp_path / 'session.h264'
+    path.write_bytes(b''.join(nal_units for _, _, nal_units in units))
+    decode = video_maker_old._h264_file_decoder(str(path), len(timed))
+    # Every other picture, as after _make_stream_video drops some entries
+    for (ts, position), level, expected_ts in list(zip(timed, levels, TIMESTAMPS))[::2]:
+        image = decode(position, 0)
+        assert ts == expected_ts
+        assert abs(float(image.mean()) - level) < 4
@@ -0,0 +1,314 @@
+"""
+Loopback benchmark of the UDP video transport: the robot's FrameSender
+(PepperCameraService/video_datagrams.py) against the operator's
+FrameReassembler, with simulated random datagram loss applied to every
+datagram in both directions (original chunks, resends and NACKs).
+Reports frame completion rate and frame latency (first chunk sent to
+frame complete), with and without NACK retransmission, and with --fec
+XOR parity at each given overhead: frames rebuilt and parity bytes.
+
+With --send, only the robot's sending path is measured, as fast as it
+goes: datagrams per second and CPU microseconds per frame for the old
+concatenate-and-slice sender and each FrameSender mode ('send' is what
+the robot's Python 2.7 uses; 'batch' needs Linux 4.18+).
+
+With --receive, only the operator's receiving path is measured, over
+back-to-back sessions: datagrams and megabytes per second, CPU
+microseconds per frame and garbage collections for the old
+recvfrom/join/slice receiver and the recv_into + FramePool one, plus
+how many pool slabs had to be allocated rather than reused.
+
+    python transport_benchmark.py --loss 0 0.01 0.05 --frames 300
+    python transport_benchmark.py --loss 0.01 0.05 --fec 0.1 0.25
+    python transport_benchmark.py --send --frames 5000
+    python transport_benchmark.py --receive --frames 2000
+"""
+import argparse
+import gc
+import importlib.util
+import os
+import random
+import select
+import socket
+import struct
+import threading
+import time
+from video_datagrams import FramePool, FrameReassembler, parse_chunk, pack_nacks, CHUNK_HEADER, MAX_DATAGRAM
+
+
+def _load_robot_datagrams():
+    # Same module name as ours, so load it by path
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'PepperCameraService', 'video_datagrams.py')
+    spec = importlib.util.spec_from_file_location('robot_video_datagrams', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+robot = _load_robot_datagrams()
+
+
+class LossySocket:
+    """UDP socket whose sends are dropped with probability ``loss``."""
+    def __init__(self, loss: float, seed: int):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 16 * 1024 * 1024)
+        self.sock.bind(('127.0.0.1', 0))
+        self.loss = loss
+        self._random = random.Random(seed)
+        self.sent = 0
+        self.dropped = 0
+
+    def _lost(self) -> bool:
+        if self.loss and self._random.random() < self.loss:
+            self.dropped += 1
+            return True
+        self.sent += 1
+        return False
+
+    def sendto(self, data, addr):
+        if not self._lost():
+            self.sock.sendto(data, addr)
+
+
+def run_session(frames: int, frame_bytes: int, fps: float, loss: float, nack: bool, timeout_s: float,
+                fec: float = 0.0) -> dict:
+    sender = LossySocket(loss, seed=1)
+    receiver = LossySocket(loss, seed=2)
+    receiver_addr = receiver.sock.getsockname()
+    # Datagram by datagram, so the simulated loss hits single datagrams
+    frame_sender = robot.FrameSender(sender, receiver_addr, fec_overhead=fec, mode='send')
+    reassembler = FrameReassembler(timeout_s, nack=nack)
+    sent_at: dict[int, float] = {}
+    latencies: list[float] = []
+    done = threading.Event()
+
+    def send_frames():
+        payload = os.urandom(frame_bytes)
+        for frame_id in range(frames):
+            sent_at[frame_id] = time.perf_counter()
+            frame_sender.send_frame(struct.pack('!QI', frame_id, len(payload)), payload)
+            time.sleep(1.0 / fps)
+
+    def serve_nacks():
+        while not done.is_set():
+            readable, _, _ = select.select([sender.sock], [], [], 0.05)
+            if readable:
+                data, _ = sender.sock.recvfrom(2048)
+                frame_sender.handle_nack(data)
+
+    threads = [threading.Thread(target=send_frames), threading.Thread(target=serve_nacks)]
+    for thread in threads:
+        thread.start()
+    receiver.sock.settimeout(0.01)
+    robot_addr = sender.sock.getsockname()
+    deadline = None
+    while True:
+        now = time.perf_counter()
+        if deadline is None and not threads[0].is_alive():
+            deadline = now + timeout_s * 2
+        if deadline is not None and (now > deadline or reassembler.stats.frames_completed == frames):
+            break
+        try:
+            data, _ = receiver.sock.recvfrom(MAX_DATAGRAM)
+        except socket.timeout:
+            data = None
+        now = time.perf_counter()
+        chunk = parse_chunk(data) if data else None
+        if chunk is not None and reassembler.add(data, chunk, now) is not None:
+            latencies.append(now - sent_at[chunk[1]])
+        reassembler.expire(now)
+        for datagram in pack_nacks(reassembler.nacks(now)):
+            receiver.sendto(datagram, robot_addr)
+    reassembler.expire(time.perf_counter(), force=True)
+    done.set()
+    for thread in threads:
+        thread.join()
+    sender.sock.close()
+    receiver.sock.close()
+    latencies.sort()
+    return {
+        'completed': len(latencies) / frames,
+        'mean_ms': sum(latencies) / len(latencies) * 1000.0 if latencies else 0.0,
+        'p95_ms': latencies[int(len(latencies) * 0.95) - 1] * 1000.0 if latencies else 0.0,
+        'max_ms': latencies[-1] * 1000.0 if latencies else 0.0,
+        'resent': frame_sender.chunks_resent,
+        'rebuilt': reassembler.stats.frames_rebuilt,
+        'parity_bytes': reassembler.stats.parity_bytes,
+        'overhead': reassembler.stats.parity_bytes / max(1, reassembler.stats.data_bytes),
+    }
+
+
+def _legacy_send(sock, target, frame_id, timestamp_us, payload):
+    # The sender before FrameSender: header + payload copy, then a sliced copy per chunk
+    frame_packet = struct.pack('!QI', int(timestamp_us), len(payload)) + payload
+    count = robot.chunk_count(len(frame_packet))
+    for index in range(count):
+        start = index * robot.CHUNK_PAYLOAD
+        header = robot.CHUNK_HEADER.pack(robot.CHUNK_MAGIC, robot.PROTOCOL_VERSION, robot.KIND_FRAME, frame_id, index, count)
+        sock.sendto(header + frame_packet[start:start + robot.CHUNK_PAYLOAD], target)
+    return count
+
+
+def _cpu_seconds() -> float:
+    times = os.times()
+    return times[0] + times[1]
+
+
+def run_send(frames: int, frame_bytes: int):
+    sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink.bind(('127.0.0.1', 0))   # never read: the kernel drops the overflow, the sender does not block
+    target = sink.getsockname()
+    payload = os.urandom(frame_bytes)
+    print(f"{'sender':>8} {'datagrams/s':>12} {'cpu us/frame':>13}")
+    for mode in ('legacy', 'send', 'sendmsg', 'batch'):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if mode != 'legacy':
+            sock.connect(target)
+        frame_sender = robot.FrameSender(sock, mode=mode if mode != 'legacy' else 'send')
+        datagrams = 0
+        cpu_started, started = _cpu_seconds(), time.perf_counter()
+        for frame_id in range(frames):
+            if mode == 'legacy':
+                datagrams += _legacy_send(sock, target, frame_id, frame_id, payload)
+            else:
+                frame_sender.send_frame(struct.pack('!QI', frame_id, len(payload)), payload)
+        elapsed, cpu = time.perf_counter() - started, _cpu_seconds() - cpu_started
+        datagrams = datagrams or frame_sender.datagrams_sent
+        print(f"{frame_sender.mode if mode != 'legacy' else mode:>8} {datagrams / elapsed:>12.0f} "
+              f"{cpu / frames * 1e6:>13.1f}")
+        sock.close()
+    sink.close()
+
+
+FRAME_HEADER = struct.Struct('!QI')
+
+
+class _LegacyReceiver:
+    # The receiver before FramePool, same bookkeeping: a bytes object per datagram from recvfrom,
+    # the frame copied out whole (the old join), then sliced past the frame header
+    def __init__(self, sock):
+        self.sock = sock
+        self.reassembler = FrameReassembler(pool=FramePool())
+
+    def receive(self, store):
+        data, _ = self.sock.recvfrom(MAX_DATAGRAM)
+        blob = self.reassembler.add(data, parse_chunk(data), 0.0)
+        if blob is not None:
+            self.reassembler.pool.release(blob)
+            blob = bytes(blob)
+            store.append((FRAME_HEADER.unpack_from(blob)[0], blob[FRAME_HEADER.size:]))
+
+    def end_session(self, store):
+        pass
+
+
+class _PoolReceiver:
+    # UDPSocketHandler.run: recv_into one buffer, chunks copied to their offset in a slab region,
+    # the frame kept as a view of it and given back once the session's video is made
+    def __init__(self, sock):
+        self.sock = sock
+        self.buffer = bytearray(MAX_DATAGRAM)
+        self.view = memoryview(self.buffer)
+        self.reassembler = FrameReassembler(pool=FramePool())
+
+    def receive(self, store):
+        data = self.view[:self.sock.recv_into(self.buffer)]
+        blob = self.reassembler.add(data, parse_chunk(data), 0.0)
+        if blob is not None:
+            store.append((FRAME_HEADER.unpack_from(blob)[0], blob[FRAME_HEADER.size:]))
+
+    def end_session(self, store):
+        for _, payload in store:
+            self.reassembler.pool.release(payload)
+
+
+def run_receive(frames: int, frame_bytes: int, sessions: int = 3):
+    payload = os.urandom(frame_bytes)
+    # ~1 MB of frames per burst, which the 16 MB socket buffer holds with its per-datagram overhead
+    burst = max(1, (1 << 20) // frame_bytes)
+    datagrams_per_frame = robot.chunk_count(FRAME_HEADER.size + frame_bytes)
+    collections = [0, 0, 0]
+
+    def count_collections(phase, info):
+        if phase == 'start':
+            collections[info['generation']] += 1
+
+    gc.callbacks.append(count_collections)
+    print(f"{'receiver':>8} {'datagrams/s':>12} {'MB/s':>8} {'cpu us/frame':>13} {'gc gen0/1/2':>12} {'buffers new/reused':>19}")
+    try:
+        for name, receiver_class in (('legacy', _LegacyReceiver), ('pool', _PoolReceiver)):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 16 * 1024 * 1024)
+            sock.bind(('127.0.0.1', 0))
+            sock.settimeout(1.0)
+            sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sender.connect(sock.getsockname())
+            frame_sender = robot.FrameSender(sender)
+            receiver = receiver_class(sock)
+            collections[:] = [0, 0, 0]
+            elapsed = cpu = 0.0
+            received = 0
+            for _ in range(sessions):
+                store = []
+                for first in range(0, frames, burst):
+                    # A burst the socket buffer holds whole, then received with only the receiver running
+                    count = min(burst, frames - first)
+                    for frame_id in range(first, first + count):
+                        frame_sender.send_frame(FRAME_HEADER.pack(frame_id, frame_bytes), payload)
+                    cpu_started, started = time.thread_time(), time.perf_counter()
+                    try:
+                        for _ in range(count * datagrams_per_frame):
+                            receiver.receive(store)
+                            received += 1
+                    except socket.timeout:
+                        pass
+                    elapsed += time.perf_counter() - started
+                    cpu += time.thread_time() - cpu_started
+                if len(store) != frames:
+                    print(f"{name}: {frames - len(store)} frames lost in the socket buffer")
+                receiver.end_session(store)
+                store = None
+            pool = receiver.reassembler.pool
+            buffers = f"{pool.allocated}/{pool.reused}" if name == 'pool' else "-"
+            print(f"{name:>8} {received / elapsed:>12.0f} {received * robot.DATAGRAM_SIZE / elapsed / 1e6:>8.1f} "
+                  f"{cpu / (frames * sessions) * 1e6:>13.1f} {'/'.join(map(str, collections)):>12} {buffers:>19}")
+            sock.close()
+            sender.close()
+    finally:
+        gc.callbacks.remove(count_collections)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--loss', type=float, nargs='+', default=[0.0, 0.01, 0.05], help='Datagram loss probabilities')
+    parser.add_argument('--frames', type=int, default=300)
+    parser.add_argument('--frame_bytes', type=int, default=30000, help='Encoded frame size (a 640x480 JPEG is ~30 kB)')
+    parser.add_argument('--fps', type=float, default=15.0)
+    parser.add_argument('--timeout_ms', type=float, default=500.0, help='Reassembly timeout / latency budget')
+    parser.add_argument('--fec', type=float, nargs='*', default=[], help='Parity overheads to try (robot --video_fec)')
+    parser.add_argument('--send', action='store_true', help='Measure the sending path only')
+    parser.add_argument('--receive', action='store_true', help='Measure the receiving path only')
+    args = parser.parse_args()
+
+    if args.send:
+        run_send(args.frames, args.frame_bytes)
+        return
+    if args.receive:
+        run_receive(args.frames, args.frame_bytes)
+        return
+
+    modes = [('none', False, 0.0), ('nack', True, 0.0)]
+    modes += [(f'fec{fec:g}', False, fec) for fec in args.fec]
+    print(f"{'loss':>6} {'mode':>8} {'complete':>9} {'mean ms':>8} {'p95 ms':>8} {'max ms':>8} {'resent':>7} "
+          f"{'rebuilt':>7} {'overhead':>9}")
+    for loss in args.loss:
+        for name, nack, fec in modes:
+            result = run_session(args.frames, args.frame_bytes, args.fps, loss, nack, args.timeout_ms / 1000.0, fec)
+            print(f"{loss:>6.3f} {name:>8} {result['completed'] * 100:>8.1f}% "
+                  f"{result['mean_ms']:>8.2f} {result['p95_ms']:>8.2f} {result['max_ms']:>8.2f} "
+                  f"{result['resent']:>7} {result['rebuilt']:>7} {result['overhead'] * 100:>8.1f}%")
+
+
+if __name__ == '__main__':
+    main()
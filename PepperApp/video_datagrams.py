@@ -0,0 +1,414 @@
+import struct
+from collections import deque
+import numpy as np
+
+# Must match PepperCameraService/video_datagrams.py
+CHUNK_HEADER = struct.Struct('!2sBBIHH')   # magic, version, kind, frame id, chunk index, chunk count
+CHUNK_MAGIC = b'PV'
+PROTOCOL_VERSION = 1
+KIND_FRAME = 0
+KIND_PARITY = 1
+DATAGRAM_SIZE = 1400
+CHUNK_PAYLOAD = DATAGRAM_SIZE - CHUNK_HEADER.size
+PARITY_HEADER = struct.Struct('!HH')       # parity count, length of the frame's last data chunk
+PARITY_DATAGRAM_SIZE = CHUNK_HEADER.size + PARITY_HEADER.size + CHUNK_PAYLOAD
+MAX_DATAGRAM = 2048                        # receive buffer size; parity datagrams exceed DATAGRAM_SIZE
+NACK_HEADER = struct.Struct('!2sBB')       # magic, version, entry count
+NACK_ENTRY = struct.Struct('!IHH')         # frame id, first chunk index, bitmap bytes (0: whole frame)
+NACK_MAGIC = b'PN'
+
+
+def parse_chunk(data: bytes | memoryview) -> tuple[int, int, int, int] | None:
+    """(kind, frame id, index, count) of a chunk or parity datagram, or None for anything
+    else (legacy frame bytes, END, audio chunks and markers)."""
+    if len(data) <= CHUNK_HEADER.size:
+        return None
+    magic, version, kind, frame_id, index, count = CHUNK_HEADER.unpack_from(data)
+    if magic != CHUNK_MAGIC or version != PROTOCOL_VERSION or index >= count:
+        return None
+    if kind == KIND_PARITY:
+        return (kind, frame_id, index, count) if len(data) == PARITY_DATAGRAM_SIZE else None
+    # Only the last chunk of a frame may be short
+    if kind != KIND_FRAME or (index < count - 1 and len(data) != DATAGRAM_SIZE):
+        return None
+    return kind, frame_id, index, count
+
+
+def pack_nacks(requests: list[tuple[int, list[int] | None]]) -> list[bytes]:
+    """NACK datagrams for [(frame id, missing chunk indexes or None for the whole frame), ...]."""
+    datagrams = []
+    entries: list[bytes] = []
+    size = NACK_HEADER.size
+    for frame_id, indexes in requests:
+        if indexes:
+            first = min(indexes)
+            bitmap = bytearray((max(indexes) - first) // 8 + 1)
+            for index in indexes:
+                bitmap[(index - first) // 8] |= 1 << ((index - first) % 8)
+            entry = NACK_ENTRY.pack(frame_id, first, len(bitmap)) + bytes(bitmap)
+        else:
+            entry = NACK_ENTRY.pack(frame_id, 0, 0)
+        if entries and (size + len(entry) > DATAGRAM_SIZE or len(entries) == 255):
+            datagrams.append(NACK_HEADER.pack(NACK_MAGIC, PROTOCOL_VERSION, len(entries)) + b"".join(entries))
+            entries, size = [], NACK_HEADER.size
+        entries.append(entry)
+        size += len(entry)
+    if entries:
+        datagrams.append(NACK_HEADER.pack(NACK_MAGIC, PROTOCOL_VERSION, len(entries)) + b"".join(entries))
+    return datagrams
+
+
+class LossStats:
+    """Per-session counters of the chunked video stream."""
+    def __init__(self):
+        self.frames_completed = 0
+        self.frames_dropped = 0
+        self.chunks_received = 0
+        self.chunks_lost = 0        # missing from dropped frames, after any recovery
+        self.duplicates = 0         # chunk already held, or for a frame already completed
+        self.late = 0               # chunk for a frame already dropped
+        self.reordered = 0          # chunk arriving after a higher index of its frame
+        self.nacks_sent = 0         # per-frame retransmission requests
+        self.chunks_recovered = 0   # chunks that arrived after their frame was NACKed
+        self.frames_recovered = 0   # frames completed only after a NACK
+        self.recovery_s = 0.0       # summed first-chunk-to-complete time of recovered frames
+        self.data_bytes = 0         # chunk datagram bytes received
+        self.parity_bytes = 0       # parity datagram bytes received (FEC overhead)
+        self.chunks_rebuilt = 0     # data chunks rebuilt from parity
+        self.frames_rebuilt = 0     # frames completed only thanks to parity
+
+    def loss_rate(self) -> float:
+        total = self.chunks_received + self.chunks_rebuilt + self.chunks_lost
+        return self.chunks_lost / total if total else 0.0
+
+    def completion_rate(self) -> float:
+        total = self.frames_completed + self.frames_dropped
+        return self.frames_completed / total if total else 1.0
+
+    def summary(self) -> str:
+        text = (f"video chunks: {self.chunks_received} received, {self.chunks_lost} lost "
+                f"({self.loss_rate() * 100:.2f}%), {self.reordered} reordered, {self.duplicates} duplicate, "
+                f"{self.late} late; frames: {self.frames_completed} complete, {self.frames_dropped} dropped")
+        if self.nacks_sent:
+            recovery_ms = self.recovery_s * 1000.0 / self.frames_recovered if self.frames_recovered else 0.0
+            text += (f"; NACKs: {self.nacks_sent} sent, {self.chunks_recovered} chunks and "
+                     f"{self.frames_recovered} frames recovered, {recovery_ms:.1f} ms mean recovery")
+        if self.parity_bytes:
+            overhead = self.parity_bytes / self.data_bytes * 100 if self.data_bytes else 0.0
+            text += (f"; FEC: {self.frames_rebuilt} frames ({self.chunks_rebuilt} chunks) rebuilt "
+                     f"for {self.parity_bytes} parity bytes ({overhead:.1f}% overhead)")
+        return text
+
+
+class _Slab(bytearray):
+    """A FramePool slab; views of it reach the pool again through memoryview.obj."""
+    def __init__(self, size: int):
+        bytearray.__init__(self, size)
+        self.used = 0       # bytes handed out since it was (re)started
+        self.live = 0       # regions handed out and not yet released
+
+
+class FramePool:
+    """
+    Reassembly buffers for FrameReassembler, carved one after another out of
+    shared slabs. A frame's region is taken when its first chunk arrives,
+    sized to its chunk count (so at most one chunk larger than the frame),
+    and every chunk is written straight to its offset in it. A complete
+    frame is handed on as a read-only view of its region, without a copy.
+
+    Whoever ends up holding the frame calls release() once it is done with
+    it; a slab whose regions have all been released is reused. A slab that
+    is never fully released (a cancelled session) is not reused, and is
+    freed with the last view of it like any other object.
+    """
+    def __init__(self, slab_size: int = 4 * 1024 * 1024, max_free_bytes: int = 64 * 1024 * 1024):
+        self.slab_size = slab_size
+        self.max_free_bytes = max_free_bytes
+        self._slab: _Slab | None = None
+        self._free: list[_Slab] = []
+        self.allocated = 0          # slabs (and oversized frame buffers) created
+        self.reused = 0             # slabs started again after every region was released
+
+    @property
+    def free_bytes(self) -> int:
+        return len(self._free) * self.slab_size
+
+    def acquire(self, size: int) -> memoryview:
+        if size > self.slab_size // 4:
+            # Rare oversized frame: a buffer of its own, freed with its last view
+            self.allocated += 1
+            return memoryview(bytearray(size))
+        slab = self._slab
+        if slab is None or slab.used + size > self.slab_size:
+            self._slab = None
+            if slab is not None and slab.live == 0:
+                self._recycle(slab)
+            slab = self._slab = self._new_slab()
+        region = memoryview(slab)[slab.used:slab.used + size]
+        slab.used += size
+        slab.live += 1
+        return region
+
+    def release(self, view):
+        """Give back a region from acquire(), or any view of it; anything else is ignored."""
+        slab = getattr(view, 'obj', None)
+        if not isinstance(slab, _Slab):
+            return
+        slab.live -= 1
+        if slab.live == 0 and slab is not self._slab:
+            self._recycle(slab)
+
+    def _new_slab(self) -> _Slab:
+        if self._free:
+            self.reused += 1
+            slab = self._free.pop()
+            slab.used = 0
+            return slab
+        self.allocated += 1
+        return _Slab(self.slab_size)
+
+    def _recycle(self, slab: _Slab):
+        if self.free_bytes + self.slab_size <= self.max_free_bytes:
+            self._free.append(slab)
+
+
+class _FrameSlot:
+    __slots__ = ('count', 'buffer', 'view', 'have', 'length', 'received', 'highest', 'first_seen', 'last_seen',
+                 'last_nack', 'nacks', 'parity', 'parity_received', 'last_length', 'rebuilt')
+
+    def __init__(self, count: int, now: float, buffer: memoryview):
+        self.count = count
+        self.buffer = buffer
+        self.view = memoryview(buffer)
+        self.have = bytearray(count)        # 1 per chunk written to the buffer
+        self.length = 0                     # frame length, known once the last chunk is in
+        self.received = 0
+        self.highest = -1
+        self.first_seen = now
+        self.last_seen = now
+        self.last_nack = 0.0
+        self.nacks = 0
+        self.parity: list[bytes | None] | None = None
+        self.parity_received = 0
+        self.last_length = 0
+        self.rebuilt = False
+
+    def missing(self) -> list[int]:
+        return [i for i, have in enumerate(self.have) if not have]
+
+
+class FrameReassembler:
+    """
+    Rebuilds frames from chunk datagrams in per-frame slots, in whatever
+    order the chunks arrive. A frame still incomplete ``timeout_s`` after
+    its first chunk is dropped; expiry is swept at most a few times per
+    timeout, so the cost does not grow with the packet rate.
+
+    With ``nack`` the missing chunks of a frame are requested once its
+    burst has gone quiet for ``nack_delay_s`` (or a newer frame started),
+    again every ``nack_interval_s`` up to ``max_nacks`` times, and only
+    while a resend can still land inside the timeout. Frame ids skipped
+    entirely are requested as whole frames.
+
+    Parity datagrams (robot --video_fec) rebuild lost chunks on arrival,
+    one per interleaved XOR group, before any NACK is due.
+
+    Chunks are copied from the datagram (which may be a view of a reused
+    receive buffer) to their offset in a FramePool region. A complete frame
+    is that region, returned as a read-only memoryview so slicing it is
+    free; the consumer hands it back with pool.release(). A dropped frame's
+    region goes back at once.
+    """
+    def __init__(self, timeout_s: float = 0.5, remembered: int = 1024, nack: bool = False,
+                 nack_delay_s: float = 0.01, nack_interval_s: float = 0.05, max_nacks: int = 3,
+                 pool: FramePool | None = None):
+        self.timeout_s = timeout_s
+        self.nack = nack
+        self.nack_delay_s = nack_delay_s
+        self.nack_interval_s = nack_interval_s
+        self.max_nacks = max_nacks
+        self._newest: int | None = None
+        # Frame ids skipped entirely: id -> [first noticed, last nack, nacks]
+        self._gaps: dict[int, list] = {}
+        self.stats = LossStats()
+        self._slots: dict[int, _FrameSlot] = {}
+        # Recently finished frame ids -> True if completed, False if dropped
+        self._finished: dict[int, bool] = {}
+        self._finished_order: deque[int] = deque()
+        self._remembered = remembered
+        self._last_sweep = 0.0
+        self.pool = pool if pool is not None else FramePool()
+
+    @property
+    def pending(self) -> int:
+        return len(self._slots) + len(self._gaps)
+
+    def add(self, data: bytes | memoryview, chunk: tuple[int, int, int, int], now: float) -> memoryview | None:
+        """Store a chunk parsed by parse_chunk; returns the frame blob once it is complete."""
+        kind, frame_id, index, count = chunk
+        if kind == KIND_PARITY:
+            self.stats.parity_bytes += len(data)
+        else:
+            self.stats.data_bytes += len(data)
+        finished = self._finished.get(frame_id)
+        if finished is not None:
+            if kind == KIND_PARITY:
+                pass    # parity trails the data; for a complete frame it is simply not needed
+            elif finished:
+                self.stats.duplicates += 1
+            else:
+                self.stats.late += 1
+            return None
+        slot = self._slots.get(frame_id)
+        if slot is None or slot.count != count:
+            if slot is not None:
+                self.pool.release(slot.buffer)
+            slot = self._slots[frame_id] = _FrameSlot(count, now, self.pool.acquire(count * CHUNK_PAYLOAD))
+            gap = self._gaps.pop(frame_id, None)
+            if gap is not None:
+                slot.first_seen, slot.last_nack, slot.nacks = gap
+            self._note_frame_id(frame_id, now)
+        if kind == KIND_PARITY:
+            if not self._add_parity(slot, data, index):
+                return None
+        else:
+            if slot.have[index]:
+                self.stats.duplicates += 1
+                return None
+            offset = index * CHUNK_PAYLOAD
+            end = offset + len(data) - CHUNK_HEADER.size
+            slot.view[offset:end] = data[CHUNK_HEADER.size:]
+            slot.have[index] = 1
+            if index == count - 1:
+                slot.length = end
+            slot.received += 1
+            slot.last_seen = now
+            self.stats.chunks_received += 1
+            if slot.nacks:
+                self.stats.chunks_recovered += 1
+            if index < slot.highest:
+                self.stats.reordered += 1
+            else:
+                slot.highest = index
+        if slot.received < count and slot.parity_received and slot.received + slot.parity_received >= count:
+            self._rebuild(slot)
+        if slot.received < count:
+            return None
+        del self._slots[frame_id]
+        self._finish(frame_id, True)
+        self.stats.frames_completed += 1
+        if slot.rebuilt:
+            self.stats.frames_rebuilt += 1
+        if slot.nacks:
+            self.stats.frames_recovered += 1
+            self.stats.recovery_s += now - slot.first_seen
+        return slot.view[:slot.length].toreadonly()
+
+    def _add_parity(self, slot: _FrameSlot, data: bytes, index: int) -> bool:
+        parity_count, last_length = PARITY_HEADER.unpack_from(data, CHUNK_HEADER.size)
+        if slot.parity is None:
+            if not 0 < parity_count <= slot.count or index >= parity_count or not 0 < last_length <= CHUNK_PAYLOAD:
+                return False
+            slot.parity = [None] * parity_count
+            slot.last_length = last_length
+        elif len(slot.parity) != parity_count or index >= parity_count:
+            return False
+        if slot.parity[index] is not None:
+            self.stats.duplicates += 1
+            return False
+        slot.parity[index] = bytes(data[CHUNK_HEADER.size + PARITY_HEADER.size:])
+        slot.parity_received += 1
+        return True
+
+    def _rebuild(self, slot: _FrameSlot):
+        """Rebuild every missing chunk that is alone in its parity group and whose parity arrived."""
+        parity_count = len(slot.parity)
+        rows = -(-slot.count // parity_count) * parity_count
+        chunks = np.zeros((rows, CHUNK_PAYLOAD), dtype=np.uint8)
+        # Only the chunks written so far: the rest of a pooled buffer holds an older frame
+        have = np.frombuffer(slot.have, dtype=np.uint8).astype(bool)
+        received = np.frombuffer(slot.buffer, dtype=np.uint8, count=slot.count * CHUNK_PAYLOAD)
+        chunks[:slot.count][have] = received.reshape(slot.count, CHUNK_PAYLOAD)[have]
+        if have[-1]:
+            chunks[slot.count - 1, slot.length - (slot.count - 1) * CHUNK_PAYLOAD:] = 0
+        missing_by_group: dict[int, list[int]] = {}
+        for i in slot.missing():
+            missing_by_group.setdefault(i % parity_count, []).append(i)
+        # XOR of each group's received chunks; with its parity, that is the one missing chunk
+        partial = np.bitwise_xor.reduce(chunks.reshape(-1, parity_count, CHUNK_PAYLOAD), axis=0)
+        for group, indexes in missing_by_group.items():
+            if len(indexes) != 1 or slot.parity[group] is None:
+                continue
+            index = indexes[0]
+            rebuilt = np.bitwise_xor(partial[group], np.frombuffer(slot.parity[group], dtype=np.uint8))
+            size = slot.last_length if index == slot.count - 1 else CHUNK_PAYLOAD
+            offset = index * CHUNK_PAYLOAD
+            slot.view[offset:offset + size] = rebuilt[:size].tobytes()
+            slot.have[index] = 1
+            if index == slot.count - 1:
+                slot.length = offset + size
+            slot.received += 1
+            slot.rebuilt = True
+            self.stats.chunks_rebuilt += 1
+
+    def _note_frame_id(self, frame_id: int, now: float):
+        if self.nack and self._newest is not None and self._newest + 1 < frame_id <= self._newest + 64:
+            # Ids in between were sent (the robot numbers every frame) but nothing of them arrived
+            for missing in range(self._newest + 1, frame_id):
+                if missing not in self._slots and missing not in self._finished:
+                    self._gaps[missing] = [now, 0.0, 0]
+        if self._newest is None or frame_id > self._newest:
+            self._newest = frame_id
+
+    def nacks(self, now: float) -> list[tuple[int, list[int] | None]]:
+        """Retransmission requests due now: [(frame id, missing chunk indexes or None), ...]."""
+        if not self.nack or not self.pending:
+            return []
+        requests = []
+        # A resend is only worth asking for if it can arrive before the frame is dropped
+        budget = self.timeout_s - self.nack_interval_s
+        for frame_id, slot in self._slots.items():
+            if slot.nacks >= self.max_nacks or now - slot.first_seen > budget:
+                continue
+            if now - slot.last_nack < self.nack_interval_s:
+                continue
+            if now - slot.last_seen < self.nack_delay_s and frame_id >= self._newest:
+                continue    # its burst may still be arriving
+            slot.last_nack = now
+            slot.nacks += 1
+            requests.append((frame_id, slot.missing()))
+        for frame_id, gap in self._gaps.items():
+            if gap[2] >= self.max_nacks or now - gap[0] > budget or now - gap[1] < self.nack_interval_s:
+                continue
+            gap[1] = now
+            gap[2] += 1
+            requests.append((frame_id, None))
+        self.stats.nacks_sent += len(requests)
+        return requests
+
+    def expire(self, now: float, force: bool = False) -> int:
+        """Drop frames incomplete for longer than the timeout (all of them with ``force``); returns how many."""
+        if not self.pending or (not force and now - self._last_sweep < self.timeout_s / 4):
+            return 0
+        self._last_sweep = now
+        expired = [frame_id for frame_id, slot in self._slots.items()
+                   if force or now - slot.first_seen > self.timeout_s]
+        for frame_id in expired:
+            slot = self._slots.pop(frame_id)
+            self.pool.release(slot.buffer)
+            self.stats.frames_dropped += 1
+            self.stats.chunks_lost += slot.count - slot.received
+            self._finish(frame_id, False)
+        # Whole frames that never arrived; their chunk count is unknown
+        lost = [frame_id for frame_id, gap in self._gaps.items() if force or now - gap[0] > self.timeout_s]
+        for frame_id in lost:
+            del self._gaps[frame_id]
+            self.stats.frames_dropped += 1
+            self._finish(frame_id, False)
+        return len(expired) + len(lost)
+
+    def _finish(self, frame_id: int, completed: bool):
+        self._finished[frame_id] = completed
+        self._finished_order.append(frame_id)
+        if len(self._finished_order) > self._remembered:
+            self._finished.pop(self._finished_order.popleft(), None)
@@ -5,6 +5,10 @@ import os
 import subprocess
 import wave
 import io
+import json
+from frame_codecs import FrameDecoder, h264_access_unit, h264_has_idr, h264_picture_starts
+from audio_codecs import decode_audio
+from audio_timeline import split_timeline, split_segments, AudioClock
 
 
 def _compute_median(values):
@@ -18,6 +22,28 @@ def _compute_median(values):
     return (sorted_vals[mid - 1] + sorted_vals[mid]) / 2.0
 
 
+def _capture_interval_us(deltas):
+    """
+    Output frame interval for timestamped frames: the typical interval of the
+    fastest rate the robot captured at. Its rate controller lowers the frame
+    rate under congestion, so a session can mix rates; timing every frame at
+    this interval keeps the fast stretches whole and repeats frames in the slow
+    ones instead of playing them fast. One early or late grab does not set it.
+    """
+    if not deltas:
+        return None
+    ordered = sorted(deltas)
+    fastest = ordered[len(ordered) // 10]
+    return _compute_median([delta for delta in ordered if delta <= fastest * 1.25])
+
+
+def _rate_varied(deltas, interval_us):
+    """More than a tenth of the frames came at a lower rate than ``interval_us``."""
+    if not deltas or not interval_us:
+        return False
+    return sum(1 for delta in deltas if delta > interval_us * 1.25) > len(deltas) / 10
+
+
 def _audio_duration_seconds(audio_bytes):
     if not audio_bytes:
         return None
@@ -32,22 +58,346 @@ def _audio_duration_seconds(audio_bytes):
     return None
 
 
-def make_video_from_frames(frames, patient_id, audio_bytes=None, mux_audio=True):
+def _split_streams(frames):
+    """Group ``(ts, data)`` / ``(ts, data, stream_id)`` entries by stream; untagged entries are stream 0."""
+    streams = {}
+    for source in frames:
+        stream_id = source[2] if isinstance(source, tuple) and len(source) == 3 else 0
+        streams.setdefault(stream_id, []).append(source)
+    return streams
+
+
+def _tiled_frames(streams):
+    """One entry per primary-stream tick whose data is the tuple of every stream's buffer at that tick."""
+    stream_ids = sorted(streams)
+    by_ts = {sid: {entry[0]: entry[1] for entry in streams[sid]} for sid in stream_ids}
+    primary = stream_ids[0]
+    return stream_ids, [(ts_us, tuple(by_ts[sid].get(ts_us) for sid in stream_ids)) for ts_us, *_ in streams[primary]]
+
+
+def _tile_decoder(stream_count, tile_size):
+    decoders = [FrameDecoder() for _ in range(stream_count)]
+    last_tiles = [None] * stream_count
+    blank = np.zeros((tile_size[1], tile_size[0], 3), dtype=np.uint8)
+
+    def decode(parts, idx):
+        # Each buffer is decoded exactly once; a stream missing at this tick repeats its last image
+        for i, part in enumerate(parts):
+            if part is None:
+                continue
+            image = decoders[i].decode(part, idx)
+            if image is not None:
+                if (image.shape[1], image.shape[0]) != tile_size:
+                    image = cv2.resize(image, tile_size)
+                last_tiles[i] = image
+        if last_tiles[0] is None:
+            return None
+        return np.hstack([tile if tile is not None else blank for tile in last_tiles])
+    return decode
+
+
+def make_video_from_frames(frames, patient_id, audio_bytes=None, mux_audio=True, rate_changes=None):
     if not frames:
         print("No frames to process.")
         return
 
     current_time = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+    audio_bytes, timeline = split_timeline(audio_bytes)
+    audio_bytes, segments = split_segments(audio_bytes)
+    # FLAC/ADPCM from the robot become WAV here, before any duration math or muxing
+    audio_bytes = decode_audio(audio_bytes)
+    audio_clock = _audio_clock(audio_bytes, timeline)
+    _write_speech_index(audio_bytes, segments, f'speech_{current_time}_{patient_id}.json')
+    _write_rate_changes(rate_changes, f'rate_changes_{current_time}_{patient_id}.json')
+    streams = _split_streams(frames)
+    if len(streams) == 1:
+        _make_stream_video(frames, patient_id, current_time, audio_bytes, mux_audio, audio_clock=audio_clock)
+        return
+
     width, height = 640, 480
+    tile_flag = os.getenv('PEPPER_TILE_STREAMS', '0').strip().lower()
+    if any(_is_h264_stream(stream_frames) for stream_frames in streams.values()):
+        print("H.264 streams are remuxed, not decoded; writing one output per stream instead of tiling.")
+    elif tile_flag not in ('0', 'false', 'no', 'off'):
+        stream_ids, tiled = _tiled_frames(streams)
+        print(f"Tiling streams {stream_ids} into one video")
+        _make_stream_video(tiled, patient_id, current_time, audio_bytes, mux_audio,
+                           size=(width * len(stream_ids), height),
+                           decode=_tile_decoder(len(stream_ids), (width, height)), audio_clock=audio_clock)
+        return
+    primary = min(streams)
+    for stream_id, stream_frames in sorted(streams.items()):
+        # Streams share capture timestamps, so every output lines up with the same audio
+        label = "" if stream_id == primary else f"_cam{stream_id}"
+        print(f"Writing stream {stream_id}: {len(stream_frames)} frames")
+        _make_stream_video(stream_frames, patient_id, current_time, audio_bytes, mux_audio, label=label,
+                           audio_clock=audio_clock)
+
+
+def _audio_clock(audio_bytes, timeline):
+    """AudioClock for the robot's audio timeline, or None to fall back to fitting fps to the audio length."""
+    if not audio_bytes or not timeline:
+        return None
+    try:
+        with wave.open(io.BytesIO(audio_bytes), 'rb') as wf:
+            sample_rate = wf.getframerate()
+        clock = AudioClock(timeline, sample_rate)
+    except Exception as exc:
+        print(f"Ignoring audio timeline: {exc}")
+        return None
+    print(f"A/V drift: {clock.drift_ms_per_minute:+.2f} ms/min (audio clock vs robot clock, "
+          f"{len(timeline)} buffers, max jitter {clock.jitter_ms:.1f} ms)")
+    return clock
+
+
+def _write_speech_index(audio_bytes, segments, path):
+    """Robot voice activity segments as JSON next to the video, for jumping to or transcribing speech only."""
+    if not audio_bytes or segments is None:
+        return
+    try:
+        with wave.open(io.BytesIO(audio_bytes), 'rb') as wf:
+            sample_rate = wf.getframerate()
+        index = {
+            'sample_rate': sample_rate,
+            'segments': [{'start_sample': start, 'end_sample': end,
+                          'start': round(start / sample_rate, 3), 'end': round(end / sample_rate, 3)}
+                         for start, end in segments],
+        }
+        with open(path, 'w') as f:
+            json.dump(index, f, indent=2)
+    except Exception as exc:
+        print(f"Could not write speech index: {exc}")
+        return
+    speech = sum(end - start for start, end in segments) / sample_rate
+    print(f"Speech index: {len(segments)} segments, {speech:.1f}s of speech -> {path}")
+
+
+def _write_rate_changes(changes, path):
+    """The robot's quality / frame rate changes as JSON next to the video, each with the frame it applies from."""
+    if not changes:
+        return
+    try:
+        with open(path, 'w') as f:
+            json.dump(changes, f, indent=2)
+    except Exception as exc:
+        print(f"Could not write rate changes: {exc}")
+        return
+    print(f"Rate changes: {len(changes)} -> {path}")
+
+
+def _is_h264_stream(frames):
+    first = frames[0]
+    data = first[1] if isinstance(first, tuple) else first
+    return h264_access_unit(data) is not None
+
+
+def _h264_access_units(frames):
+    """
+    (ts, first picture number or None, NAL units) of the H.264 payloads a
+    decoder can use: from the first IDR on and, after a payload lost in
+    transit (a gap in the robot's access unit numbers), again only from the
+    next IDR, because the frames in between reference the missing one.
+    """
+    units = []
+    expected = None
+    waiting = True
+    skipped = 0
+    for source in frames:
+        unit = h264_access_unit(source[1])
+        if unit is None:
+            continue
+        seq, first_picture, nal_units = unit
+        if seq is not None:
+            if expected is not None and seq != expected:
+                print(f"H.264 access units {expected}..{seq - 1} missing; resuming at the next IDR")
+                waiting = True
+            expected = (seq + 1) & 0xFFFFFFFF
+        if waiting:
+            if not h264_has_idr(nal_units):
+                skipped += 1
+                continue
+            waiting = False
+        units.append((source[0], first_picture, nal_units))
+    if skipped:
+        print(f"Skipped {skipped} H.264 frames that depend on a missing one")
+    return units
+
+
+def _remux_h264_stream(frames, patient_id, current_time, audio_bytes=None, mux_audio=True, label="", audio_clock=None):
+    """
+    Concatenate the robot's H.264 NAL units and remux them into MP4 with ffmpeg;
+    no decoding. A raw H.264 stream plays at one frame rate, so a session whose
+    rate changed is decoded and rewritten on its capture timestamps instead.
+    """
+    entries = _h264_access_units(frames)
+    if not entries:
+        print("No decodable H.264 frames (no IDR received).")
+        return
+    payloads = [nal_units for _, _, nal_units in entries]
+    pictures = sum(len(h264_picture_starts(nal_units)) for nal_units in payloads)
+    ts_values = [source[0] for source in entries if source[0] is not None]
+    deltas = [b - a for a, b in zip(ts_values, ts_values[1:]) if b > a]
+    median_delta = _compute_median(deltas)
+    interval_us = _capture_interval_us(deltas)
+    audio_duration = _audio_duration_seconds(audio_bytes) if audio_bytes else None
+    if audio_clock is not None and len(ts_values) >= 2:
+        # Frame rate measured on the audio clock, so the remuxed video does not drift from the audio
+        span = audio_clock.audio_seconds(ts_values[-1]) - audio_clock.audio_seconds(ts_values[0])
+        fps = (len(ts_values) - 1) / span if span > 0 else 15.0
+    elif median_delta:
+        fps = 1e6 / median_delta
+    elif audio_duration:
+        fps = pictures / audio_duration
+    else:
+        fps = 15.0
+    fps = max(1.0, min(60.0, fps))
+
+    h264_path = f'output_{current_time}_{patient_id}{label}.h264'
+    with open(h264_path, 'wb') as f:
+        for nal_units in payloads:
+            f.write(nal_units)
+    if len(ts_values) == len(entries) and _rate_varied(deltas, interval_us):
+        timed = _h264_picture_times(frames, entries)
+        if timed is not None:
+            print(f"Frame rate changed during the session; decoding the H.264 stream to time frames "
+                  f"at {1e6 / interval_us:.2f} fps on their capture timestamps")
+            _make_stream_video(timed, patient_id, current_time,
+                               audio_bytes, mux_audio, label, decode=_h264_file_decoder(h264_path, len(timed)),
+                               audio_clock=audio_clock)
+            os.remove(h264_path)
+            return
+        print(f"WARNING: the frame rate changed during the session, but this robot's H.264 payloads do not "
+              f"number their pictures; remuxing at {fps:.2f} fps, so stretches at other rates play at the wrong speed")
+    video_path = f'output_{current_time}_{patient_id}{label}.mp4'
+    # Where the first frame falls in the audio: positive delays the video, negative the audio
+    start_offset = audio_clock.audio_seconds(ts_values[0]) if audio_clock is not None and ts_values else 0.0
+    video_offset = ['-itsoffset', f'{start_offset:.3f}'] if start_offset > 0 else []
+    ffmpeg_cmd = ['ffmpeg', '-y'] + video_offset + ['-framerate', f'{fps:.5f}', '-f', 'h264', '-i', h264_path]
+    audio_path = None
+    if audio_bytes and mux_audio:
+        audio_path = f'audio_{current_time}_{patient_id}{label}.wav'
+        with open(audio_path, 'wb') as f:
+            f.write(audio_bytes)
+        video_path = f'output_{current_time}_{patient_id}{label}_with_audio.mp4'
+        audio_offset = ['-itsoffset', f'{-start_offset:.3f}'] if start_offset < 0 else []
+        ffmpeg_cmd += audio_offset + ['-i', audio_path, '-c:a', 'aac', '-b:a', '128k', '-shortest']
+    ffmpeg_cmd += ['-c:v', 'copy', video_path]
+    try:
+        subprocess.run(ffmpeg_cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        os.remove(h264_path)
+        print(f"H.264 stream remuxed: {video_path} ({pictures} frames at {fps:.2f} fps)")
+    except Exception as e:
+        print(f"ffmpeg failed to remux H.264: {e}. Keeping raw stream at {h264_path}")
+
+
+def _h264_picture_times(frames, units):
+    """
+    (capture ts, picture position) for every picture written from ``units``,
+    in file order, or None if the payloads do not number their pictures.
+    Picture n was encoded for the frame whose payload has access unit number
+    n, whichever payload carried the picture: the robot's encoder output can
+    lag its input, leaving one payload empty and the next with two pictures.
+    The position is the picture's index in the file as 4 bytes, so frames
+    that _make_stream_video filters out cannot shift which picture is shown.
+    """
+    capture_ts = {}
+    for source in frames:
+        unit = h264_access_unit(source[1])
+        if unit is not None and unit[0] is not None:
+            capture_ts[unit[0]] = source[0]
+    times = []
+    for _, first_picture, nal_units in units:
+        if first_picture is None:
+            return None
+        for n in range(len(h264_picture_starts(nal_units))):
+            times.append(capture_ts.get((first_picture + n) & 0xFFFFFFFF))
+    known = [i for i, ts in enumerate(times) if ts is not None]
+    if len(known) < 2:
+        return None
+    if len(known) < len(times):
+        # Its own payload was lost but the picture arrived with a later one
+        print(f"Timing {len(times) - len(known)} H.264 pictures between their neighbours: their frames' payloads were lost")
+        times = np.interp(range(len(times)), known, [times[i] for i in known])
+    return [(int(ts), position.to_bytes(4, 'big')) for position, ts in enumerate(times)]
+
+
+def _h264_file_decoder(h264_path, expected):
+    """decode(data, idx) for _make_stream_video returning the picture of an H.264 file at the
+    position in ``data`` (from _h264_picture_times); pictures are read in order, skipping any
+    not asked for."""
+    capture = cv2.VideoCapture(h264_path)
+    state = {'read': 0, 'image': None, 'ended': False}
+
+    def decode(data, idx):
+        position = int.from_bytes(data, 'big')
+        while state['read'] <= position:
+            if state['ended']:
+                return None
+            ok, image = capture.read()
+            if not ok:
+                capture.release()
+                state['ended'] = True
+                print(f"WARNING: {h264_path} decoded to {state['read']} pictures, {expected} expected; "
+                      f"the rest of the video repeats the last one")
+                return None
+            state['read'] += 1
+            state['image'] = image
+        return state['image']
+    return decode
+
+
+def _write_aligned_video(entries, decode, audio_clock, audio_duration, interval_us, video_path, fourcc, size):
+    """
+    Write frames at the capture rate onto the audio clock: output slot k shows
+    the latest frame captured at or before k / fps seconds of audio, so gaps
+    repeat the previous frame and drift is absorbed instead of the fps being
+    stretched to the audio length. Slots before the first frame are black.
+    """
+    fps = 1e6 / interval_us if interval_us else 15.0
+    fps = max(1.0, min(60.0, fps))
+    positions = [audio_clock.audio_seconds(entry["ts"]) for entry in entries]
+    slots = int(max(audio_duration, positions[-1]) * fps) + 1
+    out = cv2.VideoWriter(video_path, fourcc, fps, size)
+    current = np.zeros((size[1], size[0], 3), dtype=np.uint8)
+    next_idx = 0
+    repeated = 0
+    for slot in range(slots):
+        slot_time = slot / fps
+        advanced = False
+        # Decode every frame in order, even ones sharing a slot: delta and repeat records need it
+        while next_idx < len(entries) and positions[next_idx] <= slot_time:
+            image = decode(entries[next_idx]["data"], next_idx)
+            if image is not None:
+                if (image.shape[1], image.shape[0]) != size:
+                    image = cv2.resize(image, size)
+                current = image
+                advanced = True
+            next_idx += 1
+        if not advanced and next_idx > 0:
+            repeated += 1
+        out.write(current)
+    out.release()
+    print(f"Aligned to audio clock: {slots} slots at {fps:.2f} fps, first frame at {positions[0]:+.3f}s of audio, "
+          f"{repeated} repeated slots, {len(entries) - next_idx} frames past the end")
+
+
+def _make_stream_video(frames, patient_id, current_time, audio_bytes=None, mux_audio=True, label="",
+                       size=(640, 480), decode=None, audio_clock=None):
+    if decode is None and _is_h264_stream(frames):
+        _remux_h264_stream(frames, patient_id, current_time, audio_bytes, mux_audio, label, audio_clock)
+        return
+    width, height = size
+    if decode is None:
+        decode = FrameDecoder().decode
 
     structured_frames = []
     for idx, source in enumerate(frames):
-        if isinstance(source, tuple) and len(source) == 2:
-            ts_us, buffer_bytes = source
+        if isinstance(source, tuple) and len(source) >= 2:
+            ts_us, buffer_bytes = source[0], source[1]
         else:
             ts_us = None
             buffer_bytes = source
-        if not buffer_bytes:
+        if buffer_bytes is None or len(buffer_bytes) == 0:
             continue
         structured_frames.append({
             "idx": idx,
@@ -77,7 +427,7 @@ def make_video_from_frames(frames, patient_id, audio_bytes=None, mux_audio=True)
         return
 
     fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-    video_path = f'output_{current_time}_{patient_id}.mp4'
+    video_path = f'output_{current_time}_{patient_id}{label}.mp4'
 
     ts_values = [entry["ts"] for entry in filtered_frames if entry["ts"] is not None]
     delta_values = []
@@ -85,119 +435,110 @@ def make_video_from_frames(frames, patient_id, audio_bytes=None, mux_audio=True)
         delta = ts_values[i] - ts_values[i - 1]
         if delta > 0:
             delta_values.append(delta)
-    median_delta = _compute_median(delta_values)
+    interval_us = _capture_interval_us(delta_values)
     capture_span_us = ts_values[-1] - ts_values[0] if len(ts_values) >= 2 else None
     capture_span_sec = (capture_span_us / 1e6) if capture_span_us and capture_span_us > 0 else None
     audio_duration = _audio_duration_seconds(audio_bytes) if audio_bytes else None
 
-    expected_interval_us = None
-    if median_delta and median_delta > 0:
-        expected_interval_us = median_delta
-    elif capture_span_sec and len(ts_values) > 1:
-        expected_interval_us = int((capture_span_sec * 1e6) / (len(ts_values) - 1))
-    elif audio_duration and len(filtered_frames) > 1:
-        expected_interval_us = int((audio_duration * 1e6) / (len(filtered_frames) - 1))
-
-    target_duration_sec = None
-    if audio_duration and audio_duration > 0:
-        target_duration_sec = audio_duration
-    elif capture_span_sec and capture_span_sec > 0:
-        target_duration_sec = capture_span_sec
-    elif expected_interval_us and expected_interval_us > 0:
-        target_duration_sec = (expected_interval_us / 1e6) * len(filtered_frames)
+    if audio_clock is not None and audio_duration and len(ts_values) == len(filtered_frames) > 1:
+        # Exact alignment: every frame is placed at its capture time on the audio clock
+        _write_aligned_video(filtered_frames, decode, audio_clock, audio_duration, interval_us,
+                             video_path, fourcc, (width, height))
     else:
-        target_duration_sec = len(filtered_frames) / 15.0 if len(filtered_frames) > 0 else 1.0
+        expected_interval_us = None
+        if interval_us and interval_us > 0:
+            expected_interval_us = interval_us
+        elif capture_span_sec and len(ts_values) > 1:
+            expected_interval_us = int((capture_span_sec * 1e6) / (len(ts_values) - 1))
+        elif audio_duration and len(filtered_frames) > 1:
+            expected_interval_us = int((audio_duration * 1e6) / (len(filtered_frames) - 1))
 
-    fill_plan = [0] * len(filtered_frames)
-    planned_fill = 0
-    if expected_interval_us:
-        last_ts = None
-        GAP_TOLERANCE = 1.2
-        MAX_DUP_FILL = 180
-        for idx, entry in enumerate(filtered_frames):
-            ts = entry["ts"]
-            if ts is not None and last_ts is not None:
-                gap_us = ts - last_ts
-                if gap_us > expected_interval_us * GAP_TOLERANCE:
-                    missing = int(round(gap_us / expected_interval_us)) - 1
+        target_duration_sec = None
+        if audio_duration and audio_duration > 0:
+            target_duration_sec = audio_duration
+        elif capture_span_sec and capture_span_sec > 0:
+            target_duration_sec = capture_span_sec
+        elif expected_interval_us and expected_interval_us > 0:
+            target_duration_sec = (expected_interval_us / 1e6) * len(filtered_frames)
+        else:
+            target_duration_sec = len(filtered_frames) / 15.0 if len(filtered_frames) > 0 else 1.0
+
+        fill_plan = [0] * len(filtered_frames)
+        planned_fill = 0
+        if expected_interval_us:
+            first_ts = None
+            last_slot = None
+            MAX_DUP_FILL = 180
+            for idx, entry in enumerate(filtered_frames):
+                ts = entry["ts"]
+                if ts is None:
+                    continue
+                if first_ts is None:
+                    first_ts = ts
+                # Slots on the capture timeline rather than gap by gap, so a stretch at a
+                # lower frame rate repeats frames without drifting
+                slot = int(round((ts - first_ts) / expected_interval_us))
+                if last_slot is not None:
+                    missing = slot - last_slot - 1
                     if missing > 0:
                         capped = min(missing, MAX_DUP_FILL)
                         fill_plan[idx] = capped
                         planned_fill += capped
-            if ts is not None:
-                last_ts = ts
+                    slot = max(slot, last_slot + 1)
+                last_slot = slot
 
-    planned_total_frames = len(filtered_frames) + planned_fill
-    if not target_duration_sec or target_duration_sec <= 0:
-        target_duration_sec = max(1.0, len(filtered_frames) / 15.0)
-    fps = planned_total_frames / target_duration_sec if target_duration_sec > 0 else 15.0
-    fps = max(1.0, min(60.0, fps))
+        planned_total_frames = len(filtered_frames) + planned_fill
+        if not target_duration_sec or target_duration_sec <= 0:
+            target_duration_sec = max(1.0, len(filtered_frames) / 15.0)
+        fps = planned_total_frames / target_duration_sec if target_duration_sec > 0 else 15.0
+        fps = max(1.0, min(60.0, fps))
 
-    if not expected_interval_us and fps:
-        expected_interval_us = int(1e6 / fps)
+        if not expected_interval_us and fps:
+            expected_interval_us = int(1e6 / fps)
 
-    out = cv2.VideoWriter(video_path, fourcc, fps, (width, height))
+        out = cv2.VideoWriter(video_path, fourcc, fps, (width, height))
 
-    last_ts = None
-    duplicates_inserted = 0
-    estimated_missing = 0
-    frames_written = 0
-    last_frame_image = None
-
-    for idx, entry in enumerate(filtered_frames):
-        frame_data = entry["data"]
-        # Skip empty or obviously invalid buffers to avoid OpenCV assertion
-        if not frame_data or len(frame_data) < 16:
-            print(f"Skipping frame {idx}: empty or too small buffer ({0 if not frame_data else len(frame_data)} bytes)")
-            continue
-        try:
-            np_data = np.frombuffer(frame_data, dtype=np.uint8)
-            if np_data.size == 0:
-                print(f"Skipping frame {idx}: empty decoded buffer")
+        last_ts = None
+        duplicates_inserted = 0
+        estimated_missing = 0
+        frames_written = 0
+        last_frame_image = None
+
+        for idx, entry in enumerate(filtered_frames):
+            image = decode(entry["data"], idx)
+            if image is None:
                 continue
-            image = cv2.imdecode(np_data, cv2.IMREAD_COLOR)
-        except Exception as e:
-            print(f"Skipping frame {idx}: imdecode error: {e}")
-            continue
-        if image is None:
-            print(f"Skipping frame {idx}: decode returned None")
-            continue
-        # Ensure 3 channels BGR
-        if len(image.shape) == 2:
-            image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
-        elif image.shape[2] == 1:
-            image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
-        # Ensure size is consistent
-        if (image.shape[1], image.shape[0]) != (width, height):
-            image = cv2.resize(image, (width, height))
-        if expected_interval_us and last_ts is not None and entry["ts"] is not None and last_frame_image is not None:
-            requested_fill = fill_plan[idx] if idx < len(fill_plan) else 0
-            if requested_fill > 0:
-                for _ in range(requested_fill):
-                    out.write(last_frame_image)
-                duplicates_inserted += requested_fill
-                estimated_missing += requested_fill
-        out.write(image)
-        frames_written += 1
-        if entry["ts"] is not None:
-            last_ts = entry["ts"]
-        last_frame_image = image
+            # Ensure size is consistent
+            if (image.shape[1], image.shape[0]) != (width, height):
+                image = cv2.resize(image, (width, height))
+            if expected_interval_us and last_ts is not None and entry["ts"] is not None and last_frame_image is not None:
+                requested_fill = fill_plan[idx] if idx < len(fill_plan) else 0
+                if requested_fill > 0:
+                    for _ in range(requested_fill):
+                        out.write(last_frame_image)
+                    duplicates_inserted += requested_fill
+                    estimated_missing += requested_fill
+            out.write(image)
+            frames_written += 1
+            if entry["ts"] is not None:
+                last_ts = entry["ts"]
+            last_frame_image = image
 
-    out.release()
-    total_frames_output = frames_written + duplicates_inserted
-    if duplicates_inserted:
-        print(f"Inserted {duplicates_inserted} placeholder frames (planned {planned_fill}) to cover ~{estimated_missing} missing intervals.")
-    if capture_span_sec:
-        print(f"Capture span: {capture_span_sec:.2f}s, target fps: {fps:.2f}, frames written: {total_frames_output}")
-    elif audio_duration:
-        print(f"Audio duration: {audio_duration:.2f}s, target fps: {fps:.2f}, frames written: {total_frames_output}")
-    else:
-        print(f"Frames written: {total_frames_output}, fps fallback: {fps:.2f}")
+        out.release()
+        total_frames_output = frames_written + duplicates_inserted
+        if duplicates_inserted:
+            print(f"Inserted {duplicates_inserted} placeholder frames (planned {planned_fill}) to cover ~{estimated_missing} missing intervals.")
+        if capture_span_sec:
+            print(f"Capture span: {capture_span_sec:.2f}s, target fps: {fps:.2f}, frames written: {total_frames_output}")
+        elif audio_duration:
+            print(f"Audio duration: {audio_duration:.2f}s, target fps: {fps:.2f}, frames written: {total_frames_output}")
+        else:
+            print(f"Frames written: {total_frames_output}, fps fallback: {fps:.2f}")
 
     if audio_bytes:
         try:
             # Persist audio to a WAV file for debugging and reuse it for muxing
-            audio_path = f'audio_{current_time}_{patient_id}.wav'
+            audio_path = f'audio_{current_time}_{patient_id}{label}.wav'
             with open(audio_path, 'wb') as f:
                 f.write(audio_bytes)
 
@@ -206,7 +547,7 @@ def make_video_from_frames(frames, patient_id, audio_bytes=None, mux_audio=True)
 
             if mux_audio:
                 # Mux using ffmpeg if available
-                output_path = f'output_{current_time}_{patient_id}_with_audio.mp4'
+                output_path = f'output_{current_time}_{patient_id}{label}_with_audio.mp4'
                 ffmpeg_cmd = [
                     'ffmpeg', '-y',
                     '-i', video_path,
@@ -1,8 +1,11 @@
+import os
+import struct
 import sys
-import wave
+import threading
 from array import array
-from io import BytesIO
 import numpy as np
+from audio_timeline import pack_timeline, pack_trailer, SEGMENTS_MAGIC
+from voice_activity import VoiceActivityDetector
 
 
 PY2 = sys.version_info[0] == 2
@@ -34,15 +37,86 @@ def _as_bytes(chunk):
         return tmp.tostring()
 
 
-def _join_chunks(chunks):
-    normalized = [_as_bytes(chunk) for chunk in chunks]
-    if PY2:
-        return ''.join(normalized)
-    return b''.join(normalized)
+def _timestamp_us(timestamp):
+    # ALAudioDevice passes [seconds, microseconds]
+    try:
+        return int(timestamp[0]) * 1000000 + int(timestamp[1])
+    except (TypeError, IndexError):
+        return int(timestamp or 0)
+
+
+# Canonical 44-byte PCM WAV header
+_WAV_HEADER = struct.Struct('<4sI4s4sIHHIIHH4sI')
+
+
+def _wav_header(data_bytes, sample_rate, channels=1, sample_width=2):
+    return _WAV_HEADER.pack(b'RIFF', 36 + data_bytes, b'WAVE', b'fmt ', 16, 1, channels, sample_rate,
+                            sample_rate * channels * sample_width, channels * sample_width, sample_width * 8,
+                            b'data', data_bytes)
+
+
+class MonoArena(object):
+    """
+    Growable mono int16 buffer that downmixes each ALAudioDevice buffer as it
+    arrives. Samples live in a bytearray behind room for the WAV header, so
+    finishing a recording is a single slice of header, audio and trailer.
+    """
+
+    def __init__(self, initial_samples=48000 * 30):
+        self._buf = bytearray(_WAV_HEADER.size + 2 * initial_samples)
+        self._samples = np.frombuffer(self._buf, dtype=np.int16, offset=_WAV_HEADER.size)
+        self._acc = np.empty(0, dtype=np.int32)
+        self.length = 0
+
+    def _reserve(self, count):
+        needed = self.length + count
+        if needed <= len(self._samples):
+            return
+        capacity = max(2 * len(self._samples), needed)
+        buf = bytearray(_WAV_HEADER.size + 2 * capacity)
+        samples = np.frombuffer(buf, dtype=np.int16, offset=_WAV_HEADER.size)
+        samples[:self.length] = self._samples[:self.length]
+        self._buf, self._samples = buf, samples
+
+    def append(self, samples, nb_channels):
+        """Downmix and append; returns the view of the new mono samples (valid until the next append)."""
+        nb_channels = max(1, nb_channels)
+        count = len(samples) // nb_channels
+        self._reserve(count)
+        out = self._samples[self.length:self.length + count]
+        if nb_channels == 1:
+            out[:] = samples[:count]
+        else:
+            if len(self._acc) < count:
+                self._acc = np.empty(count, dtype=np.int32)
+            acc = self._acc[:count]
+            # Integer mean: int32 sum, floor divide, then narrow into the arena
+            np.sum(samples[:count * nb_channels].reshape(count, nb_channels), axis=1, dtype=np.int32, out=acc)
+            np.floor_divide(acc, nb_channels, out=acc)
+            out[:] = acc
+        self.length += count
+        return out
+
+    def to_wav(self, sample_rate, trailer=b''):
+        """
+        Finish as a WAV file followed by ``trailer`` (e.g. the audio timeline);
+        the arena cannot be appended to afterwards.
+        """
+        data_bytes = 2 * self.length
+        self._reserve((len(trailer) + 1) // 2)
+        buf = self._buf
+        buf[:_WAV_HEADER.size] = _wav_header(data_bytes, sample_rate)
+        end = _WAV_HEADER.size + data_bytes
+        buf[end:end + len(trailer)] = trailer
+        self._samples = None
+        self._buf = None
+        # A slice, not a resize: views from append() may still be alive (resizing
+        # then raises BufferError, or on Python 2 may leave them dangling)
+        return buf[:end + len(trailer)]
 
 
 class SoundReceiverModule(object):
-    """Minimal audio capture for Pepper; mixes 4 channels at 48 kHz down to mono WAV."""
+    """Minimal audio capture for Pepper; mixes 4 channels at 48 kHz down to mono WAV as buffers arrive."""
 
     def __init__(self, session, name="SoundReceiverModule"):
         super(SoundReceiverModule, self).__init__()
@@ -50,19 +124,66 @@ class SoundReceiverModule(object):
         self.module_name = name
         self.sample_rate = 48000
         self.default_channels = 4
-        self.chunks = []
+        self.arena = None
+        # (mono sample offset, NAOqi timestamp_us) per buffer, sent with the audio for A/V alignment
+        self.timeline = []
+        # processRemote runs on NAOqi's thread; stop() must not finish the arena or the
+        # streamer mid-append
+        self._arena_lock = threading.Lock()
         self.is_recording = False
         self.last_nb_channels = self.default_channels
-
-    def start(self):
+        # Optional AudioStreamer: mono buffers also go to the operator as they arrive, so
+        # stop() only waits for the tail; self.arena is kept until the stream is confirmed
+        self.streamer = None
+        # Optional AudioArchive: raw interleaved buffers of every channel, kept as they arrive
+        self.archive = None
+        # Optional AudioMonitor: live listening, independent of recording; keeps us subscribed
+        self.monitor = None
+        self.subscribed = False
+        # Speech segments of the recording, sent with the audio (PEPPER_VAD=0 disables)
+        self.vad = None
+
+    def _subscribe(self):
+        if self.subscribed:
+            return
         try:
             self.audio_service.closeAudioInputs()
         except Exception:
             pass
+        self.audio_service.setClientPreferences(self.module_name, self.sample_rate, self.default_channels, 0)
+        self.audio_service.subscribe(self.module_name)
+        self.subscribed = True
+
+    def _unsubscribe(self):
+        if not self.subscribed or self.monitor is not None:
+            return
+        try:
+            self.audio_service.unsubscribe(self.module_name)
+        except Exception:
+            pass
+        self.subscribed = False
+
+    def start_monitor(self, monitor):
+        self.monitor = monitor
+        try:
+            self._subscribe()
+        except Exception as exc:
+            print("[SoundReceiver] monitor start error: {}".format(exc))
+
+    def stop_monitor(self):
+        monitor, self.monitor = self.monitor, None
+        if monitor is not None:
+            monitor.stop()
+        if not self.is_recording:
+            self._unsubscribe()
+
+    def start(self):
         try:
-            self.audio_service.setClientPreferences(self.module_name, self.sample_rate, self.default_channels, 0)
-            self.audio_service.subscribe(self.module_name)
-            self.chunks = []
+            self._subscribe()
+            self.arena = MonoArena(self.sample_rate * 30)
+            self.timeline = []
+            vad_flag = os.getenv('PEPPER_VAD', '1').strip().lower()
+            self.vad = VoiceActivityDetector(self.sample_rate) if vad_flag not in ('0', 'false', 'no', 'off') else None
             self.is_recording = True
         except Exception as exc:
             print("[SoundReceiver] start error: {}".format(exc))
@@ -72,56 +193,50 @@ class SoundReceiverModule(object):
         if not self.is_recording:
             return None
         self.is_recording = False
-        try:
-            self.audio_service.unsubscribe(self.module_name)
-        except Exception:
-            pass
-        if not self.chunks:
+        self._unsubscribe()
+        with self._arena_lock:
+            # A processRemote already past is_recording finds nothing to feed after this
+            arena, self.arena = self.arena, None
+            streamer, self.streamer = self.streamer, None
+            vad, self.vad = self.vad, None
+        if self.archive is not None:
+            self.archive.close()
+            print("Audio archive {}: {} bytes".format(self.archive.path, self.archive.bytes_written))
+            self.archive = None
+        segments = b''
+        if vad is not None:
+            segments = pack_trailer(SEGMENTS_MAGIC, vad.finish())
+            print("Voice activity: {} segments".format(len(vad.segments)))
+        if streamer is not None:
+            if streamer.finish(segments):
+                return None
+            print("[SoundReceiver] audio stream incomplete; sending the recording instead")
+        if arena is None or arena.length == 0:
             return None
-        raw_bytes = _join_chunks(self.chunks)
-        self.chunks = []
-        nb_channels = int(self.last_nb_channels or 1)
-        return self._to_wav(raw_bytes, nb_channels)
-
-    def _to_wav(self, audio_bytes, nb_channels):
-        samples_np = np.frombuffer(audio_bytes, dtype=np.int16)
-
-        if nb_channels > 1:
-            try:
-                samples_np = samples_np.reshape(-1, nb_channels)
-                mono_np = samples_np.mean(axis=1).astype(np.int16)
-            
-            except ValueError as e:
-                # Handle potential partial buffer
-                print("Audio buffer warning (reshape failed): {}. Truncating.".format(e))
-                cutoff = (len(samples_np) // nb_channels) * nb_channels
-                samples_np = samples_np[:cutoff].reshape(-1, nb_channels)
-                mono_np = samples_np.mean(axis=1).astype(np.int16)
-        else:
-            mono_np = samples_np
-        
-        if hasattr(mono_np, "tobytes"):
-            mono_bytes = mono_np.tobytes()
-        else:
-            mono_bytes = mono_np.tostring() # Python 2 fallback
-
-        buf = BytesIO()
-        wav = wave.open(buf, 'wb')
-        wav.setnchannels(1)
-        wav.setsampwidth(2)
-        wav.setframerate(self.sample_rate)
-        wav.writeframes(mono_bytes)
-        wav.close()
-        data = buf.getvalue()
-        buf.close()
-        return data
-
+        return arena.to_wav(self.sample_rate, segments + pack_timeline(self.timeline))
 
     def processRemote(self, nbOfChannels, nbrOfSamplesByChannel, timestamp, buffer):
         self.last_nb_channels = nbOfChannels or self.default_channels
-        if not self.is_recording:
+        monitor = self.monitor
+        if not self.is_recording and monitor is None:
             return
         try:
-            self.chunks.append(_as_bytes(buffer))
+            raw = _as_bytes(buffer)
+            if monitor is not None:
+                monitor.send(raw, int(self.last_nb_channels or 1))
+            if not self.is_recording:
+                return
+            if self.archive is not None:
+                self.archive.append(raw)
+            samples = np.frombuffer(raw, dtype=np.int16)
+            with self._arena_lock:
+                if self.arena is not None:
+                    timestamp_us = _timestamp_us(timestamp)
+                    self.timeline.append((self.arena.length, timestamp_us))
+                    mono = self.arena.append(samples, int(self.last_nb_channels or 1))
+                    if self.streamer is not None:
+                        self.streamer.send(timestamp_us, _as_bytes(mono))
+                    if self.vad is not None:
+                        self.vad.process(mono)
         except Exception:
             pass
@@ -0,0 +1,119 @@
+import threading
+from capture_stats import clock
+
+
+class AdaptiveRateController(object):
+    """
+    Closed-loop JPEG quality / frame-rate control driven by the depth of the
+    outgoing frame queue and the throughput the UDP sender actually achieves.
+
+    Under pressure quality is lowered first, then frame rate. When the link
+    clears the steps are undone in reverse order (frame rate first, then
+    quality). Every change is logged with the frame it applies from.
+    """
+
+    def __init__(self, quality=80, fps=15, min_quality=40, max_quality=None,
+                 min_fps=5, max_fps=None, quality_step=10, fps_step=2,
+                 high_water=30, low_water=5, hold_frames=15, enabled=True):
+        self.max_quality = int(max_quality if max_quality is not None else quality)
+        self.min_quality = int(min(min_quality, self.max_quality))
+        self.max_fps = int(max_fps if max_fps is not None else fps)
+        self.min_fps = int(min(min_fps, self.max_fps))
+        self.quality_step = max(1, int(quality_step))
+        self.fps_step = max(1, int(fps_step))
+        self.high_water = high_water
+        self.low_water = low_water
+        # Frames to wait after a change before reacting again, so the queue can respond
+        self.hold_frames = hold_frames
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Start a new recording at the upper bounds with a fresh change log."""
+        with self._lock:
+            self.quality = self.max_quality
+            self.fps = self.max_fps
+            self.changes = []
+            self._frames_since_change = 0
+            self._produced_bytes = 0
+            self._sent_bytes = 0
+            self._window_start = clock()
+            self.produced_rate = 0.0
+            self.sent_rate = 0.0
+
+    def note_sent(self, nbytes):
+        """Called by the sender for every frame that left the robot."""
+        with self._lock:
+            self._sent_bytes += nbytes
+
+    def observe(self, frame_index, timestamp_us, frame_bytes, queue_depth):
+        """
+        Called once per encoded frame, in capture order. Returns True when
+        quality or frame rate changed.
+        """
+        with self._lock:
+            self._produced_bytes += frame_bytes
+            self._update_rates()
+            if not self.enabled:
+                return False
+            self._frames_since_change += 1
+            if self._frames_since_change < self.hold_frames:
+                return False
+            old_quality, old_fps = self.quality, self.fps
+            if queue_depth >= self.high_water:
+                self._step_down()
+                reason = "pressure"
+            elif queue_depth <= self.low_water and self.sent_rate >= 0.9 * self.produced_rate:
+                self._step_up()
+                reason = "clear"
+            else:
+                return False
+            if (self.quality, self.fps) == (old_quality, old_fps):
+                return False
+            self._frames_since_change = 0
+            change = {
+                "frame": frame_index,
+                "timestamp_us": timestamp_us,
+                "quality": (old_quality, self.quality),
+                "fps": (old_fps, self.fps),
+                "queue_depth": queue_depth,
+                "sent_rate": self.sent_rate,
+                "produced_rate": self.produced_rate,
+                "reason": reason,
+            }
+            self.changes.append(change)
+        print("[RateControl] frame {} ts={}: quality {}->{} fps {}->{} ({}, queue={}, sent {:.0f} kB/s, produced {:.0f} kB/s)".format(
+            frame_index, timestamp_us, old_quality, self.quality, old_fps, self.fps, reason,
+            queue_depth, self.sent_rate / 1024.0, self.produced_rate / 1024.0))
+        return True
+
+    def _step_down(self):
+        if self.quality > self.min_quality:
+            self.quality = max(self.min_quality, self.quality - self.quality_step)
+        elif self.fps > self.min_fps:
+            self.fps = max(self.min_fps, self.fps - self.fps_step)
+
+    def _step_up(self):
+        if self.fps < self.max_fps:
+            self.fps = min(self.max_fps, self.fps + self.fps_step)
+        elif self.quality < self.max_quality:
+            self.quality = min(self.max_quality, self.quality + self.quality_step)
+
+    def _update_rates(self):
+        # Byte rates over roughly one-second windows, smoothed
+        now = clock()
+        elapsed = now - self._window_start
+        if elapsed < 1.0:
+            return
+        alpha = 0.5
+        self.produced_rate = alpha * (self._produced_bytes / elapsed) + (1 - alpha) * self.produced_rate
+        self.sent_rate = alpha * (self._sent_bytes / elapsed) + (1 - alpha) * self.sent_rate
+        self._produced_bytes = 0
+        self._sent_bytes = 0
+        self._window_start = now
+
+    def report(self):
+        print("[RateControl] {} change(s); final quality={} fps={} (bounds quality {}-{}, fps {}-{})".format(
+            len(self.changes), self.quality, self.fps,
+            self.min_quality, self.max_quality, self.min_fps, self.max_fps))
@@ -0,0 +1,51 @@
+import os
+import struct
+import threading
+import time
+from session_spool import spool_dir
+
+
+# Multichannel archive: this header, then interleaved little-endian int16 frames exactly as
+# ALAudioDevice delivers them. The length follows from the file size, so the header is
+# written once and the file is only ever appended to.
+ARCHIVE_HEADER = struct.Struct('!4sIH2x')   # magic, sample rate, channels
+ARCHIVE_MAGIC = b'PMC0'
+
+
+class AudioArchive(object):
+    """
+    Keeps every microphone channel of a recording on the robot's flash for
+    source localisation. Buffers are appended as they arrive; the file is
+    pushed to the operator's bulk port after the session like a spool.
+    """
+
+    def __init__(self, sample_rate, channels, session_id=None, directory=None):
+        self.session_id = session_id or str(int(time.time() * 1000))
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.path = os.path.join(directory or spool_dir(), 'audio_{}.pmc'.format(self.session_id))
+        self._file = open(self.path, 'wb')
+        self._file.write(ARCHIVE_HEADER.pack(ARCHIVE_MAGIC, sample_rate, channels))
+        self._lock = threading.Lock()
+        self.bytes_written = 0
+
+    def append(self, pcm_bytes):
+        with self._lock:
+            if self._file is not None:
+                self._file.write(pcm_bytes)
+                self.bytes_written += len(pcm_bytes)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def size(self):
+        return os.path.getsize(self.path)
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
@@ -0,0 +1,127 @@
+#!/usr/bin/env python2
+"""
+Benchmark of the legacy vs. current SoundReceiverModule recording paths
+against session length. Feeds synthetic 4-channel 48 kHz buffers the way
+ALAudioDevice calls processRemote, then reports stop() latency and, where
+tracemalloc is available (Python 3.9+), peak traced memory over the whole
+session including stop(). With --codecs each available audio codec is run
+on the recorded WAV: compression ratio and encode CPU seconds.
+
+    python audio_benchmark.py --seconds 10 60 300
+    python audio_benchmark.py --seconds 60 --codecs
+"""
+import argparse
+import wave
+from io import BytesIO
+import numpy as np
+from SoundReciver_py2 import MonoArena, _as_bytes
+from capture_stats import clock
+from audio_codecs import available_audio_codecs, get_audio_codec, encode_audio
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2.7 on the robot
+    tracemalloc = None
+
+SAMPLE_RATE = 48000
+CHANNELS = 4
+SAMPLES_PER_BUFFER = 4096
+
+
+class LegacyRecorder(object):
+    """The pre-arena path: keep every raw buffer, join + float mean + BytesIO copy at stop."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def process(self, buffer):
+        self.chunks.append(_as_bytes(buffer))
+
+    def stop(self):
+        samples = np.frombuffer(b"".join(self.chunks), dtype=np.int16)
+        self.chunks = []
+        mono = samples.reshape(-1, CHANNELS).mean(axis=1).astype(np.int16)
+        buf = BytesIO()
+        wav = wave.open(buf, 'wb')
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(SAMPLE_RATE)
+        wav.writeframes(mono.tobytes())
+        wav.close()
+        return buf.getvalue()
+
+
+class ArenaRecorder(object):
+    def __init__(self):
+        self.arena = MonoArena(SAMPLE_RATE * 30)
+
+    def process(self, buffer):
+        self.arena.append(np.frombuffer(buffer, dtype=np.int16), CHANNELS)
+
+    def stop(self):
+        return self.arena.to_wav(SAMPLE_RATE)
+
+
+def make_speech_like_wav(seconds):
+    """Mono WAV of tones plus low noise; random noise alone would defeat FLAC."""
+    rng = np.random.RandomState(0)
+    t = np.arange(int(seconds * SAMPLE_RATE)) / float(SAMPLE_RATE)
+    signal = 4000 * np.sin(2 * np.pi * 220 * t) * (0.5 + 0.5 * np.sin(2 * np.pi * 0.7 * t))
+    signal += rng.normal(0, 200, len(t))
+    arena = MonoArena(len(t))
+    arena.append(signal.clip(-32768, 32767).astype(np.int16), 1)
+    return arena.to_wav(SAMPLE_RATE)
+
+
+def run_codecs(seconds):
+    wav_bytes = make_speech_like_wav(seconds)
+    print("{:<8} {:>8} {:>12} {:>8} {:>10}".format("codec", "seconds", "bytes", "ratio", "cpu s"))
+    for name in available_audio_codecs():
+        payload, cpu_seconds = encode_audio(wav_bytes, get_audio_codec(name))
+        print("{:<8} {:>8} {:>12} {:>8.2f} {:>10.2f}".format(
+            name, seconds, len(payload), len(wav_bytes) / float(len(payload)), cpu_seconds))
+
+
+def make_buffer():
+    rng = np.random.RandomState(0)
+    return rng.randint(-3000, 3000, SAMPLES_PER_BUFFER * CHANNELS).astype(np.int16).tobytes()
+
+
+def run_session(recorder_cls, seconds, buffer):
+    buffers = int(seconds * SAMPLE_RATE / SAMPLES_PER_BUFFER)
+    if tracemalloc is not None:
+        tracemalloc.start()
+    recorder = recorder_cls()
+    for _ in range(buffers):
+        # ALAudioDevice hands over a fresh buffer each call
+        recorder.process(bytes(bytearray(buffer)))
+    started = clock()
+    wav_bytes = recorder.stop()
+    stop_ms = (clock() - started) * 1000.0
+    peak = None
+    if tracemalloc is not None:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return stop_ms, peak, len(wav_bytes)
+
+
+def run(session_lengths):
+    buffer = make_buffer()
+    print("{:<8} {:>8} {:>12} {:>14} {:>12}".format("path", "seconds", "stop ms", "peak MB", "wav bytes"))
+    for seconds in session_lengths:
+        for name, recorder_cls in (("legacy", LegacyRecorder), ("arena", ArenaRecorder)):
+            stop_ms, peak, size = run_session(recorder_cls, seconds, buffer)
+            peak_s = "n/a" if peak is None else "{:.1f}".format(peak / 1048576.0)
+            print("{:<8} {:>8} {:>12.2f} {:>14} {:>12}".format(name, seconds, stop_ms, peak_s, size))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='SoundReceiverModule recording benchmark')
+    parser.add_argument('--seconds', type=int, nargs='+', default=[10, 60, 300], help='Session lengths to simulate')
+    parser.add_argument('--codecs', action='store_true', help='Benchmark the audio codecs instead of the recording path')
+    args = parser.parse_args()
+    if args.codecs:
+        for seconds in args.seconds:
+            run_codecs(seconds)
+    else:
+        run(args.seconds)
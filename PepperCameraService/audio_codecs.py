@@ -0,0 +1,209 @@
+import os
+import struct
+import subprocess
+from io import BytesIO
+import numpy as np
+from frame_compresser import _find_executable
+from audio_timeline import trailers_length
+
+
+# Self-describing like the frame payloads: the operator recognises WAV ('RIFF'),
+# FLAC ('fLaC') and the IMA-ADPCM container below from the first bytes.
+ADPCM_MAGIC = b'IMA0'
+ADPCM_HEADER = struct.Struct('!4sIBI')     # magic, sample rate, channels, samples per channel
+ADPCM_BLOCK_HEADER = struct.Struct('!hB')  # first sample (exact), step index
+ADPCM_BLOCK_SAMPLES = 4096
+
+_IMA_INDEX_TABLE = [-1, -1, -1, -1, 2, 4, 6, 8] * 2
+_IMA_STEP_TABLE = [
+    7, 8, 9, 10, 11, 12, 13, 14, 16, 17, 19, 21, 23, 25, 28, 31, 34, 37, 41, 45,
+    50, 55, 60, 66, 73, 80, 88, 97, 107, 118, 130, 143, 157, 173, 190, 209, 230,
+    253, 279, 307, 337, 371, 408, 449, 494, 544, 598, 658, 724, 796, 876, 963,
+    1060, 1166, 1282, 1411, 1552, 1707, 1878, 2066, 2272, 2499, 2749, 3024, 3327,
+    3660, 4026, 4428, 4871, 5358, 5894, 6484, 7132, 7845, 8630, 9493, 10442,
+    11487, 12635, 13899, 15289, 16818, 18500, 20350, 22385, 24623, 27086, 29794,
+    32767,
+]
+
+
+def _wav_format(wav_bytes):
+    """(sample_rate, channels, data offset, data bytes) of a canonical 16-bit PCM WAV, or None."""
+    if len(wav_bytes) < 44 or bytes(wav_bytes[:4]) != b'RIFF' or bytes(wav_bytes[36:40]) != b'data':
+        return None
+    channels, sample_rate = struct.unpack_from('<HI', bytes(wav_bytes[22:28]))
+    data_bytes = struct.unpack_from('<I', bytes(wav_bytes[40:44]))[0]
+    return sample_rate, channels, 44, min(data_bytes, len(wav_bytes) - 44)
+
+
+class AudioCodec(object):
+    """Encodes interleaved int16 PCM for the transfer to the operator."""
+    name = None
+
+    @classmethod
+    def is_available(cls):
+        return True
+
+    def encode(self, samples, sample_rate, channels):
+        raise NotImplementedError
+
+
+_CODECS = {}
+
+
+def register_audio_codec(cls):
+    _CODECS[cls.name] = cls
+    return cls
+
+
+def available_audio_codecs():
+    return [name for name, cls in sorted(_CODECS.items()) if cls.is_available()]
+
+
+def get_audio_codec(name):
+    cls = _CODECS.get(name)
+    if cls is None or not cls.is_available():
+        print("Audio codec {!r} not available; using 'wav'".format(name))
+        cls = _CODECS['wav']
+    return cls()
+
+
+@register_audio_codec
+class WavCodec(AudioCodec):
+    """Uncompressed; encode_audio passes the WAV through untouched."""
+    name = 'wav'
+
+
+@register_audio_codec
+class FlacCodec(AudioCodec):
+    """Lossless, via pysoundfile when installed, otherwise an ffmpeg subprocess."""
+    name = 'flac'
+
+    @classmethod
+    def is_available(cls):
+        try:
+            import soundfile  # noqa: F401
+            return True
+        except (ImportError, OSError):
+            return _find_executable('ffmpeg') is not None
+
+    def encode(self, samples, sample_rate, channels):
+        try:
+            import soundfile
+            buf = BytesIO()
+            soundfile.write(buf, samples.reshape(-1, channels), sample_rate, format='FLAC', subtype='PCM_16')
+            return buf.getvalue()
+        except (ImportError, OSError):
+            pass
+        process = subprocess.Popen([
+            'ffmpeg', '-loglevel', 'error', '-f', 's16le', '-ar', str(sample_rate), '-ac', str(channels), '-i', '-',
+            '-f', 'flac', '-'
+        ], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        data, _ = process.communicate(samples.tobytes())
+        if process.returncode != 0 or not data:
+            raise Exception("ffmpeg FLAC encode failed")
+        return data
+
+
+_STEPS = np.array(_IMA_STEP_TABLE, dtype=np.int32)
+_INDEX_STEPS = np.array(_IMA_INDEX_TABLE, dtype=np.int32)
+
+
+def _ima_start_index(blocks):
+    """Step index for each block's start: the step nearest its opening sample-to-sample changes."""
+    opening = blocks[:, :9].astype(np.int32)
+    change = np.abs(np.diff(opening, axis=1)).sum(axis=1) / max(1, opening.shape[1] - 1)
+    return np.minimum(np.searchsorted(_STEPS, change), 88).astype(np.int32)
+
+
+def _ima_encode_blocks(blocks, index):
+    """
+    IMA-ADPCM for every block at once: blocks[:, 0] is each block's exact first
+    sample and blocks[:, 1:] are encoded from it, starting at step ``index``.
+    Returns the nibbles packed two to a byte, low nibble first: shape
+    (n, length // 2) + the blocks' trailing shape (channels).
+    """
+    length = blocks.shape[1]
+    predictor = blocks[:, 0].astype(np.int32)
+    index = index.copy()
+    packed = np.zeros((blocks.shape[0], length // 2) + blocks.shape[2:], dtype=np.uint8)
+    for position in range(1, length):
+        step = _STEPS[index]
+        diff = blocks[:, position].astype(np.int32) - predictor
+        nibble = (diff < 0).astype(np.int32) << 3
+        diff = np.abs(diff)
+        delta = step >> 3
+        for bit in (4, 2, 1):
+            hit = diff >= step
+            nibble |= hit * bit
+            diff -= hit * step
+            delta += hit * step
+            step = step >> 1
+        predictor = np.where(nibble & 8, np.maximum(-32768, predictor - delta),
+                             np.minimum(32767, predictor + delta))
+        index = np.clip(index + _INDEX_STEPS[nibble], 0, 88)
+        if position % 2:
+            packed[:, position // 2] = nibble
+        else:
+            packed[:, position // 2 - 1] |= (nibble << 4).astype(np.uint8)
+    return packed
+
+
+@register_audio_codec
+class ImaAdpcmCodec(AudioCodec):
+    """
+    4:1 lossy IMA-ADPCM in numpy, so it runs on the robot's Python 2.7
+    without extra libraries. The step adaptation is sequential within a
+    block, but every block restarts from an exact sample and its own
+    estimated step, so all blocks of a recording are encoded together and
+    the Python loop is one block long whatever the session length. A
+    corrupt block stays local.
+    """
+    name = 'adpcm'
+
+    def encode(self, samples, sample_rate, channels):
+        count = len(samples) // channels
+        frames = samples[:count * channels].reshape(count, channels)
+        parts = [ADPCM_HEADER.pack(ADPCM_MAGIC, sample_rate, channels, count)]
+        full = count // ADPCM_BLOCK_SAMPLES
+        # Block-major, then channel: the order the operator reads the blocks in
+        groups = [frames[:full * ADPCM_BLOCK_SAMPLES].reshape(full, ADPCM_BLOCK_SAMPLES, channels)]
+        if count % ADPCM_BLOCK_SAMPLES:
+            groups.append(frames[full * ADPCM_BLOCK_SAMPLES:][np.newaxis])
+        for blocks in groups:
+            if not len(blocks):
+                continue
+            index = _ima_start_index(blocks)
+            packed = _ima_encode_blocks(blocks, index)
+            for block in range(len(blocks)):
+                for channel in range(channels):
+                    parts.append(ADPCM_BLOCK_HEADER.pack(int(blocks[block, 0, channel]), int(index[block, channel])))
+                    parts.append(packed[block, :, channel].tobytes())
+        return b''.join(parts)
+
+
+def encode_audio(wav_bytes, codec):
+    """
+    Encode a recording from SoundReceiverModule with ``codec`` (an AudioCodec).
+    Returns (payload, cpu seconds). The WAV is passed through on 'wav' or if
+    encoding fails, which the operator handles transparently. A trailing audio
+    timeline and segment index are carried over unchanged.
+    """
+    audio_format = _wav_format(wav_bytes) if wav_bytes else None
+    if codec.name == 'wav' or audio_format is None:
+        return wav_bytes, 0.0
+    sample_rate, channels, offset, data_bytes = audio_format
+    trailer = bytes(wav_bytes[len(wav_bytes) - trailers_length(wav_bytes):])
+    samples = np.frombuffer(wav_bytes, dtype=np.int16, count=data_bytes // 2, offset=offset)
+    cpu_started = _cpu_seconds()
+    try:
+        payload = codec.encode(samples, sample_rate, channels)
+    except Exception as e:
+        print("Audio codec {} failed, sending WAV: {}".format(codec.name, e))
+        return wav_bytes, 0.0
+    return payload + trailer, _cpu_seconds() - cpu_started
+
+
+def _cpu_seconds():
+    # Includes the ffmpeg child process when FLAC falls back to it
+    times = os.times()
+    return times[0] + times[1] + times[2] + times[3]
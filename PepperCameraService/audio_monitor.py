@@ -0,0 +1,112 @@
+import socket
+import struct
+import threading
+import time
+from collections import deque
+import numpy as np
+
+
+# Per packet: magic, sequence number, capture time of the first sample and send time
+# (both robot wall clock, us), sample count; then mono int16 samples at the monitor rate
+MONITOR_HEADER = struct.Struct('!4sIQQH')
+MONITOR_MAGIC = b'PMON'
+# Clock probes from the operator, echoed with the robot's time appended: magic, operator time
+PING_HEADER = struct.Struct('!4sQ')
+PING_MAGIC = b'PPNG'
+PONG_MAGIC = b'PPON'
+
+
+class AudioMonitor(threading.Thread):
+    """
+    Live, best-effort audio for the operator to listen to. ``send`` only
+    queues the raw ALAudioDevice buffer (bounded, oldest dropped) and wakes
+    this thread, which mixes it to mono, decimates 48 kHz to 16 kHz and
+    sends 20 ms UDP packets. A second thread blocks on the socket to answer
+    the operator's clock probes, from which the operator measures
+    mouth-to-ear latency. Neither polls. Independent of the recording path:
+    nothing here touches the arena, the streamer or the spool.
+    """
+
+    def __init__(self, target, sample_rate=48000, decimation=3, frame_ms=20, max_queued=16):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.target = target
+        self.sample_rate = sample_rate
+        self.decimation = decimation
+        self.frame_samples = sample_rate // decimation * frame_ms // 1000
+        self._queue = deque(maxlen=max_queued)
+        self._ready = threading.Condition()
+        self._seq = 0
+        # Set before start(), so a stop() that comes first is not lost
+        self.running = True
+        self.packets_sent = 0
+        self.buffers_dropped = 0
+
+    def send(self, raw_bytes, nb_channels):
+        """Called from processRemote; must stay cheap."""
+        with self._ready:
+            if len(self._queue) == self._queue.maxlen:
+                self.buffers_dropped += 1
+            self._queue.append((time.time(), raw_bytes, nb_channels))
+            self._ready.notify()
+
+    def stop(self):
+        with self._ready:
+            self.running = False
+            self._ready.notify()
+
+    def run(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # Only bounds how long the ping thread takes to notice stop()
+        sock.settimeout(0.5)
+        pings = threading.Thread(target=self._answer_pings, args=(sock,))
+        pings.daemon = True
+        pings.start()
+        try:
+            while True:
+                with self._ready:
+                    # No timeout: Python 2.7's timed wait polls
+                    while self.running and not self._queue:
+                        self._ready.wait()
+                    if not self.running:
+                        break
+                    buffers = list(self._queue)
+                    self._queue.clear()
+                for received_at, raw_bytes, nb_channels in buffers:
+                    self._send_buffer(sock, received_at, raw_bytes, max(1, nb_channels))
+        finally:
+            pings.join()
+            sock.close()
+
+    def _answer_pings(self, sock):
+        while self.running:
+            try:
+                data, addr = sock.recvfrom(64)
+            except socket.timeout:
+                continue
+            except socket.error:
+                return
+            if len(data) == PING_HEADER.size and data[:4] == PING_MAGIC:
+                sock.sendto(PONG_MAGIC + data[4:] + struct.pack('!Q', int(time.time() * 1e6)), addr)
+
+    def _send_buffer(self, sock, received_at, raw_bytes, nb_channels):
+        samples = np.frombuffer(raw_bytes, dtype=np.int16)
+        group = nb_channels * self.decimation
+        count = len(samples) // group
+        if count == 0:
+            return
+        # Mono mix and box-filter decimation in one integer mean over channels x decimation
+        mono = (samples[:count * group].reshape(count, group).sum(axis=1, dtype=np.int32) // group).astype(np.int16)
+        # ALAudioDevice calls back once the buffer is full: its first sample is one buffer old
+        output_rate = self.sample_rate // self.decimation
+        first_capture_us = int(received_at * 1e6) - count * 1000000 // output_rate
+        for start in range(0, count, self.frame_samples):
+            frame = mono[start:start + self.frame_samples]
+            capture_us = first_capture_us + start * 1000000 // output_rate
+            header = MONITOR_HEADER.pack(MONITOR_MAGIC, self._seq, capture_us, int(time.time() * 1e6), len(frame))
+            try:
+                sock.sendto(header + frame.tobytes(), self.target)
+                self.packets_sent += 1
+            except socket.error:
+                pass
+            self._seq += 1
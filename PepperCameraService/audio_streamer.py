@@ -0,0 +1,112 @@
+import socket
+import struct
+import threading
+import time
+from collections import deque
+
+
+# Per packet: magic, sequence number, NAOqi capture timestamp (us), payload length
+PACKET_HEADER = struct.Struct('!4sIQI')
+AUDIO_MAGIC = b'PAUD'
+# The end packet's payload is the recording's trailers (e.g. the voice activity segments), if any
+END_MAGIC = b'PEND'
+# The operator's answer once the end packet and everything before it are on its disk
+END_ACK = b'AUDIO_OK\n'
+# First line on the connection: "AUDIO_SESSION <id> <sample_rate> <channels>\n"
+
+
+class AudioStreamer(threading.Thread):
+    """
+    Sends audio to the operator while recording, over its own TCP connection
+    so recording-quality audio is never lost. ``send`` is called from
+    ALAudioDevice's processRemote and only queues (bounded, oldest dropped);
+    this thread does the blocking socket writes. ``finish`` flushes the
+    queue, sends the end packet and waits for the operator's END_ACK; the
+    stream is complete only if that came back and nothing was dropped.
+    """
+
+    def __init__(self, target, sample_rate, channels=1, session_id=None, max_queued=1024):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.target = target
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.session_id = session_id or str(int(time.time() * 1000))
+        # ~90 s of 4096-sample buffers: the operator's connection stalled if it fills
+        self._queue = deque(maxlen=max_queued)
+        self._wakeup = threading.Condition()
+        self._finishing = False
+        self._trailer = b''
+        self._seq = 0
+        self.bytes_sent = 0
+        self.packets_sent = 0
+        self.buffers_dropped = 0
+        self.failed = False
+        self.confirmed = False
+
+    def send(self, timestamp_us, pcm_bytes):
+        if self.failed:
+            return
+        with self._wakeup:
+            if self._finishing or len(self._queue) == self._queue.maxlen:
+                # After finish the end packet may already be out; either way the stream has a gap
+                self.buffers_dropped += 1
+                if self._finishing:
+                    return
+            self._queue.append((self._seq, timestamp_us, pcm_bytes))
+            self._seq += 1
+            self._wakeup.notify()
+
+    def finish(self, trailer=b'', timeout=10.0):
+        with self._wakeup:
+            self._trailer = trailer
+            self._finishing = True
+            self._wakeup.notify()
+        self.join(timeout)
+        complete = self.confirmed and not self.buffers_dropped
+        print("Audio stream {}: {} packets, {} bytes, {} dropped{}".format(
+            self.session_id, self.packets_sent, self.bytes_sent, self.buffers_dropped,
+            "" if complete else " (INCOMPLETE)"))
+        return complete
+
+    def run(self):
+        sock = None
+        try:
+            sock = socket.create_connection(self.target, timeout=10)
+            sock.sendall("AUDIO_SESSION {} {} {}\n".format(self.session_id, self.sample_rate, self.channels).encode('utf-8'))
+            while True:
+                with self._wakeup:
+                    # No timeout: Python 2.7's timed wait polls
+                    while not self._queue and not self._finishing:
+                        self._wakeup.wait()
+                    batch = list(self._queue)
+                    self._queue.clear()
+                    done = self._finishing and not batch
+                if done:
+                    sock.sendall(PACKET_HEADER.pack(END_MAGIC, self._seq, 0, len(self._trailer)) + self._trailer)
+                    self.confirmed = self._read_ack(sock)
+                    break
+                for seq, timestamp_us, pcm_bytes in batch:
+                    sock.sendall(PACKET_HEADER.pack(AUDIO_MAGIC, seq, int(timestamp_us), len(pcm_bytes)))
+                    sock.sendall(pcm_bytes)
+                    self.bytes_sent += len(pcm_bytes)
+                    self.packets_sent += 1
+        except Exception as e:
+            print("Audio stream failed:", e)
+            self.failed = True
+        finally:
+            if sock is not None:
+                try:
+                    sock.close()
+                except Exception:
+                    pass
+
+    @staticmethod
+    def _read_ack(sock):
+        reply = b''
+        while not reply.endswith(b'\n') and len(reply) < len(END_ACK):
+            data = sock.recv(len(END_ACK) - len(reply))
+            if not data:
+                break
+            reply += data
+        return reply == END_ACK
@@ -0,0 +1,35 @@
+import struct
+
+
+# Indexes appended as trailers to the recording's audio payload (any codec): entries, then a
+# footer naming them. Parsers that read the audio by its own length fields (RIFF, FLAC, IMA0)
+# never see them; the operator strips them first, last trailer first.
+TRAILER_ENTRY = struct.Struct('!QQ')      # two unsigned values per entry, see the magics
+TRAILER_FOOTER = struct.Struct('!4sI')    # magic, entry count
+TIMELINE_MAGIC = b'PTIM'   # (mono sample offset, NAOqi capture timestamp us), one per buffer
+SEGMENTS_MAGIC = b'PVAD'   # (start sample, end sample) of each voice activity segment
+TRAILER_MAGICS = (TIMELINE_MAGIC, SEGMENTS_MAGIC)
+
+
+def pack_trailer(magic, entries):
+    parts = [TRAILER_ENTRY.pack(first, second) for first, second in entries]
+    parts.append(TRAILER_FOOTER.pack(magic, len(entries)))
+    return b''.join(parts)
+
+
+def pack_timeline(entries):
+    """Trailer bytes for [(sample offset, timestamp_us), ...]."""
+    return pack_trailer(TIMELINE_MAGIC, entries)
+
+
+def trailers_length(data):
+    """Total length of the known trailers at the end of ``data``, 0 if there are none."""
+    total = 0
+    while len(data) - total >= TRAILER_FOOTER.size:
+        end = len(data) - total
+        magic, count = TRAILER_FOOTER.unpack(bytes(data[end - TRAILER_FOOTER.size:end]))
+        length = count * TRAILER_ENTRY.size + TRAILER_FOOTER.size
+        if magic not in TRAILER_MAGICS or length > end:
+            break
+        total += length
+    return total
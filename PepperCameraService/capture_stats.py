@@ -0,0 +1,122 @@
+import ctypes
+import ctypes.util
+import os
+import threading
+import time
+
+
+class _Timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+def _monotonic_clock():
+    """time.monotonic; on the robot's Python 2.7, CLOCK_MONOTONIC through ctypes.
+    Wall-clock time only if neither is available."""
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    CLOCK_MONOTONIC = 1
+    for name in ('rt', 'c'):
+        try:
+            clock_gettime = ctypes.CDLL(ctypes.util.find_library(name), use_errno=True).clock_gettime
+        except (OSError, AttributeError):
+            continue
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+
+        def monotonic():
+            ts = _Timespec()
+            if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+                errno = ctypes.get_errno()
+                raise OSError(errno, os.strerror(errno))
+            return ts.tv_sec + ts.tv_nsec * 1e-9
+        try:
+            monotonic()
+        except OSError:
+            continue
+        return monotonic
+    print("No monotonic clock available; capture timing follows the wall clock")
+    return time.time
+
+
+# Deadlines and durations must not jump when NTP steps the wall clock
+clock = _monotonic_clock()
+
+
+class TimingStat(object):
+    """Thread-safe running count/mean/min/max of a duration in seconds."""
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = 0.0
+
+    def add(self, seconds):
+        with self._lock:
+            self.count += 1
+            self.total += seconds
+            if self.min is None or seconds < self.min:
+                self.min = seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def summary(self):
+        if not self.count:
+            return "{}: n=0".format(self.name)
+        return "{}: n={} mean={:.2f}ms min={:.2f}ms max={:.2f}ms".format(
+            self.name, self.count, self.mean() * 1000.0, self.min * 1000.0, self.max * 1000.0)
+
+
+class RecorderStats(object):
+    """
+    Timings collected by PepperCameraRecorder over one recording. The
+    encode workers update theirs under the recorder's _reorder_lock; the
+    rest belong to the capture thread.
+    """
+
+    def __init__(self, target_fps=None):
+        self.target_fps = target_fps
+        self.grab = TimingStat("grab")
+        self.queue_wait = TimingStat("queue wait")
+        self.encode = TimingStat("encode")
+        self.jitter = TimingStat("jitter")
+        self.overruns = 0
+        self.skipped_slots = 0
+        self.duplicates = 0
+        self.repeats = 0
+        self.frames_out = 0
+        self.encode_errors = 0
+        self.started_at = None
+        self.stopped_at = None
+
+    def start(self):
+        self.started_at = clock()
+        self.stopped_at = None
+
+    def stop(self):
+        self.stopped_at = clock()
+
+    def elapsed(self):
+        if self.started_at is None:
+            return 0.0
+        end = self.stopped_at if self.stopped_at is not None else clock()
+        return max(0.0, end - self.started_at)
+
+    def achieved_fps(self):
+        elapsed = self.elapsed()
+        return self.frames_out / elapsed if elapsed > 0 else 0.0
+
+    def report(self):
+        print("[Recorder] frames={} errors={} elapsed={:.2f}s achieved fps={:.2f} (subscribed {})".format(
+            self.frames_out, self.encode_errors, self.elapsed(), self.achieved_fps(), self.target_fps))
+        print("[Recorder] overruns={} skipped slots={} duplicate grabs={} static repeats={}".format(
+            self.overruns, self.skipped_slots, self.duplicates, self.repeats))
+        for stat in (self.grab, self.queue_wait, self.encode, self.jitter):
+            print("[Recorder] " + stat.summary())
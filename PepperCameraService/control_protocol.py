@@ -0,0 +1,35 @@
+import json
+
+
+# Framed control connection, opted into during codec negotiation: the operator appends
+# CONTROL_OPTION to its 'codec' reply, and a robot that knows it answers CONTROL_ACCEPT.
+# From then on every request is one JSON object per line ({"id", "cmd"[, "text"]}), so
+# back-to-back commands never merge and a long text never splits. Each request is
+# acknowledged twice on the same connection, between the robot's other lines:
+#   {"id", "ack": "received", "ts"}                      when read
+#   {"id", "ack": "done" | "error", "ts", "exec_ms"}     when executed
+# ts is the robot's wall clock. Replies are the only robot lines starting with '{'.
+CONTROL_OPTION = 'control=json'
+CONTROL_ACCEPT = b'CONTROL:json\n'
+
+
+def pack_message(message):
+    return (json.dumps(message, separators=(',', ':')) + '\n').encode('utf-8')
+
+
+class LineReader(object):
+    """Newline-terminated lines from a socket, through one buffer however TCP splits or merges them."""
+
+    def __init__(self, sock, buffered=b''):
+        self.sock = sock
+        self._buffer = buffered
+
+    def read_line(self):
+        """The next line without its newline, or None once the connection is closed."""
+        while b'\n' not in self._buffer:
+            data = self.sock.recv(4096)
+            if not data:
+                return None
+            self._buffer += data
+        line, self._buffer = self._buffer.split(b'\n', 1)
+        return line
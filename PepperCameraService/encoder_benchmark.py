@@ -0,0 +1,140 @@
+#!/usr/bin/env python2
+"""
+Benchmark every available frame encoder backend on the same set of frames:
+encode wall and CPU ms/frame (CPU includes an ffmpeg child process),
+bytes/frame and, where the operator's code can be imported (Python 3 with
+PepperApp next to this directory), decode ms/frame. With --finalize the
+operator's make_video_from_frames is timed end to end for each backend
+(JPEG decodes and re-encodes, H.264 only remuxes).
+
+    python encoder_benchmark.py --capture 100      # grab frames from the robot's camera
+    python encoder_benchmark.py --images ./frames  # JPEG/PNG files captured earlier
+    python encoder_benchmark.py                    # synthetic frames
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import cv2
+import numpy as np
+from frame_compresser import available_encoders, get_encoder, BGR_COLORSPACE
+from capture_stats import clock
+
+try:
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'PepperApp'))
+    from frame_codecs import FrameDecoder
+    from video_maker_old import make_video_from_frames
+except Exception:  # Python 2.7 on the robot, or PepperApp not deployed
+    FrameDecoder = None
+    make_video_from_frames = None
+
+
+def capture_frames(count):
+    import qi
+    session = qi.Session()
+    session.connect("tcp://127.0.0.1:9559")
+    video_device = session.service("ALVideoDevice")
+    handle = video_device.subscribeCamera("kamera_bench", 0, 2, BGR_COLORSPACE, 15)
+    frames = []
+    try:
+        while len(frames) < count:
+            image = video_device.getImageRemote(handle)
+            if image is None:
+                continue
+            frames.append(np.frombuffer(image[6], dtype=np.uint8).reshape((image[1], image[0], 3)).copy())
+            time.sleep(1.0 / 15)
+    finally:
+        video_device.unsubscribe(handle)
+    return frames
+
+
+def load_frames(directory):
+    frames = []
+    for name in sorted(os.listdir(directory)):
+        image = cv2.imread(os.path.join(directory, name), cv2.IMREAD_COLOR)
+        if image is not None:
+            frames.append(image)
+    return frames
+
+
+def synthetic_frames(count, width=640, height=480):
+    # A slowly moving gradient with sensor noise, roughly like a still WoZ scene
+    rng = np.random.RandomState(0)
+    base = np.linspace(0, 255, width, dtype=np.float32)[None, :, None]
+    frames = []
+    for i in range(count):
+        noise = rng.normal(0, 6, (height, width, 3))
+        frames.append((np.roll(base, i, axis=1) + noise).clip(0, 255).astype(np.uint8))
+    return frames
+
+
+def _cpu_seconds():
+    times = os.times()
+    return times[0] + times[1] + times[2] + times[3]
+
+
+def time_finalize(payloads, fps=15):
+    """Wall seconds for make_video_from_frames on these payloads, run in a scratch directory."""
+    frames = [(int(i * 1e6 / fps), payload) for i, payload in enumerate(payloads)]
+    cwd = os.getcwd()
+    scratch = tempfile.mkdtemp(prefix='pepper_bench_')
+    try:
+        os.chdir(scratch)
+        started = clock()
+        make_video_from_frames(frames, 0, None, False)
+        return clock() - started
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+def run(frames, quality, finalize=False):
+    print("{} frames of {}x{}, quality {}".format(len(frames), frames[0].shape[1], frames[0].shape[0], quality))
+    header = "{:<10} {:>10} {:>10} {:>12} {:>10}".format("backend", "encode ms", "cpu ms", "bytes/frame", "decode ms")
+    if finalize:
+        header += " {:>12}".format("finalize s")
+    print(header)
+    for name in available_encoders():
+        encoder = get_encoder(name)
+        payloads = []
+        started = clock()
+        cpu_started = _cpu_seconds()
+        for image in frames:
+            payloads.append(encoder.encode(image, quality))
+        encoder.close()
+        encode_ms = (clock() - started) * 1000.0 / len(frames)
+        cpu_ms = (_cpu_seconds() - cpu_started) * 1000.0 / len(frames)
+        mean_bytes = sum(len(p) for p in payloads) / float(len(payloads))
+        decode_ms = "n/a"
+        if FrameDecoder is not None and name != 'h264':
+            decoder = FrameDecoder()
+            started = clock()
+            for idx, payload in enumerate(payloads):
+                decoder.decode(payload, idx)
+            decode_ms = "{:.2f}".format((clock() - started) * 1000.0 / len(payloads))
+        line = "{:<10} {:>10.2f} {:>10.2f} {:>12.0f} {:>10}".format(name, encode_ms, cpu_ms, mean_bytes, decode_ms)
+        if finalize and make_video_from_frames is not None:
+            line += " {:>12.2f}".format(time_finalize(payloads))
+        print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Frame encoder backend benchmark')
+    parser.add_argument('--capture', type=int, default=0, help='Grab this many frames from the camera')
+    parser.add_argument('--images', type=str, default=None, help='Directory of captured frames')
+    parser.add_argument('--frames', type=int, default=60, help='Synthetic frame count')
+    parser.add_argument('--quality', type=int, default=80, help='JPEG quality')
+    parser.add_argument('--finalize', action='store_true', help='Also time the operator-side video finalize per backend')
+    args = parser.parse_args()
+    if args.capture:
+        frames = capture_frames(args.capture)
+    elif args.images:
+        frames = load_frames(args.images)
+    else:
+        frames = synthetic_frames(args.frames)
+    if not frames:
+        print("No frames to benchmark.")
+        sys.exit(1)
+    run(frames, args.quality, args.finalize)
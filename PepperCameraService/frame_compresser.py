@@ -1,23 +1,390 @@
+import os
+import struct
+import subprocess
+import threading
+import zlib
 import cv2
 import numpy as np
 
 
-def compress_frame_data(frame_data, quality=80):
-    width = frame_data[0]
-    height = frame_data[1]
-    raw_bytes = frame_data[6]
+# NAOqi colorspace ids (ALImage field 3)
+RGB_COLORSPACE = 11
+BGR_COLORSPACE = 13
+DEPTH_COLORSPACE = 17
+
+_ENCODE_PARAMS = {}
+# Conversion buffers are reused per encoder thread, never shared between threads
+_scratch = threading.local()
+
+
+def _encode_params(quality):
+    params = _ENCODE_PARAMS.get(quality)
+    if params is None:
+        params = [int(cv2.IMWRITE_JPEG_QUALITY), int(quality)]
+        _ENCODE_PARAMS[quality] = params
+    return params
+
+
+def _bgr_scratch(shape):
+    buf = getattr(_scratch, 'bgr', None)
+    if buf is None or buf.shape != shape:
+        buf = np.empty(shape, dtype=np.uint8)
+        _scratch.bgr = buf
+    return buf
+
+
+class FrameEncoder(object):
+    """
+    Encodes one BGR uint8 image into a self-describing payload. The operator
+    recognises the format from the payload itself (JPEG/PNG signatures or the
+    4-byte magics below), so a fallback on the robot can never desync it.
+    Stateful encoders depend on the previous frame and must see frames in
+    order, so the recorder runs them on a single worker.
+    """
+    name = None
+    stateful = False
+    # Whether the operator can expand static-scene repeat records between this encoder's frames
+    allows_repeats = True
+
+    @classmethod
+    def is_available(cls):
+        return True
+
+    def encode(self, image, quality, stream_id=0):
+        raise NotImplementedError
+
+    def flush(self):
+        """Output the encoder still holds once the last frame is in, as one more payload, or None."""
+        return None
+
+    def close(self):
+        pass
+
+
+_ENCODERS = {}
+
+
+def register_encoder(cls):
+    _ENCODERS[cls.name] = cls
+    return cls
+
+
+def available_encoders():
+    return [name for name, cls in sorted(_ENCODERS.items()) if cls.is_available()]
+
+
+def get_encoder(name):
+    cls = _ENCODERS.get(name)
+    if cls is None or not cls.is_available():
+        print("Frame encoder {!r} not available; using 'jpeg'".format(name))
+        cls = _ENCODERS['jpeg']
+    return cls()
+
+
+@register_encoder
+class OpenCVJpegEncoder(FrameEncoder):
+    name = 'jpeg'
+
+    def encode(self, image, quality, stream_id=0):
+        result, encimg = cv2.imencode('.jpg', image, _encode_params(quality))
+        if not result:
+            raise Exception("Nie udalo sie zakodowac obrazu")
+        return encimg.tobytes()
+
+
+@register_encoder
+class TurboJpegEncoder(FrameEncoder):
+    name = 'turbojpeg'
+    _turbo = None
+
+    @classmethod
+    def is_available(cls):
+        if cls._turbo is None:
+            try:
+                from turbojpeg import TurboJPEG
+                cls._turbo = TurboJPEG()
+            except Exception:
+                cls._turbo = False
+        return bool(cls._turbo)
+
+    def encode(self, image, quality, stream_id=0):
+        from turbojpeg import TJPF_BGR
+        return self._turbo.encode(image, quality=int(quality), pixel_format=TJPF_BGR)
+
+
+@register_encoder
+class PngEncoder(FrameEncoder):
+    """Lossless; for debugging image quality problems."""
+    name = 'png'
 
-    np_arr = np.frombuffer(bytearray(raw_bytes), dtype=np.uint8)
-    image = np_arr.reshape((height, width, 3))
-    image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+    def encode(self, image, quality, stream_id=0):
+        # Lowest compression level: PNG here is about fidelity, not size
+        result, encimg = cv2.imencode('.png', image, [int(cv2.IMWRITE_PNG_COMPRESSION), 1])
+        if not result:
+            raise Exception("Nie udalo sie zakodowac obrazu")
+        return encimg.tobytes()
 
-    encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), quality]
-    result, encimg = cv2.imencode('.jpg', image, encode_param)
 
-    if not result:
-        raise Exception("Nie udalo sie zakodowac obrazu")
+RAW_MAGIC = b'RAW0'
+DELTA_MAGIC = b'DLT1'
+_RAW_HEADER = struct.Struct('!4sHHB')      # magic, width, height, channels
+_DELTA_HEADER = struct.Struct('!4sHHBBII') # magic, width, height, channels, keyframe, frame seq, reference seq
+
+
+@register_encoder
+class RawEncoder(FrameEncoder):
+    """Uncompressed BGR with a small header; for debugging only."""
+    name = 'raw'
+
+    def encode(self, image, quality, stream_id=0):
+        height, width = image.shape[:2]
+        return _RAW_HEADER.pack(RAW_MAGIC, width, height, image.shape[2]) + image.tobytes()
+
+
+@register_encoder
+class DeltaEncoder(FrameEncoder):
+    """
+    Lossless inter-frame codec: zlib of the byte-wise difference to the
+    previous frame, with a full keyframe every ``keyframe_interval`` frames.
+    Needs only numpy and zlib, so it runs on the robot's Python 2.7.
+    Each frame carries its sequence number and that of its reference, so
+    the operator can tell when a lost frame broke the chain.
+    """
+    name = 'delta'
+    stateful = True
+    keyframe_interval = 30
+
+    def __init__(self):
+        self._previous = {}
+        self._since_key = {}
+        self._seq = {}
+
+    def encode(self, image, quality, stream_id=0):
+        height, width = image.shape[:2]
+        previous = self._previous.get(stream_id)
+        since_key = self._since_key.get(stream_id, 0)
+        keyframe = previous is None or previous.shape != image.shape or since_key >= self.keyframe_interval
+        if keyframe:
+            body = image
+            self._since_key[stream_id] = 0
+        else:
+            # uint8 subtraction wraps modulo 256, which the decoder undoes by adding
+            body = image - previous
+            self._since_key[stream_id] = since_key + 1
+        self._previous[stream_id] = image.copy()
+        seq = (self._seq.get(stream_id, -1) + 1) & 0xFFFFFFFF
+        self._seq[stream_id] = seq
+        reference = seq if keyframe else (seq - 1) & 0xFFFFFFFF
+        header = _DELTA_HEADER.pack(DELTA_MAGIC, width, height, image.shape[2], 1 if keyframe else 0, seq, reference)
+        return header + zlib.compress(body.tobytes(), 1)
+
+
+H264_MAGIC = b'AVC2'
+# magic, access unit seq (gaps mean lost payloads; seq n is the call that encoded frame n),
+# number of the first picture in the payload (pictures are numbered in encoding order)
+_H264_HEADER = struct.Struct('!4sII')
+
+
+def h264_picture_starts(nal_units):
+    """
+    Offsets in Annex B ``nal_units`` where a picture begins: at the SEI, SPS,
+    PPS or access unit delimiter ahead of its first slice, or at that slice
+    (first_mb_in_slice 0, a leading 1 bit). Must match PepperApp/frame_codecs.py.
+    """
+    data = bytearray(nal_units)
+    starts = []
+    prefix = None       # first non-slice NAL unit since the last slice
+    pos = data.find(b'\x00\x00\x01')
+    while 0 <= pos < len(data) - 3:
+        begin = pos - 1 if pos > 0 and data[pos - 1] == 0 else pos
+        nal_type = data[pos + 3] & 0x1F
+        if nal_type in (6, 7, 8, 9):
+            if prefix is None:
+                prefix = begin
+        elif nal_type in (1, 5):
+            if pos + 4 < len(data) and data[pos + 4] & 0x80:
+                starts.append(prefix if prefix is not None else begin)
+            prefix = None
+        pos = data.find(b'\x00\x00\x01', pos + 3)
+    return starts
+
+
+def _find_executable(name):
+    for directory in os.getenv('PATH', '').split(os.pathsep):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+
+@register_encoder
+class H264Encoder(FrameEncoder):
+    """
+    Inter-frame H.264 (Annex B, no B-frames, keyframe every ``gop`` frames).
+    Each payload is ``AVC2``, a sequence number, the number of its first
+    picture and whole pictures' NAL units, so the operator can concatenate
+    and remux them without decoding, resume at the next IDR after a lost
+    payload, and tell which frame each picture is even when the encoder's
+    output lags a frame behind its input. Uses PyAV
+    when installed, otherwise an ffmpeg subprocess; the primary stream only.
+    """
+    name = 'h264'
+    stateful = True
+    allows_repeats = False
+    gop = 30
+    fps = 15
+
+    @classmethod
+    def is_available(cls):
+        try:
+            import av  # noqa: F401
+            return True
+        except ImportError:
+            return _find_executable('ffmpeg') is not None
+
+    def __init__(self):
+        self._stream_id = None
+        self._codec = None
+        self._process = None
+        self._reader = None
+        self._output = []
+        self._output_lock = threading.Lock()
+        self._seq = 0
+        self._pictures = 0      # pictures handed out so far
+
+    def _payload(self, nal_units):
+        payload = _H264_HEADER.pack(H264_MAGIC, self._seq, self._pictures) + nal_units
+        self._seq = (self._seq + 1) & 0xFFFFFFFF
+        self._pictures = (self._pictures + len(h264_picture_starts(nal_units))) & 0xFFFFFFFF
+        return payload
+
+    def _crf(self, quality):
+        # JPEG-style quality 0-100 onto x264 CRF 51-0 (80 -> 23)
+        return max(0, min(51, int(round(51 - quality * 0.35))))
+
+    def _open(self, image, quality):
+        height, width = image.shape[:2]
+        try:
+            import av
+            from fractions import Fraction
+            codec = av.CodecContext.create('libx264', 'w')
+            codec.width = width
+            codec.height = height
+            codec.pix_fmt = 'yuv420p'
+            codec.time_base = Fraction(1, self.fps)
+            codec.options = {'preset': 'ultrafast', 'tune': 'zerolatency', 'g': str(self.gop),
+                             'bf': '0', 'crf': str(self._crf(quality))}
+            self._codec = codec
+            return
+        except ImportError:
+            pass
+        self._process = subprocess.Popen([
+            'ffmpeg', '-loglevel', 'error',
+            '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', '{}x{}'.format(width, height), '-r', str(self.fps), '-i', '-',
+            '-c:v', 'libx264', '-preset', 'ultrafast', '-tune', 'zerolatency', '-g', str(self.gop), '-bf', '0',
+            '-crf', str(self._crf(quality)), '-f', 'h264', '-flush_packets', '1', '-'
+        ], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self._reader = threading.Thread(target=self._read_output)
+        self._reader.daemon = True
+        self._reader.start()
+
+    def _read_output(self):
+        # Whole pictures only: a picture is complete once the next one starts (or at EOF)
+        fd = self._process.stdout.fileno()
+        pending = bytearray()
+        while True:
+            data = os.read(fd, 65536)
+            if not data:
+                with self._output_lock:
+                    if pending:
+                        self._output.append(bytes(pending))
+                return
+            pending += data
+            starts = h264_picture_starts(pending)
+            if starts and starts[-1] > 0:
+                with self._output_lock:
+                    self._output.append(bytes(pending[:starts[-1]]))
+                del pending[:starts[-1]]
+
+    def encode(self, image, quality, stream_id=0):
+        if self._stream_id is None:
+            self._stream_id = stream_id
+        elif stream_id != self._stream_id:
+            # One bitstream per encoder: secondary cameras fall back to JPEG
+            return _DEFAULT_ENCODER.encode(image, quality, stream_id)
+        if self._codec is None and self._process is None:
+            self._open(image, quality)
+        if self._codec is not None:
+            import av
+            frame = av.VideoFrame.from_ndarray(image, format='bgr24')
+            nal_units = b''.join(bytes(packet) for packet in self._codec.encode(frame))
+            return self._payload(nal_units)
+        self._process.stdin.write(image.tobytes())
+        self._process.stdin.flush()
+        # Never waits: whatever pictures the reader has completed go out now, usually the
+        # previous frame's, and the picture numbers tell the operator which frames they are
+        with self._output_lock:
+            nal_units = b''.join(self._output)
+            self._output = []
+        return self._payload(nal_units)
+
+    def flush(self):
+        # Drain the encoder: PyAV returns its delayed packets, ffmpeg writes them out on EOF
+        nal_units = b''
+        if self._codec is not None:
+            try:
+                nal_units = b''.join(bytes(packet) for packet in self._codec.encode(None))
+            except Exception as e:
+                print("Failed to flush the H.264 encoder: {}".format(e))
+            self._codec = None
+        elif self._process is not None:
+            try:
+                self._process.stdin.close()
+                self._process.wait()
+            except Exception as e:
+                print("Failed to flush the H.264 encoder: {}".format(e))
+            self._reader.join(2.0)
+            with self._output_lock:
+                nal_units = b''.join(self._output)
+                self._output = []
+            self._process = None
+        return self._payload(nal_units) if nal_units else None
+
+    def close(self):
+        if self._process is not None:
+            try:
+                self._process.stdin.close()
+                self._process.wait()
+            except Exception:
+                pass
+            self._process = None
+
+
+_DEFAULT_ENCODER = OpenCVJpegEncoder()
+
+
+def compress_frame_data(frame_data, quality=80, encoder=None, stream_id=0):
+    width = frame_data[0]
+    height = frame_data[1]
+    colorspace = frame_data[3]
+    raw_bytes = frame_data[6]
 
-    compressed_data = encimg.tobytes()
+    if colorspace == DEPTH_COLORSPACE:
+        # 16-bit depth would be ruined by JPEG; PNG keeps it lossless whatever the backend
+        image = np.frombuffer(raw_bytes, dtype=np.uint16).reshape((height, width))
+        result, encimg = cv2.imencode('.png', image)
+        if not result:
+            raise Exception("Nie udalo sie zakodowac obrazu")
+        compressed_data = encimg.tobytes()
+    else:
+        # View the NAOqi buffer in place; encoders only read from it
+        image = np.frombuffer(raw_bytes, dtype=np.uint8).reshape((height, width, 3))
+        if colorspace != BGR_COLORSPACE:
+            # Subscribed in RGB: convert into a reused buffer instead of a fresh array
+            image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR, dst=_bgr_scratch(image.shape))
+        if encoder is None:
+            encoder = _DEFAULT_ENCODER
+        compressed_data = encoder.encode(image, quality, stream_id)
 
     timestamp_sec = int(frame_data[4])
     timestamp_usec = int(frame_data[5])
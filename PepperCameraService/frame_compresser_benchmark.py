@@ -0,0 +1,75 @@
+#!/usr/bin/env python2
+"""
+Micro-benchmark of the legacy vs. current compress_frame_data paths on a
+synthetic VGA frame. Reports microseconds per frame and, where tracemalloc
+is available (Python 3.9+), peak bytes allocated per frame.
+
+    python frame_compresser_benchmark.py --frames 200
+"""
+import argparse
+import timeit
+import cv2
+import numpy as np
+from frame_compresser import compress_frame_data, RGB_COLORSPACE, BGR_COLORSPACE
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2.7 on the robot
+    tracemalloc = None
+
+
+def compress_frame_data_legacy(frame_data, quality=80):
+    """The pre zero-copy path: bytearray copy + RGB2BGR conversion per frame."""
+    width = frame_data[0]
+    height = frame_data[1]
+    np_arr = np.frombuffer(bytearray(frame_data[6]), dtype=np.uint8)
+    image = np_arr.reshape((height, width, 3))
+    image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+    result, encimg = cv2.imencode('.jpg', image, [int(cv2.IMWRITE_JPEG_QUALITY), quality])
+    return (int(frame_data[4]) * 1000000) + int(frame_data[5]), encimg.tobytes()
+
+
+def make_frame(colorspace, width=640, height=480):
+    rng = np.random.RandomState(0)
+    # Smooth gradient plus noise compresses roughly like a camera image
+    base = np.linspace(0, 255, width, dtype=np.float32)[None, :, None]
+    image = (base + rng.normal(0, 12, (height, width, 3))).clip(0, 255).astype(np.uint8)
+    return [width, height, 3, colorspace, 0, 0, image.tobytes()]
+
+
+def peak_allocation(func, frame, repeats):
+    """Mean peak of traced bytes allocated during one call (numpy arrays included)."""
+    if tracemalloc is None or not hasattr(tracemalloc, 'reset_peak'):
+        return None
+    func(frame)
+    tracemalloc.start()
+    total = 0
+    for _ in range(repeats):
+        baseline = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        func(frame)
+        total += tracemalloc.get_traced_memory()[1] - baseline
+    tracemalloc.stop()
+    return total / float(repeats)
+
+
+def run(frames):
+    cases = [
+        ("legacy (RGB, bytearray + cvtColor)", compress_frame_data_legacy, make_frame(RGB_COLORSPACE)),
+        ("current (RGB subscription)", compress_frame_data, make_frame(RGB_COLORSPACE)),
+        ("current (BGR subscription)", compress_frame_data, make_frame(BGR_COLORSPACE)),
+    ]
+    for name, func, frame in cases:
+        seconds = timeit.timeit(lambda: func(frame), number=frames)
+        line = "{:<38} {:8.1f} us/frame".format(name, seconds / frames * 1e6)
+        peak = peak_allocation(func, frame, min(frames, 50))
+        if peak is not None:
+            line += "  {:10.0f} B allocated/frame".format(peak)
+        print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='compress_frame_data micro-benchmark')
+    parser.add_argument('--frames', type=int, default=200, help='Frames per case')
+    args = parser.parse_args()
+    run(args.frames)
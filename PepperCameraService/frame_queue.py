@@ -0,0 +1,151 @@
+import os
+import struct
+import tempfile
+import threading
+from collections import deque
+from session_spool import spool_dir
+
+
+class FrameQueue(object):
+    """
+    FIFO of encoded ``(timestamp_us, payload, stream_id)`` frames with a memory cap.
+
+    Drop-in for the ``collections.deque`` the recorder and UDP sender used
+    (``append``, ``popleft``, ``len``). Once the queued JPEG bytes reach
+    ``max_bytes`` the queue either drops the oldest frames (policy ``drop``)
+    or appends new frames to a spill file on the robot's flash (policy
+    ``spill``). Spilled frames are served after the in-memory ones, so
+    capture order is kept, and the file is removed once drained.
+    """
+
+    _record_header = struct.Struct('!QIB')
+
+    def __init__(self, max_bytes=None, policy=None, spill_dir=None):
+        if max_bytes is None:
+            try:
+                max_bytes = int(float(os.getenv('PEPPER_FRAME_QUEUE_MB', '64')) * 1024 * 1024)
+            except ValueError:
+                max_bytes = 64 * 1024 * 1024
+        if policy is None:
+            policy = os.getenv('PEPPER_FRAME_QUEUE_POLICY', 'spill').strip().lower()
+        if policy not in ('drop', 'spill'):
+            print("Unknown frame queue policy {!r}; using 'spill'".format(policy))
+            policy = 'spill'
+        self.max_bytes = max(1, max_bytes)
+        self.policy = policy
+        self.spill_dir = spill_dir or os.getenv('PEPPER_SPILL_DIR')
+        self._lock = threading.Lock()
+        self._memory = deque()
+        self._memory_bytes = 0
+        self._spill_file = None
+        self._spill_path = None
+        self._spill_read_offset = 0
+        self._spill_count = 0
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self._lock:
+            self.high_water_frames = len(self._memory) + self._spill_count
+            self.high_water_bytes = self._memory_bytes
+            self.dropped_frames = 0
+            self.dropped_bytes = 0
+            self.spilled_frames = 0
+            self.spilled_bytes = 0
+
+    def __len__(self):
+        with self._lock:
+            return len(self._memory) + self._spill_count
+
+    def append(self, frame):
+        timestamp_us, payload, stream_id = frame
+        size = len(payload)
+        with self._lock:
+            if self._spill_count or self._memory_bytes + size > self.max_bytes:
+                if self.policy == 'spill':
+                    if self._spill(timestamp_us, payload, stream_id):
+                        self._update_high_water()
+                        return
+                    if self._spill_count:
+                        # Older frames are still on disk; queueing this one in memory would reorder
+                        self.dropped_frames += 1
+                        self.dropped_bytes += size
+                        return
+                # Drop oldest frames until the new one fits
+                while self._memory and self._memory_bytes + size > self.max_bytes:
+                    dropped = self._memory.popleft()[1]
+                    self._memory_bytes -= len(dropped)
+                    self.dropped_frames += 1
+                    self.dropped_bytes += len(dropped)
+            self._memory.append(frame)
+            self._memory_bytes += size
+            self._update_high_water()
+
+    def popleft(self):
+        with self._lock:
+            if self._memory:
+                frame = self._memory.popleft()
+                self._memory_bytes -= len(frame[1])
+                return frame
+            if self._spill_count:
+                return self._unspill()
+        raise IndexError("pop from an empty FrameQueue")
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._memory_bytes = 0
+            self._reset_spill()
+
+    def report(self):
+        print("[FrameQueue] high water: {} frames / {:.1f} MB (cap {:.1f} MB, policy {}); dropped {} frames ({:.1f} MB); spilled {} frames ({:.1f} MB)".format(
+            self.high_water_frames, self.high_water_bytes / 1048576.0, self.max_bytes / 1048576.0, self.policy,
+            self.dropped_frames, self.dropped_bytes / 1048576.0,
+            self.spilled_frames, self.spilled_bytes / 1048576.0))
+
+    def _update_high_water(self):
+        queued = len(self._memory) + self._spill_count
+        if queued > self.high_water_frames:
+            self.high_water_frames = queued
+        if self._memory_bytes > self.high_water_bytes:
+            self.high_water_bytes = self._memory_bytes
+
+    def _spill(self, timestamp_us, payload, stream_id):
+        try:
+            if self._spill_file is None:
+                fd, self._spill_path = tempfile.mkstemp(prefix='pepper_frames_', suffix='.spill', dir=self.spill_dir or spool_dir())
+                self._spill_file = os.fdopen(fd, 'w+b')
+                self._spill_read_offset = 0
+            self._spill_file.seek(0, os.SEEK_END)
+            self._spill_file.write(self._record_header.pack(int(timestamp_us), len(payload), stream_id))
+            self._spill_file.write(payload)
+            self._spill_file.flush()
+        except Exception as e:
+            print("Failed to spill frame to disk, dropping instead: {}".format(e))
+            return False
+        self._spill_count += 1
+        self.spilled_frames += 1
+        self.spilled_bytes += len(payload)
+        return True
+
+    def _unspill(self):
+        self._spill_file.seek(self._spill_read_offset)
+        header = self._spill_file.read(self._record_header.size)
+        timestamp_us, size, stream_id = self._record_header.unpack(header)
+        payload = self._spill_file.read(size)
+        self._spill_read_offset += self._record_header.size + size
+        self._spill_count -= 1
+        if self._spill_count == 0:
+            self._reset_spill()
+        return timestamp_us, payload, stream_id
+
+    def _reset_spill(self):
+        self._spill_count = 0
+        self._spill_read_offset = 0
+        if self._spill_file is not None:
+            try:
+                self._spill_file.close()
+                os.remove(self._spill_path)
+            except Exception:
+                pass
+        self._spill_file = None
+        self._spill_path = None
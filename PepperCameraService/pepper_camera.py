@@ -1,45 +1,103 @@
 #!/usr/bin/env python2
 import qi
+import os
 import threading
-from collections import deque
-from frame_compresser import compress_frame_data
+from frame_queue import FrameQueue
+from frame_compresser import compress_frame_data, get_encoder
 from SoundReciver_py2 import SoundReceiverModule
+from capture_stats import RecorderStats, clock
+from adaptive_controller import AdaptiveRateController
+from session_spool import SessionSpool
+from scene_detector import REPEAT_PAYLOAD
+from audio_streamer import AudioStreamer
+from audio_codecs import get_audio_codec, encode_audio
+from audio_archive import AudioArchive
+from audio_monitor import AudioMonitor
 from time import sleep
+import time
+try:
+    import queue
+except ImportError:  # Python 2.7 on the robot
+    import Queue as queue
 
 #test
 
 
+# Camera name -> (ALVideoDevice camera index, resolution, colorspace). The stream id on the
+# wire is the camera index; 0 (top) is the primary stream.
+CAMERAS = {
+    "top": (0, 2, 13),     # kVGA, kBGRColorSpace: frames go to imencode without conversion
+    "bottom": (1, 2, 13),  # kVGA, kBGRColorSpace
+    "depth": (2, 1, 17),   # kQVGA, kDepthColorSpace (16-bit millimetres, encoded as PNG)
+}
 
 
 class PepperCamera(object):
-    def __init__(self):
+    def __init__(self, rate_controller=None, lossless=False, cameras=("top",), scene_detector=None, archive_audio=False):
         # Initialize fields BEFORE creating services, so init_qi_session can set them.
-        # Deque gives O(1) pops from the left, avoiding quadratic slowdowns when streaming frames
-        self.frames = deque()
+        # Bounded FIFO: O(1) pops from the left, and unsent frames beyond the memory cap
+        # are spilled to flash (or dropped) instead of filling the robot's RAM
+        self.frames = FrameQueue()
         self.pepper_camera_recorder = None
         self.sound_module_instance = None
         self.audio_bytes = None
+        self.rate_controller = rate_controller
+        # Lossless mode: frames and audio also go to an on-robot spool sent at stop;
+        # the live UDP stream is then only a preview
+        self.lossless = lossless
+        self.spool = None
+        self.cameras = [CAMERAS[name] for name in cameras]
+        # Frame encoder backend; the operator picks one at connect time (see set_encoder)
+        self.encoder_name = 'jpeg'
+        # Audio codec for the recording sent at stop; negotiated like the frame encoder
+        self.audio_codec_name = 'wav'
+        # Optional StaticSceneDetector: unchanged frames are sent as tiny repeat records
+        self.scene_detector = scene_detector
+        # (host, port) to stream audio to while recording; set by PepperSocketManager
+        self.audio_stream_target = None
+        self.audio_stream_id = None
+        # Archival mode: also keep all microphone channels in an AudioArchive, sent after stop
+        self.archive_audio = archive_audio
+        self.audio_archive = None
         self.init_qi_session()
+        if self.rate_controller is None:
+            self.rate_controller = AdaptiveRateController(fps=self.framerate, enabled=False)
+        if self.lossless:
+            # Spooled frames are the recording: keep their quality fixed, and never
+            # spill preview frames to flash
+            self.rate_controller.enabled = False
+            self.frames.policy = 'drop'
 
     def init_qi_session(self):
-        CAMERA_INDEX = 0
-        RESOLUTION_INDEX = 2
-        COLORSPACE_INDEX = 11
         FRAMERATE = 15
+        self.framerate = FRAMERATE
         self.session = qi.Session()
         self.session.connect("tcp://127.0.0.1:9559")
         self.session.service("ALTextToSpeech").setLanguage("Polish")
         self.session.service("ALAutonomousLife").setState("solitary")
         self.session.service("ALAutonomousLife").setAutonomousAbilityEnabled("BasicAwareness", False)  # Disable basic awareness to prevent interruptions
         self.delete_subs("kamera")
-        self.vid_handle = self.session.service("ALVideoDevice").subscribeCamera(
-            "kamera",
-            CAMERA_INDEX,
-            RESOLUTION_INDEX,
-            COLORSPACE_INDEX,
-            FRAMERATE
-        
-        )
+        camera_indexes = [camera[0] for camera in self.cameras]
+        resolutions = [camera[1] for camera in self.cameras]
+        colorspaces = [camera[2] for camera in self.cameras]
+        if len(self.cameras) == 1:
+            self.vid_handle = self.session.service("ALVideoDevice").subscribeCamera(
+                "kamera",
+                camera_indexes[0],
+                resolutions[0],
+                colorspaces[0],
+                FRAMERATE
+            )
+        else:
+            # One subscription for all cameras: a single batched grab per tick
+            self.vid_handle = self.session.service("ALVideoDevice").subscribeCameras(
+                "kamera",
+                camera_indexes,
+                resolutions,
+                colorspaces,
+                FRAMERATE
+            )
+        self.stream_ids = camera_indexes
         print("Camera subscribed successfully.")
 
         # Initialize and register sound receiver service (Python 2.7)
@@ -51,6 +109,28 @@ class PepperCamera(object):
         except Exception as e:
             print("Failed to initialize sound module:", e)
 
+    def start_audio_monitor(self, target):
+        """Stream live, low-rate audio to the operator for listening, recording or not."""
+        if not self.sound_module_instance:
+            print("sound_module_instance is None; audio monitor will not start.")
+            return
+        monitor = AudioMonitor(target, self.sound_module_instance.sample_rate)
+        monitor.start()
+        self.sound_module_instance.start_monitor(monitor)
+        print("Audio monitor streaming to", target)
+
+
+    def set_encoder(self, name):
+        """Select the frame encoder backend used from the next recording on."""
+        self.encoder_name = get_encoder(name).name
+        print("Frame encoder:", self.encoder_name)
+        return self.encoder_name
+
+    def set_audio_codec(self, name):
+        """Select the codec the recorded audio is sent with from the next recording on."""
+        self.audio_codec_name = get_audio_codec(name).name
+        print("Audio codec:", self.audio_codec_name)
+        return self.audio_codec_name
 
     def delete_subs(self, name):
         all_subscribers = self.session.service("ALVideoDevice").getSubscribers()
@@ -67,13 +147,33 @@ class PepperCamera(object):
         self.session.service("ALAutonomousLife").setAutonomousAbilityEnabled("ListeningMovement", False)
         self.session.service("ALAutonomousLife").setAutonomousAbilityEnabled("BasicAwareness", False)
         if not self.pepper_camera_recorder:
-            self.pepper_camera_recorder = PepperCameraRecorder(self.session, self.vid_handle, self.frames)
+            self.rate_controller.reset()
+            self.frames.reset_stats()
+            if self.lossless:
+                if self.spool:
+                    self.spool.remove()
+                self.spool = SessionSpool()
+                print("Spooling session to", self.spool.path)
+            self.pepper_camera_recorder = PepperCameraRecorder(
+                self.session, self.vid_handle, self.frames, self.framerate,
+                rate_controller=self.rate_controller, spool=self.spool, stream_ids=self.stream_ids,
+                encoder=get_encoder(self.encoder_name), scene_detector=self.scene_detector)
             self.pepper_camera_recorder.is_recording = True
             self.pepper_camera_recorder.start()
         # Start audio recording if available
         if self.sound_module_instance:
             try:
                 print("Attempting to start audio module...")
+                self.audio_stream_id = None
+                if self.audio_stream_target and not self.lossless:
+                    streamer = AudioStreamer(self.audio_stream_target, self.sound_module_instance.sample_rate)
+                    streamer.start()
+                    self.sound_module_instance.streamer = streamer
+                    self.audio_stream_id = streamer.session_id
+                if self.archive_audio:
+                    self.audio_archive = AudioArchive(self.sound_module_instance.sample_rate,
+                                                      self.sound_module_instance.default_channels)
+                    self.sound_module_instance.archive = self.audio_archive
                 self.sound_module_instance.start()
                 self.audio_bytes = None
                 print("Audio recording started.")
@@ -82,18 +182,36 @@ class PepperCamera(object):
         else:
             print("sound_module_instance is None; audio will not start.")
 
-    def stop_recording(self):
+    def stop_recording(self, audio=True):
         if self.pepper_camera_recorder:
             self.pepper_camera_recorder.is_recording = False
             self.pepper_camera_recorder.join()
             self.pepper_camera_recorder = None
-        # Stop audio recording and capture compressed audio bytes
+            self.rate_controller.report()
+        if audio:
+            self.finish_audio()
+
+    def finish_audio(self):
+        # Stop audio recording and capture compressed audio bytes; split from stop_recording
+        # so the frame count can go out before the encode
         if self.sound_module_instance:
             try:
                 self.audio_bytes = self.sound_module_instance.stop()
                 print("Audio recording stopped. Bytes:", 0 if self.audio_bytes is None else len(self.audio_bytes))
+                if self.audio_bytes is not None:
+                    # The stream did not complete; the recording goes out over TCP instead
+                    self.audio_stream_id = None
             except Exception as e:
                 print("Failed to stop audio recording:", e)
+            if self.audio_bytes and self.audio_codec_name != 'wav':
+                wav_size = len(self.audio_bytes)
+                self.audio_bytes, cpu_seconds = encode_audio(self.audio_bytes, get_audio_codec(self.audio_codec_name))
+                print("[AudioCodec] {}: {} -> {} bytes ({:.2f}x), {:.2f}s CPU".format(
+                    self.audio_codec_name, wav_size, len(self.audio_bytes),
+                    wav_size / float(max(1, len(self.audio_bytes))), cpu_seconds))
+        if self.spool and not self.spool.finished:
+            self.spool.append_audio(self.audio_bytes)
+            print("Spool finished: {} frames, {} bytes".format(self.spool.frame_count, self.spool.finish()))
 
     def exit(self):
         if self.pepper_camera_recorder:
@@ -102,6 +220,7 @@ class PepperCamera(object):
         # Ensure audio module unsubscribes if still active
         try:
             if self.sound_module_instance:
+                self.sound_module_instance.stop_monitor()
                 self.sound_module_instance.stop()
         except:
             pass
@@ -123,16 +242,178 @@ class PepperCamera(object):
 
 
 class PepperCameraRecorder(threading.Thread):
-    def __init__(self, session, vid_handle, frames):
+    """
+    Grabs frames on its own thread and hands them to a small pool of JPEG
+    encoder threads (cv2 releases the GIL while encoding). Encoded frames are
+    put back in capture order before they reach ``frames``.
+
+    Grabs run on deadlines spaced 1/fps apart on a monotonic clock. When a
+    grab overruns by a whole interval the missed slots are either skipped
+    (default) or caught up back-to-back, per PEPPER_CAPTURE_OVERRUN.
+
+    With several ``stream_ids`` every tick is one getImagesRemote call; all
+    images of a tick share the primary image's timestamp and are encoded in
+    parallel. Frames are ``(timestamp_us, payload, stream_id)``.
+    """
+    def __init__(self, session, vid_handle, frames, target_fps=None, encode_workers=None, rate_controller=None,
+                 spool=None, stream_ids=(0,), encoder=None, scene_detector=None):
         threading.Thread.__init__(self)
         self.frames = frames
         self.session = session
         self.vid_handle = vid_handle
         self.is_recording = False
-
+        if encode_workers is None:
+            try:
+                encode_workers = int(os.getenv('PEPPER_ENCODE_WORKERS', str(1 + len(stream_ids))))
+            except ValueError:
+                encode_workers = 1 + len(stream_ids)
+        self.encoder = encoder if encoder is not None else get_encoder('jpeg')
+        if self.encoder.stateful:
+            # Inter-frame encoders need every frame in capture order
+            encode_workers = 1
+        self.encode_workers = max(1, encode_workers)
+        # Small bound: a backlog here only means we grab faster than we can encode
+        self._encode_queue = queue.Queue(maxsize=2 * self.encode_workers)
+        self._reorder_lock = threading.Lock()
+        self._pending = {}
+        self._next_seq = 0
+        self._last_ts = None    # of the last primary-stream frame emitted
+        self.stats = RecorderStats(target_fps)
+        self.rate_controller = rate_controller
+        self.spool = spool
+        self.stream_ids = list(stream_ids)
+        self.scene_detector = scene_detector
+        self.catch_up = os.getenv('PEPPER_CAPTURE_OVERRUN', 'skip').strip().lower() == 'catchup'
+        # Never burst more than this many back-to-back grabs when catching up
+        self.max_catch_up = 2
 
     def run(self):
-        while self.is_recording:
-            frame_data_raw = self.session.service("ALVideoDevice").getImageRemote(self.vid_handle)
-            frame_data = compress_frame_data(frame_data_raw)
-            self.frames.append(frame_data)
+        video_device = self.session.service("ALVideoDevice")
+        workers = [threading.Thread(target=self._encode_worker) for _ in range(self.encode_workers)]
+        for worker in workers:
+            worker.start()
+        seq = 0
+        applied_fps = self.stats.target_fps
+        interval = 1.0 / applied_fps if applied_fps else 0.0
+        next_deadline = clock()
+        last_capture_ts = None
+        multi_stream = len(self.stream_ids) > 1
+        self.stats.start()
+        try:
+            while self.is_recording:
+                if self.rate_controller and self.rate_controller.fps != applied_fps:
+                    applied_fps = self.rate_controller.fps
+                    interval = 1.0 / applied_fps if applied_fps else 0.0
+                    next_deadline = clock() + interval
+                    try:
+                        video_device.setFrameRate(self.vid_handle, applied_fps)
+                    except Exception as e:
+                        print("Failed to set camera frame rate to {}: {}".format(applied_fps, e))
+                now = clock()
+                if next_deadline - now > interval:
+                    # Never more than a slot ahead unless the clock stepped back; don't sleep through it
+                    next_deadline = now + interval
+                if now < next_deadline:
+                    time.sleep(next_deadline - now)
+                    now = clock()
+                self.stats.jitter.add(now - next_deadline)
+                grab_start = now
+                if multi_stream:
+                    images = video_device.getImagesRemote(self.vid_handle)
+                else:
+                    images = [video_device.getImageRemote(self.vid_handle)]
+                grabbed_at = clock()
+                self.stats.grab.add(grabbed_at - grab_start)
+                next_deadline = self._next_deadline(next_deadline, interval, grabbed_at)
+                if not images or images[0] is None:
+                    continue
+                capture_ts = (images[0][4], images[0][5])
+                if capture_ts == last_capture_ts:
+                    # Camera has not produced a new image yet; don't encode it twice
+                    self.stats.duplicates += 1
+                    continue
+                last_capture_ts = capture_ts
+                shared_ts = (int(capture_ts[0]) * 1000000) + int(capture_ts[1])
+                for stream_id, frame_data_raw in zip(self.stream_ids, images):
+                    if frame_data_raw is None:
+                        continue
+                    if self.scene_detector and self.encoder.allows_repeats and \
+                            self.scene_detector.is_static(frame_data_raw, stream_id):
+                        # Nothing worth encoding; the worker emits a repeat record in order
+                        frame_data_raw = None
+                    self._encode_queue.put((seq, grabbed_at, frame_data_raw, stream_id, shared_ts))
+                    seq += 1
+        finally:
+            for _ in workers:
+                self._encode_queue.put(None)
+            for worker in workers:
+                worker.join()
+            tail = self.encoder.flush()
+            if tail is not None and self._last_ts is not None:
+                # Frames the encoder still held; just after the last frame so the operator keeps its order
+                self._emit_in_order(self._next_seq, (self._last_ts + 1, tail, self.stream_ids[0]))
+            self.encoder.close()
+            self.stats.stop()
+            self.stats.report()
+
+    def _next_deadline(self, deadline, interval, now):
+        deadline += interval
+        if interval <= 0 or now - deadline < interval:
+            return deadline
+        # Overran by at least one whole slot
+        self.stats.overruns += 1
+        missed = int((now - deadline) / interval)
+        if self.catch_up and missed <= self.max_catch_up:
+            return deadline
+        self.stats.skipped_slots += missed
+        return deadline + missed * interval
+
+    def _encode_worker(self):
+        while True:
+            item = self._encode_queue.get()
+            if item is None:
+                return
+            seq, grabbed_at, frame_data_raw, stream_id, shared_ts = item
+            quality = self.rate_controller.quality if self.rate_controller else 80
+            encode_start = clock()
+            if frame_data_raw is None:
+                with self._reorder_lock:
+                    self.stats.repeats += 1
+                self._emit_in_order(seq, (shared_ts, REPEAT_PAYLOAD, stream_id))
+                continue
+            try:
+                _, payload = compress_frame_data(frame_data_raw, quality, self.encoder, stream_id)
+                frame_data = (shared_ts, payload, stream_id)
+            except Exception as e:
+                print("Failed to encode frame {}: {}".format(seq, e))
+                frame_data = None
+            encode_end = clock()
+            # Shared by every encode worker, like the counters _emit_in_order updates
+            with self._reorder_lock:
+                self.stats.queue_wait.add(encode_start - grabbed_at)
+                self.stats.encode.add(encode_end - encode_start)
+            self._emit_in_order(seq, frame_data)
+
+    def _emit_in_order(self, seq, frame_data):
+        with self._reorder_lock:
+            self._pending[seq] = frame_data
+            while self._next_seq in self._pending:
+                ready = self._pending.pop(self._next_seq)
+                self._next_seq += 1
+                if ready is None:
+                    self.stats.encode_errors += 1
+                    continue
+                timestamp_us, payload, stream_id = ready
+                if self.spool:
+                    try:
+                        self.spool.append_frame(timestamp_us, payload, stream_id)
+                    except Exception as e:
+                        print("Failed to spool frame {}: {}".format(timestamp_us, e))
+                self.frames.append(ready)
+                if stream_id != self.stream_ids[0]:
+                    continue
+                self._last_ts = timestamp_us
+                # Timings, fps and rate control follow the primary stream
+                self.stats.frames_out += 1
+                if self.rate_controller:
+                    self.rate_controller.observe(self.stats.frames_out, timestamp_us, len(payload), len(self.frames))
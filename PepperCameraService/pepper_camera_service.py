@@ -1,5 +1,7 @@
 import argparse
 from pepper_camera import PepperCamera
+from adaptive_controller import AdaptiveRateController
+from scene_detector import StaticSceneDetector
 from pepper_socket_manager import PepperSocketManager
 
 
@@ -9,13 +11,41 @@ if __name__ == "__main__":
     parser.add_argument('--host', type=str, default="192.168.1.103", help='Host IP address')
     parser.add_argument('--port_tcp', type=int, default=54321, help='Port number')
     parser.add_argument('--port_udp', type=int, default=54322, help='Port number')
+    parser.add_argument('--port_bulk', type=int, default=54323, help='Operator port for spool bulk transfer')
+    parser.add_argument('--stream_audio', action='store_true', help='Send audio to the operator while recording instead of at stop')
+    parser.add_argument('--port_audio', type=int, default=54324, help='Operator port for streamed audio')
+    parser.add_argument('--monitor_audio', action='store_true', help='Stream live 16 kHz audio to the operator for listening')
+    parser.add_argument('--port_monitor', type=int, default=54325, help='Operator UDP port for live audio monitoring')
+    parser.add_argument('--archive_audio', action='store_true', help='Also keep all four microphone channels and send them to the operator after stop')
+    parser.add_argument('--video_fec', type=float, default=0.0, help='Parity datagrams per frame as a fraction of its chunks, e.g. 0.2 (0 disables)')
+    parser.add_argument('--lossless', action='store_true', help='Spool the session on the robot and send it over TCP at stop')
+    parser.add_argument('--cameras', type=str, default='top', help='Comma-separated cameras to record: top,bottom,depth')
+    parser.add_argument('--static_threshold', type=float, default=0.0, help='Send repeat records for frames whose mean change is below this (0-255; 0 disables)')
+    parser.add_argument('--static_keepalive', type=float, default=2.0, help='Seconds between forced full frames on a static scene')
+    parser.add_argument('--no_adaptive', action='store_true', help='Keep JPEG quality and frame rate fixed')
+    parser.add_argument('--quality_min', type=int, default=40, help='Lowest JPEG quality under congestion')
+    parser.add_argument('--quality_max', type=int, default=80, help='JPEG quality when the link is clear')
+    parser.add_argument('--fps_min', type=int, default=5, help='Lowest frame rate under congestion')
+    parser.add_argument('--fps_max', type=int, default=15, help='Frame rate when the link is clear')
     args = parser.parse_args()
     pepper_socket_manager = None
     try:
         print("Connecting to Pepper Camera...")
-        pepper_camera = PepperCamera()
+        rate_controller = AdaptiveRateController(
+            min_quality=args.quality_min, max_quality=args.quality_max,
+            min_fps=args.fps_min, max_fps=args.fps_max,
+            enabled=not args.no_adaptive)
+        cameras = [name.strip() for name in args.cameras.split(',') if name.strip()]
+        scene_detector = None
+        if args.static_threshold > 0:
+            scene_detector = StaticSceneDetector(args.static_threshold, keepalive_frames=int(args.static_keepalive * args.fps_max))
+        pepper_camera = PepperCamera(rate_controller, lossless=args.lossless, cameras=cameras, scene_detector=scene_detector,
+                                     archive_audio=args.archive_audio)
         print("Connecting to Pepper Socket...")
-        pepper_socket_manager = PepperSocketManager(args.host, args.port_tcp, args.port_udp, pepper_camera)
+        pepper_socket_manager = PepperSocketManager(args.host, args.port_tcp, args.port_udp, pepper_camera, args.port_bulk,
+                                                    args.port_audio if args.stream_audio else None,
+                                                    args.port_monitor if args.monitor_audio else None,
+                                                    video_fec=args.video_fec)
         print("Pepper Camera Client is running.")
         pepper_camera.wez_usiadz()
         print("Robot is seated.")
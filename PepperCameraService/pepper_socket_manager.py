@@ -1,10 +1,24 @@
+import select
 import socket
 import threading
 import os
 import struct
+import json
+import time
+try:
+    import queue
+except ImportError:  # Python 2.7 on the robot
+    import Queue as queue
+from session_spool import send_spool
+from frame_compresser import available_encoders
+from audio_codecs import available_audio_codecs
+from video_datagrams import FrameSender
+from control_protocol import CONTROL_OPTION, CONTROL_ACCEPT, LineReader, pack_message
+from capture_stats import clock
 
 class PepperSocketManager():
-    def __init__(self, host, port_tcp, port_udp, pepper_camera):
+    def __init__(self, host, port_tcp, port_udp, pepper_camera, port_bulk=None, port_audio=None, port_monitor=None,
+                 video_fec=0.0):
         self.pepper_camera = pepper_camera
         self.socket_tcp = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket_udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -15,9 +29,17 @@ class PepperSocketManager():
             pass
         self.target_tcp = (host, port_tcp)
         self.target_udp = (host, port_udp)
+        self.target_bulk = (host, port_bulk if port_bulk is not None else port_tcp + 2)
+        if port_audio:
+            # Audio goes to the operator continuously while recording
+            self.pepper_camera.audio_stream_target = (host, port_audio)
+        if port_monitor:
+            self.pepper_camera.start_audio_monitor((host, port_monitor))
 
         self.tcp_thread = threading.Thread(target=self.tcp_thread_job)
         self.udp_thread = threading.Thread(target=self.udp_thread_job)
+        self.nack_thread = threading.Thread(target=self.nack_thread_job)
+        self.nack_thread.daemon = True
         # self.tcp_thread.setDaemon(True)
         # self.udp_thread.setDaemon(True)
 
@@ -26,15 +48,28 @@ class PepperSocketManager():
         # Audio staging state
         self.pending_audio = None  # None = no stop requested; b'' = explicitly no audio; bytes = audio
         self.audio_sent = False
+        # Set once the operator opts into JSON-lines control requests (control_protocol.py)
+        self.control_reader = None
+        # Acks go out from the reader while a command worker sends replies and recordings
+        self.tcp_send_lock = threading.Lock()
+        # Connected, so frames go out with send() and only the operator's NACKs come back
+        self.socket_udp.connect(self.target_udp)
+        # Chunked frame datagrams with NACK resends and optional parity
+        # (video_fec: parity datagrams per frame as a fraction of its chunks)
+        self.frame_sender = FrameSender(self.socket_udp, fec_overhead=video_fec)
 
         print("trying to connect to:", self.target_tcp, self.target_udp)
 
         self.socket_tcp.connect((host, port_tcp))
 
         print("connected succesfuly")
+        # Offer our frame encoders and audio codecs; the operator answers with 'codec <frame> [<audio>]'
+        self.socket_tcp.sendall("ENCODERS:{}\n".format(",".join(available_encoders())).encode('utf-8'))
+        self.socket_tcp.sendall("AUDIO_CODECS:{}\n".format(",".join(available_audio_codecs())).encode('utf-8'))
 
         self.tcp_thread.start()
         self.udp_thread.start()
+        self.nack_thread.start()
 
     def tcp_thread_job(self):
         '''
@@ -42,15 +77,50 @@ class PepperSocketManager():
         '''
         print("tcp thread started")
         def stop_command():
-            self.pepper_camera.stop_recording()
+            # Audio is finished in send_recording, after the frame count is out
+            self.pepper_camera.stop_recording(audio=False)
+            archive = self.pepper_camera.audio_archive
+            self.pepper_camera.audio_archive = None
+            try:
+                send_recording()
+            finally:
+                if archive is not None:
+                    # After the recording itself, so it never holds up the bulk port for a spool
+                    archive_thread = threading.Thread(target=send_archive, args=(archive,))
+                    archive_thread.daemon = True
+                    archive_thread.start()
+
+        def send_recording():
+            spool = self.pepper_camera.spool
+            if spool is not None:
+                # The spool's audio goes in before it is finished and announced
+                self.pepper_camera.finish_audio()
+                lossless_stop(spool)
+                return
+            rate_controller = getattr(self.pepper_camera, 'rate_controller', None)
+            if rate_controller is not None and rate_controller.changes and self.control_reader is not None:
+                # Operators that opted into JSON-lines control read the rate change log
+                # ahead of the frame count and write it beside the video
+                log = json.dumps(rate_controller.changes, separators=(',', ':')).encode('utf-8')
+                with self.tcp_send_lock:
+                    self.socket_tcp.sendall("RATE_CHANGES:{}\n".format(len(log)).encode('utf-8') + log)
             camera_frames_str = str(len(self.pepper_camera.frames))
             print("attempting to send ", camera_frames_str)
             # Send frame count as a line to delimit from subsequent audio header/data
             msg = (camera_frames_str + "\n").encode('utf-8')
-            self.socket_tcp.sendall(msg)
+            with self.tcp_send_lock:
+                self.socket_tcp.sendall(msg)
             bytes_sent = len(msg)
             print("succesfuly sent bytes number:", bytes_sent)
+            self.pepper_camera.frames.report()
+            self.pepper_camera.finish_audio()
             # Stage audio to be sent; either via UDP (default) or send directly over TCP if PEPPER_TCP_AUDIO=1
+            if self.pepper_camera.audio_stream_id:
+                # Audio already went out during the session; tell the operator which stream to close
+                with self.tcp_send_lock:
+                    self.socket_tcp.sendall("AUDIO_STREAM:{}\n".format(self.pepper_camera.audio_stream_id).encode('utf-8'))
+                print("Audio was streamed as", self.pepper_camera.audio_stream_id)
+                return
             try:
                 audio_bytes = getattr(self.pepper_camera, 'audio_bytes', None)
                 tcp_audio_flag = os.getenv('PEPPER_TCP_AUDIO', '1').strip().lower()
@@ -59,11 +129,14 @@ class PepperSocketManager():
                     try:
                         if audio_bytes and len(audio_bytes) > 0:
                             header = "AUDIO_LEN:{}\n".format(len(audio_bytes)).encode('utf-8')
-                            self.socket_tcp.sendall(header)
-                            self.socket_tcp.sendall(audio_bytes)
+                            # No ack may land between the header and its bytes
+                            with self.tcp_send_lock:
+                                self.socket_tcp.sendall(header)
+                                self.socket_tcp.sendall(audio_bytes)
                             print("Audio sent over TCP:", len(audio_bytes))
                         else:
-                            self.socket_tcp.sendall(b"AUDIO_NONE\n")
+                            with self.tcp_send_lock:
+                                self.socket_tcp.sendall(b"AUDIO_NONE\n")
                             print("Sent AUDIO_NONE over TCP")
                     except Exception as e:
                         print("Failed to send audio over TCP:", e)
@@ -80,6 +153,25 @@ class PepperSocketManager():
             except Exception as e:
                 print("Failed to stage audio:", e)
 
+        def send_archive(archive):
+            if send_spool(self.target_bulk, archive, kind='ARCHIVE'):
+                archive.remove()
+            else:
+                print("Audio archive transfer failed; keeping", archive.path)
+
+        def lossless_stop(spool):
+            # Live frames were only a preview; the spool carries the recording
+            self.pepper_camera.frames.clear()
+            msg = "SPOOL:{}:{}:{}\n".format(spool.session_id, spool.size(), spool.frame_count).encode('utf-8')
+            with self.tcp_send_lock:
+                self.socket_tcp.sendall(msg)
+            print("Announced spool", spool.session_id)
+            if send_spool(self.target_bulk, spool):
+                spool.remove()
+                self.pepper_camera.spool = None
+            else:
+                print("Spool transfer failed; keeping", spool.path)
+
         commands = {
             "start": self.pepper_camera.start_recording,
             "stop":  stop_command,
@@ -88,9 +180,84 @@ class PepperSocketManager():
             "wake": self.pepper_camera.wez_wstawaj,
         }
 
+        def reply(request_id, ack, **fields):
+            fields.update(id=request_id, ack=ack, ts=time.time())
+            try:
+                with self.tcp_send_lock:
+                    self.socket_tcp.sendall(pack_message(fields))
+            except Exception as e:
+                print("Failed to acknowledge request", request_id, e)
+
+        # Requests are acked as they are read and run here, one at a time and in order,
+        # so a slow speak or stop never holds up reading (and acking) the next request
+        requests = queue.Queue()
+
+        def handle_request(line):
+            try:
+                request = json.loads(line.decode('utf-8'))
+                request_id = request['id']
+                command = request['cmd']
+            except (ValueError, KeyError, TypeError):
+                print("Malformed control request:", line[:80])
+                return
+            reply(request_id, 'received')
+            requests.put((request_id, command, request))
+
+        def command_worker():
+            while True:
+                item = requests.get()
+                if item is None:
+                    break
+                run_request(*item)
+
+        def run_request(request_id, command, request):
+            started = clock()
+            print("received command: ", command, " len:", len(self.pepper_camera.frames))
+            try:
+                if command == "speak":
+                    text = request.get('text', '')
+                    if not isinstance(text, str):
+                        text = text.encode('utf-8')
+                    print("Just about to say: ", text)
+                    self.pepper_camera.wez_powiedz(text)
+                elif command in commands:
+                    commands[command]()
+                else:
+                    raise ValueError("unknown command {}".format(command))
+            except Exception as e:
+                print("Command", command, "failed:", e)
+                reply(request_id, 'error', exec_ms=(clock() - started) * 1000.0, error=str(e))
+                return
+            reply(request_id, 'done', exec_ms=(clock() - started) * 1000.0)
+
+        worker = threading.Thread(target=command_worker)
+        worker.daemon = True
+        worker.start()
         self.tcp_thread_running = True
         while self.tcp_thread_running:
+            if self.control_reader is not None:
+                line = self.control_reader.read_line()
+                if line is None:
+                    print("Control connection closed")
+                    break
+                if line.strip():
+                    handle_request(line)
+                continue
             command = str(self.socket_tcp.recv(1024).decode('utf-8')).strip()
+            if command.startswith("codec "):
+                # Codec names, then key=value options
+                names = [name for name in command[6:].split() if '=' not in name]
+                options = [name for name in command[6:].split() if '=' in name]
+                if names:
+                    self.pepper_camera.set_encoder(names[0])
+                if len(names) > 1:
+                    self.pepper_camera.set_audio_codec(names[1])
+                if CONTROL_OPTION in options:
+                    self.control_reader = LineReader(self.socket_tcp)
+                    with self.tcp_send_lock:
+                        self.socket_tcp.sendall(CONTROL_ACCEPT)
+                    print("Control requests: JSON lines")
+                continue
             if len(command) > 6:
                 print("Just about to say: ", command)
                 args = command[6:]
@@ -99,6 +266,8 @@ class PepperSocketManager():
             print("received command: ", command, " len:" , len(self.pepper_camera.frames))
             if command in commands:
                 commands[command]()
+        # Queued commands still run (a stop still sends its recording) before the worker ends
+        requests.put(None)
         self.tcp_thread_running = False
 
 
@@ -111,10 +280,10 @@ class PepperSocketManager():
         while self.udp_thread_running:
             while len(self.pepper_camera.frames) > 0:
                 frame_data = self.pepper_camera.frames.popleft()
-                # print("sending bytes")
-                # print(len(frame_data))
-                # print(type(frame_data))
                 self.udp_thread_send_frame(frame_data)
+                rate_controller = getattr(self.pepper_camera, 'rate_controller', None)
+                if rate_controller:
+                    rate_controller.note_sent(len(frame_data[1]))
             # If no frames to send, see if we need to send audio (staged on stop)
             if len(self.pepper_camera.frames) == 0:
                 # Send audio once, if staged and not yet sent
@@ -172,20 +341,37 @@ class PepperSocketManager():
         '''
         Send single frame to server
         '''
-        print("sending frame")
-        CHUNK_SIZE = 1400
-        timestamp_us, payload = frame
-        header = struct.pack('!QI', int(timestamp_us), len(payload))
-        frame_packet = header + payload
-
-        for start in range(0, len(frame_packet), CHUNK_SIZE):
-            end = start + CHUNK_SIZE
-            if end > len(frame_packet):
-                end = len(frame_packet)
-            chunk = frame_packet[start:end]
-            self.socket_udp.sendto(chunk, self.target_udp)
+        timestamp_us, payload, stream_id = frame
+        if stream_id:
+            # Secondary cameras are tagged; the primary keeps the legacy header
+            header = struct.pack('!2sBQI', b'PF', stream_id, int(timestamp_us), len(payload))
+        else:
+            header = struct.pack('!QI', int(timestamp_us), len(payload))
+        try:
+            self.frame_sender.send_frame(header, payload)
+        except socket.error as e:
+            # The connected socket reports an earlier datagram refused (operator not listening yet,
+            # or restarted) on a later send; drop this frame rather than the sender thread
+            print("Dropped frame {}: {}".format(timestamp_us, e))
 
-        self.socket_udp.sendto(b"END", self.target_udp)
+    def nack_thread_job(self):
+        '''
+        Resend the chunks the operator reports missing
+        '''
+        # select keeps the shared UDP socket blocking for the sender thread; exit() closes it
+        while True:
+            try:
+                readable, _, _ = select.select([self.socket_udp], [], [], 0.2)
+            except (select.error, socket.error, ValueError):
+                break
+            if not readable:
+                continue
+            try:
+                data, _ = self.socket_udp.recvfrom(2048)
+                self.frame_sender.handle_nack(data)
+            except socket.error:
+                continue
+        print(self.frame_sender.summary())
 
 
     def exit(self):
@@ -193,6 +379,11 @@ class PepperSocketManager():
         self.pepper_camera.exit()
         self.tcp_thread_running = False
         self.udp_thread_running = False
+        try:
+            # Wakes the control reader, which exit may be called from beside
+            self.socket_tcp.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
         self.socket_tcp.close()
         self.socket_udp.close()
         print("exited")
\ No newline at end of file
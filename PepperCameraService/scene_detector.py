@@ -0,0 +1,41 @@
+import numpy as np
+
+
+# Payload sent in place of a frame that barely differs from the last one sent:
+# "repeat the previous frame at this frame's timestamp"
+REPEAT_PAYLOAD = b'REP0'
+
+
+class StaticSceneDetector(object):
+    """
+    Cheap change detector for mostly still WoZ scenes. Compares a coarse
+    thumbnail (every ``step``-th pixel of the green channel) against the
+    last frame that was actually encoded, per stream. A real frame is still
+    forced every ``keepalive_frames`` so the operator's reference never gets
+    too old.
+    """
+
+    def __init__(self, threshold=2.0, keepalive_frames=30, step=8):
+        # Mean absolute difference (0-255) below which a frame counts as unchanged
+        self.threshold = float(threshold)
+        self.keepalive_frames = int(keepalive_frames)
+        self.step = int(step)
+        self._reference = {}
+        self._repeats = {}
+
+    def is_static(self, frame_data, stream_id=0):
+        """True when the raw ALImage can be replaced by a repeat record."""
+        if self.threshold <= 0 or frame_data[2] != 3:
+            return False
+        width, height = frame_data[0], frame_data[1]
+        image = np.frombuffer(frame_data[6], dtype=np.uint8).reshape((height, width, 3))
+        thumb = image[::self.step, ::self.step, 1].astype(np.int16)
+        reference = self._reference.get(stream_id)
+        repeats = self._repeats.get(stream_id, 0)
+        if reference is not None and reference.shape == thumb.shape and repeats < self.keepalive_frames:
+            if np.abs(thumb - reference).mean() < self.threshold:
+                self._repeats[stream_id] = repeats + 1
+                return True
+        self._reference[stream_id] = thumb
+        self._repeats[stream_id] = 0
+        return False
@@ -0,0 +1,129 @@
+import os
+import socket
+import struct
+import threading
+import time
+from control_protocol import LineReader
+
+
+RECORD_HEADER = struct.Struct('!cBQI')   # kind, stream id, timestamp_us, payload length
+INDEX_ENTRY = struct.Struct('!cBQQI')    # kind, stream id, timestamp_us, record offset, payload length
+FOOTER = struct.Struct('!4sQI')          # magic, index offset, entry count
+FOOTER_MAGIC = b'PIDX'
+KIND_VIDEO = b'V'
+KIND_AUDIO = b'A'
+
+
+def spool_dir():
+    """Directory on the robot's flash for spool/spill files (not tmpfs)."""
+    path = os.getenv('PEPPER_SPOOL_DIR', os.path.expanduser('~/.pepper_spool'))
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    return path
+
+
+class SessionSpool(object):
+    """
+    Append-only, indexed spool of one recording session on the robot.
+
+    Records are ``RECORD_HEADER`` + payload; ``finish`` appends an index of
+    every record followed by ``FOOTER`` so the operator can seek straight to
+    frames without scanning.
+    """
+
+    def __init__(self, session_id=None, directory=None):
+        self.session_id = session_id or str(int(time.time() * 1000))
+        self.path = os.path.join(directory or spool_dir(), 'session_{}.spool'.format(self.session_id))
+        self._file = open(self.path, 'wb')
+        self._lock = threading.Lock()
+        self._index = []
+        self._offset = 0
+        self.frame_count = 0
+        self.finished = False
+
+    def append_frame(self, timestamp_us, payload, stream_id=0):
+        self._append(KIND_VIDEO, stream_id, timestamp_us, payload)
+        self.frame_count += 1
+
+    def append_audio(self, audio_bytes, timestamp_us=0):
+        if audio_bytes:
+            self._append(KIND_AUDIO, 0, timestamp_us, audio_bytes)
+
+    def _append(self, kind, stream_id, timestamp_us, payload):
+        with self._lock:
+            self._file.write(RECORD_HEADER.pack(kind, stream_id, int(timestamp_us), len(payload)))
+            self._file.write(payload)
+            self._index.append((kind, stream_id, int(timestamp_us), self._offset, len(payload)))
+            self._offset += RECORD_HEADER.size + len(payload)
+
+    def finish(self):
+        with self._lock:
+            if self.finished:
+                return self.size()
+            index_offset = self._offset
+            for entry in self._index:
+                self._file.write(INDEX_ENTRY.pack(*entry))
+            self._file.write(FOOTER.pack(FOOTER_MAGIC, index_offset, len(self._index)))
+            self._file.close()
+            self.finished = True
+        return self.size()
+
+    def size(self):
+        return os.path.getsize(self.path)
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def _read_line(reader):
+    # The operator's offset and OK lines; '' once it has closed the connection
+    line = reader.read_line()
+    return line.decode('utf-8').strip() if line is not None else ''
+
+
+def send_spool(target, spool, retries=5, block_size=256 * 1024, kind='SPOOL'):
+    """
+    Push a finished spool to the operator's bulk port. The operator answers
+    the header with the offset it already holds, so a broken transfer is
+    resumed on the next attempt rather than restarted. Returns True on success.
+    Anything with ``session_id``, ``path`` and ``size()`` can be sent; ``kind``
+    tells the operator what it is ('SPOOL' or 'ARCHIVE').
+    """
+    total = spool.size()
+    for attempt in range(1, retries + 1):
+        sock = None
+        try:
+            sock = socket.create_connection(target, timeout=30)
+            sock.sendall("{} {} {}\n".format(kind, spool.session_id, total).encode('utf-8'))
+            reader = LineReader(sock)
+            offset = int(_read_line(reader))
+            started = time.time()
+            sent = 0
+            with open(spool.path, 'rb') as f:
+                f.seek(offset)
+                while True:
+                    block = f.read(block_size)
+                    if not block:
+                        break
+                    sock.sendall(block)
+                    sent += len(block)
+            reply = _read_line(reader)
+            elapsed = max(1e-6, time.time() - started)
+            print("Spool sent: {} bytes from offset {} in {:.2f}s ({:.2f} MB/s), attempt {}".format(
+                sent, offset, elapsed, sent / elapsed / 1048576.0, attempt))
+            if reply == 'OK':
+                return True
+            print("Spool transfer not acknowledged ({!r}); retrying".format(reply))
+        except Exception as e:
+            print("Spool transfer attempt {} failed: {}".format(attempt, e))
+        finally:
+            if sock is not None:
+                try:
+                    sock.close()
+                except Exception:
+                    pass
+        time.sleep(min(5.0, 0.5 * attempt))
+    return False
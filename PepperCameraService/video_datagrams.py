@@ -0,0 +1,263 @@
+import errno
+import socket
+import struct
+import threading
+from collections import deque
+import numpy as np
+
+
+# Every video datagram starts with: magic, protocol version, kind, frame id, chunk index,
+# chunk count. The chunks of a frame carry the same bytes as before (frame header +
+# payload) split at CHUNK_PAYLOAD, so the operator can reassemble them in any order and
+# tell a lost chunk from a late one without an END marker.
+CHUNK_HEADER = struct.Struct('!2sBBIHH')
+CHUNK_MAGIC = b'PV'
+PROTOCOL_VERSION = 1
+KIND_FRAME = 0
+KIND_PARITY = 1
+DATAGRAM_SIZE = 1400
+CHUNK_PAYLOAD = DATAGRAM_SIZE - CHUNK_HEADER.size
+# Parity datagrams: the chunk header (index = parity index, count = data chunk count), then
+# parity count and the length of the frame's last data chunk, then CHUNK_PAYLOAD parity bytes
+PARITY_HEADER = struct.Struct('!HH')
+PARITY_DATAGRAM_SIZE = CHUNK_HEADER.size + PARITY_HEADER.size + CHUNK_PAYLOAD
+FRAME_ID_MODULO = 1 << 32
+# Linux UDP segmentation offload: one send carrying up to 64 segments / 64 kB
+UDP_SEGMENT = 103
+BATCH_DATAGRAMS = 40
+
+
+def chunk_count(length):
+    count = max(1, (length + CHUNK_PAYLOAD - 1) // CHUNK_PAYLOAD)
+    if count > 0xFFFF:
+        raise ValueError("frame of {} bytes needs more than 65535 chunks".format(length))
+    return count
+
+
+def frame_parity(frame_header, payload, overhead):
+    """
+    XOR parity for one frame: ceil(chunks * overhead) parity chunks, parity
+    j covering data chunks j, j + p, j + 2p... Interleaving spreads a burst
+    over the groups, so up to p lost chunks (one per group) are rebuilt
+    without a round trip. Returns (chunk count, last chunk length, parity rows).
+    """
+    length = len(frame_header) + len(payload)
+    count = chunk_count(length)
+    parity_count = min(count, max(1, int(np.ceil(count * overhead))))
+    rows = -(-count // parity_count) * parity_count
+    padded = np.zeros(rows * CHUNK_PAYLOAD, dtype=np.uint8)
+    padded[:len(frame_header)] = np.frombuffer(frame_header, dtype=np.uint8)
+    padded[len(frame_header):length] = np.frombuffer(payload, dtype=np.uint8)
+    parity = np.bitwise_xor.reduce(padded.reshape(-1, parity_count, CHUNK_PAYLOAD), axis=0)
+    return count, length - (count - 1) * CHUNK_PAYLOAD, parity
+
+
+# Retransmission requests from the operator, on the same UDP socket: magic, version,
+# entry count; then per entry: frame id, first chunk index, bitmap length in bytes
+# followed by the bitmap (bit i of byte j: chunk first + 8 * j + i is missing).
+# A zero-length bitmap asks for the whole frame (none of its chunks arrived).
+NACK_HEADER = struct.Struct('!2sBB')
+NACK_ENTRY = struct.Struct('!IHH')
+NACK_MAGIC = b'PN'
+
+
+def parse_nack(data):
+    """[(frame id, [chunk indexes] or None for the whole frame), ...]; [] if ``data`` is not a NACK."""
+    if len(data) < NACK_HEADER.size or data[:2] != NACK_MAGIC:
+        return []
+    _, version, count = NACK_HEADER.unpack_from(data)
+    if version != PROTOCOL_VERSION:
+        return []
+    requests = []
+    offset = NACK_HEADER.size
+    for _ in range(count):
+        if offset + NACK_ENTRY.size > len(data):
+            break
+        frame_id, first, length = NACK_ENTRY.unpack_from(data, offset)
+        offset += NACK_ENTRY.size
+        bitmap = bytearray(data[offset:offset + length])
+        offset += length
+        if not length:
+            requests.append((frame_id, None))
+            continue
+        indexes = [first + 8 * j + i for j, byte in enumerate(bitmap) for i in range(8) if byte & (1 << i)]
+        requests.append((frame_id, indexes))
+    return requests
+
+
+class RetransmitWindow(object):
+    """
+    The last ``max_frames`` frames (header and payload, not copied), for
+    answering NACKs. Frames older than that are past any latency budget
+    the operator would still wait for, so their requests are only counted
+    as misses.
+    """
+
+    def __init__(self, max_frames=64):
+        self.max_frames = max_frames
+        self._frames = {}
+        self._order = deque()
+        self._lock = threading.Lock()
+        self.nacks_received = 0
+        self.misses = 0
+
+    def store(self, frame_id, frame_header, payload):
+        with self._lock:
+            if frame_id not in self._frames:
+                self._order.append(frame_id)
+            self._frames[frame_id] = (frame_header, payload)
+            while len(self._order) > self.max_frames:
+                self._frames.pop(self._order.popleft(), None)
+
+    def lookup(self, data):
+        """[(frame id, frame header, payload, chunk indexes or None), ...] held for a NACK datagram."""
+        found = []
+        with self._lock:
+            for frame_id, indexes in parse_nack(data):
+                self.nacks_received += 1
+                frame = self._frames.get(frame_id)
+                if frame is None:
+                    self.misses += 1
+                    continue
+                found.append((frame_id, frame[0], frame[1], indexes))
+        return found
+
+
+class FrameSender(object):
+    """
+    Sends frames as chunk datagrams without building a frame-sized packet.
+    Modes, per what the interpreter and kernel allow:
+
+    - 'batch': one sendmsg per up to BATCH_DATAGRAMS chunks, gathering the
+      chunk headers and memoryview slices of the payload (no copies), with
+      UDP segmentation offload (Linux 4.18+) cutting it into datagrams.
+    - 'sendmsg': one sendmsg per datagram, header and payload slice as
+      separate buffers.
+    - 'send': one send of header + payload slice per datagram. The only
+      mode on Python 2.7 (no sendmsg), and the fallback when 'batch' is
+      refused; per datagram it is cheaper than 'sendmsg', since the syscall
+      dwarfs a 1.4 kB copy.
+
+    ``target`` None means the socket is connected to the operator. Keeps the
+    RetransmitWindow and adds FEC parity. Frames are sent from one thread and
+    resends from another, so the counters and the mode change under a lock.
+    """
+
+    def __init__(self, sock, target=None, fec_overhead=0.0, window_frames=64, mode=None):
+        self.sock = sock
+        self.target = target
+        self.fec_overhead = fec_overhead
+        self.window = RetransmitWindow(window_frames)
+        self.frame_id = 0
+        if mode is None:
+            mode = 'batch' if hasattr(sock, 'sendmsg') and hasattr(socket, 'SOL_UDP') else 'send'
+        self.mode = mode
+        self._address = () if target is None else (target,)
+        self._lock = threading.Lock()
+        self.frames_sent = 0
+        self.datagrams_sent = 0
+        self.chunks_resent = 0
+
+    def send_frame(self, frame_header, payload):
+        """Chunk datagrams (and parity) for frame header + payload; returns the frame id."""
+        frame_id = self.frame_id
+        self.frame_id = (frame_id + 1) % FRAME_ID_MODULO
+        self.window.store(frame_id, frame_header, payload)
+        self.send_chunks(frame_id, frame_header, payload)
+        if self.fec_overhead > 0:
+            self._send_parity(frame_id, frame_header, payload)
+        with self._lock:
+            self.frames_sent += 1
+        return frame_id
+
+    def send_chunks(self, frame_id, frame_header, payload, indexes=None):
+        """Send the given chunks (all by default, ascending); returns how many."""
+        header_length = len(frame_header)
+        count = chunk_count(header_length + len(payload))
+        indexes = range(count) if indexes is None else [i for i in indexes if i < count]
+        with self._lock:
+            mode = self.mode
+        if mode == 'send':
+            return self._send_each(frame_id, frame_header, payload, count, indexes)
+        view = memoryview(payload)
+        chunks = []
+        for index in indexes:
+            start = index * CHUNK_PAYLOAD - header_length
+            end = start + CHUNK_PAYLOAD
+            parts = [CHUNK_HEADER.pack(CHUNK_MAGIC, PROTOCOL_VERSION, KIND_FRAME, frame_id, index, count)]
+            if start < 0:
+                parts.append(frame_header)
+                start = 0
+            parts.append(view[start:end])
+            if mode == 'sendmsg':
+                self.sock.sendmsg(parts, [], 0, *self._address)
+                self._count(1)
+            else:
+                chunks.append(parts)
+        if chunks:
+            self._send_batches(chunks)
+        return len(indexes)
+
+    def _send_batches(self, chunks):
+        segment = [(socket.SOL_UDP, UDP_SEGMENT, struct.pack('@H', DATAGRAM_SIZE))]
+        sent = 0
+        try:
+            while sent < len(chunks):
+                batch = chunks[sent:sent + BATCH_DATAGRAMS]
+                self.sock.sendmsg([buffer for parts in batch for buffer in parts], segment, 0, *self._address)
+                sent += len(batch)
+                self._count(len(batch))
+        except OSError as e:
+            if e.errno == errno.ECONNREFUSED:
+                raise   # the operator's port, not the kernel: the caller drops the frame
+            # No UDP segmentation offload on this kernel: one datagram per send from now on
+            print("UDP segmentation offload unavailable; sending datagrams one by one")
+            with self._lock:
+                self.mode = 'send'
+            for parts in chunks[sent:]:
+                self._send(b"".join(parts))
+
+    def _send_each(self, frame_id, frame_header, payload, count, indexes):
+        header_length = len(frame_header)
+        for index in indexes:
+            start = index * CHUNK_PAYLOAD - header_length
+            end = start + CHUNK_PAYLOAD
+            chunk_header = CHUNK_HEADER.pack(CHUNK_MAGIC, PROTOCOL_VERSION, KIND_FRAME, frame_id, index, count)
+            if start < 0:
+                chunk_header += frame_header
+                start = 0
+            self._send(chunk_header + payload[start:end])
+        return len(indexes)
+
+    def handle_nack(self, data):
+        """Resend what a NACK datagram asks for; returns the number of chunks resent."""
+        resent = 0
+        for frame_id, frame_header, payload, indexes in self.window.lookup(data):
+            resent += self.send_chunks(frame_id, frame_header, payload, indexes)
+        with self._lock:
+            self.chunks_resent += resent
+        return resent
+
+    def _send_parity(self, frame_id, frame_header, payload):
+        count, last_length, parity = frame_parity(frame_header, payload, self.fec_overhead)
+        extra = PARITY_HEADER.pack(len(parity), last_length)
+        for j in range(len(parity)):
+            header = CHUNK_HEADER.pack(CHUNK_MAGIC, PROTOCOL_VERSION, KIND_PARITY, frame_id, j, count) + extra
+            self._send(header + parity[j].tobytes())
+
+    def _send(self, datagram):
+        if self.target is None:
+            self.sock.send(datagram)
+        else:
+            self.sock.sendto(datagram, self.target)
+        self._count(1)
+
+    def _count(self, datagrams):
+        with self._lock:
+            self.datagrams_sent += datagrams
+
+    def summary(self):
+        with self._lock:
+            return "Video: {} frames in {} datagrams ({}); NACKs: {} received, {} chunks resent, {} for frames no longer held".format(
+                self.frames_sent, self.datagrams_sent, self.mode, self.window.nacks_received, self.chunks_resent,
+                self.window.misses)
@@ -0,0 +1,73 @@
+import numpy as np
+
+
+class VoiceActivityDetector(object):
+    """
+    Energy + zero-crossing voice activity detector over the mono mix, fed
+    buffer by buffer. Features are computed for all 20 ms frames of a buffer
+    at once; only the few per-buffer decisions run in Python. The noise floor
+    falls instantly and rises slowly, and a hundred times slower still during
+    speech, so a long utterance does not raise it into the speech itself;
+    a lasting rise in the background is still followed. Speech is what
+    stands ``ratio`` above it. Segments are (start sample, end sample) in
+    the mono recording.
+    """
+
+    def __init__(self, sample_rate=48000, frame_ms=20, ratio=4.0, min_energy=100.0, max_zcr=0.35,
+                 hangover_ms=300, min_speech_ms=150, noise_rise=0.01, speech_noise_rise=0.0001):
+        self.frame = sample_rate * frame_ms // 1000
+        self.ratio = ratio
+        self.min_energy = min_energy
+        self.max_zcr = max_zcr
+        self.noise_rise = noise_rise
+        self.speech_noise_rise = speech_noise_rise
+        self.hangover_frames = hangover_ms // frame_ms
+        self.min_speech = sample_rate * min_speech_ms // 1000
+        self.segments = []
+        self._carry = np.zeros(0, dtype=np.int16)
+        self._position = 0          # sample index of the first carried sample
+        self._noise = None
+        self._start = None
+        self._silent_frames = 0
+
+    def process(self, mono):
+        samples = np.concatenate((self._carry, mono)) if len(self._carry) else mono
+        count = len(samples) // self.frame
+        if count:
+            frames = samples[:count * self.frame].reshape(count, self.frame).astype(np.float32)
+            energy = (frames * frames).mean(axis=1)
+            signs = frames < 0
+            zcr = (signs[:, 1:] != signs[:, :-1]).mean(axis=1)
+            for i in range(count):
+                self._decide(self._position + i * self.frame, float(energy[i]), float(zcr[i]))
+        self._carry = samples[count * self.frame:].copy()
+        self._position += count * self.frame
+
+    def _decide(self, frame_start, energy, zcr):
+        if self._noise is None:
+            self._noise = energy
+        voiced = energy > self.min_energy and energy > self._noise * self.ratio and zcr < self.max_zcr
+        if energy < self._noise:
+            self._noise = energy
+        else:
+            self._noise += (energy - self._noise) * (self.speech_noise_rise if voiced else self.noise_rise)
+        if voiced:
+            if self._start is None:
+                self._start = frame_start
+            self._silent_frames = 0
+        elif self._start is not None:
+            self._silent_frames += 1
+            if self._silent_frames > self.hangover_frames:
+                self._close(frame_start - (self._silent_frames - 1) * self.frame)
+
+    def _close(self, end):
+        if end - self._start >= self.min_speech:
+            self.segments.append((self._start, end))
+        self._start = None
+        self._silent_frames = 0
+
+    def finish(self):
+        """Close an open segment at the end of the recording; returns all segments."""
+        if self._start is not None:
+            self._close(self._position + len(self._carry) - self._silent_frames * self.frame)
+        return self.segments